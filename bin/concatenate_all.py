@@ -2,6 +2,11 @@
 """
 Walks the submission directory and creates a parallel directory of
 the concatenated files.
+
+Other gradeables which already have a fingerprint index aren't concatenated (see
+common/fingerprint_index.py).  Once the run is done, this is run again with --matched
+to concatenate just the submissions of those gradeables which matched this gradeable, and to
+write their tokens from the archive kept with each index.
 """
 
 import argparse
@@ -12,21 +17,42 @@ import datetime
 import humanize
 import fnmatch
 import hashlib
+import locale
 import mimetypes
+from functools import lru_cache
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.fingerprint_index import extract_tokens, index_dir, read_manifest, tokens_path, update_manifest  # noqa: E402,E501
+from common.metrics import StageMetrics, timed  # noqa: E402
+from common.parallel import run_in_order  # noqa: E402
+
 IGNORED_FILES = [
     ".submit.timestamp",
     ".user_assignment_access.json"
 ]
 
+# the number of characters copied from each file at once
+CHUNK_SIZE = 1024 * 1024
+
+# the encoding concatenated files are written in, which is the default text encoding
+OUTPUT_ENCODING = locale.getpreferredencoding(False)
+
 with open(Path(__file__).resolve().parent / "lichen_config.json") as lichen_config_file:
     LICHEN_CONFIG = json.load(lichen_config_file)
 
 
-# returns a string containing the contents of the files which match the regex in the specified dir
-def getConcatFilesInDir(input_dir, regex_patterns):
-    result = ""
+# returns whether the type of a file, which is guessed from its name, can't be compared.
+# Submissions tend to share file names, so each name is only looked up once.
+@lru_cache(maxsize=None)
+def isUnsupportedFileType(file_name):
+    file_type = mimetypes.guess_type(file_name)[0]
+    return file_type is not None and (file_type.endswith("/pdf") or file_type.startswith("image/"))
+
+
+# yields the name and path of each file which matches the regex in the specified dir, in the
+# order they should be concatenated
+def getFilesToConcat(input_dir, regex_patterns):
     for my_dir, _dirs, my_files in os.walk(input_dir):
         # Determine if regex should be used (blank regex is equivalent to selecting all files)
         files = sorted(my_files)
@@ -52,24 +78,31 @@ def getConcatFilesInDir(input_dir, regex_patterns):
                 continue
 
             # check for MIME types which are not supported
-            file_type = mimetypes.guess_type(my_file)[0]
-            if file_type is not None and \
-                    (file_type.endswith("/pdf") or file_type.startswith("image/")):
+            if isUnsupportedFileType(my_file):
                 continue
 
-            absolute_path = os.path.join(my_dir, my_file)
-            # print a separator & filename
-            with open(absolute_path, encoding='ISO-8859-1') as tmp:
-                result += f"==== {my_file} ====\n"
-                # append the contents of the file
-                result += tmp.read() + "\n"
-    return result
+            yield my_file, os.path.join(my_dir, my_file)
 
 
-# This function is passed a path to a gradeable and an output path to place files in and
-# concatenates all of the files for each submission into a single file in the output directory
-# returns the total size of the files concatenated
-def processGradeable(basepath, config, input_dir, output_dir, total_concat):
+# writes the contents of the files which match the regex in the specified dir to output_file,
+# which is opened in binary mode.  Each file is copied a chunk at a time so that the memory
+# used doesn't depend on the size of the submission.  Returns the number of bytes written.
+def writeConcatFilesInDir(input_dir, regex_patterns, output_file):
+    bytes_written = 0
+    for my_file, absolute_path in getFilesToConcat(input_dir, regex_patterns):
+        # print a separator & filename
+        bytes_written += output_file.write(f"==== {my_file} ====\n".encode(OUTPUT_ENCODING))
+        # append the contents of the file
+        with open(absolute_path, encoding='ISO-8859-1') as tmp:
+            for chunk in iter(lambda: tmp.read(CHUNK_SIZE), ""):
+                bytes_written += output_file.write(chunk.encode(OUTPUT_ENCODING))
+        bytes_written += output_file.write(b"\n")
+    return bytes_written
+
+
+# This function is passed a path to a gradeable and returns the names of the users whose
+# submissions should be concatenated
+def findUsers(basepath, config, input_dir):
     # basic error checking
     if not Path(input_dir).exists():
         raise SystemExit(f"ERROR: Unable to find directory {input_dir}")
@@ -78,47 +111,105 @@ def processGradeable(basepath, config, input_dir, output_dir, total_concat):
         raise SystemExit(f"ERROR: Group for directory {input_dir} does not"
                          f"match group for {basepath} directory")
 
-    # loop over each user
-    for user in sorted(os.listdir(input_dir)):
-        user_path = os.path.join(input_dir, user)
-        if not os.path.isdir(user_path):
+    with os.scandir(input_dir) as entries:
+        return sorted(entry.name for entry in entries
+                      if entry.is_dir() and entry.name not in config["ignore_submissions"])
+
+
+# returns a list of (version, path to version) pairs for each of the user's submissions
+# which should be concatenated
+def findVersions(config, input_dir, user):
+    user_path = os.path.join(input_dir, user)
+    with os.scandir(user_path) as entries:
+        versions = sorted(entry.name for entry in entries)
+
+    if config["version"] == "active_version":
+        # get the user's active version from their settings file if it exists, else get
+        # most recent version for compatibility with early versions of Submitty
+        submissions_details_path = os.path.join(user_path, 'user_assignment_settings.json')
+        if os.path.exists(submissions_details_path):
+            with open(submissions_details_path) as details_file:
+                details_json = json.load(details_file)
+                my_active_version = int(details_json["active_version"])
+        else:
+            # get the most recent version
+            my_active_version = versions[-1]
+
+    result = []
+    for version in versions:
+        version_path = os.path.join(user_path, version)
+        if dir == "results":
+            # only the "details" folder within "results" contains files relevant to Lichen
+            version_path = os.path.join(version_path, "details")
+        if not os.path.isdir(version_path):
             continue
-        elif user in config["ignore_submissions"]:
+        if config["version"] == "active_version" and int(version) != my_active_version:
             continue
+        result.append((version, version_path))
+    return result
 
-        if config["version"] == "active_version":
-            # get the user's active version from their settings file if it exists, else get
-            # most recent version for compatibility with early versions of Submitty
-            submissions_details_path = os.path.join(user_path, 'user_assignment_settings.json')
-            if os.path.exists(submissions_details_path):
-                with open(submissions_details_path) as details_file:
-                    details_json = json.load(details_file)
-                    my_active_version = int(details_json["active_version"])
-            else:
-                # get the most recent version
-                my_active_version = sorted(os.listdir(user_path))[-1]
-
-        # loop over each version
-        for version in sorted(os.listdir(user_path)):
-            version_path = os.path.join(user_path, version)
-            if dir == "results":
-                # only the "details" folder within "results" contains files relevant to Lichen
-                version_path = os.path.join(version_path, "details")
-            if not os.path.isdir(version_path):
-                continue
-            if config["version"] == "active_version" and int(version) != my_active_version:
-                continue
-
-            output_file_path = os.path.join(output_dir, user, version, "submission.concatenated")
-
-            if not os.path.exists(os.path.dirname(output_file_path)):
-                os.makedirs(os.path.dirname(output_file_path))
 
-            # append to concatenated file
-            with open(output_file_path, "a") as output_file:
-                concatenated_contents = getConcatFilesInDir(version_path, config["regex"])
-                output_file.write(concatenated_contents)
-                total_concat += sys.getsizeof(concatenated_contents)
+# concatenates all of the files in each of version_paths, in order, into output_file_path.
+# Returns the number of bytes written
+def concatenateSubmission(output_file_path, version_paths, regex_patterns):
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    bytes_written = 0
+    with open(output_file_path, "wb") as output_file:
+        for version_path in version_paths:
+            bytes_written += writeConcatFilesInDir(version_path, regex_patterns, output_file)
+    return bytes_written
+
+
+# Concatenates every submission of each gradeable in sources, which is a list of
+# (path to gradeable, output directory, submission sizes) tuples.  All of the files for each
+# submission are concatenated into a single file in its output directory, and the number of
+# bytes concatenated for it is stored in that gradeable's submission sizes, a dict mapping
+# "user:version" strings to sizes.  A submission found in several sources (such as in both
+# the submissions and results directories) is concatenated in the order of sources.
+#
+# Submission trees are often on network filesystems, so finding and concatenating the
+# submissions mostly waits on file metadata and reads.  Both are spread over a pool of
+# worker threads, and the results are collected in the same order as a sequential walk so
+# that the output doesn't depend on the number of workers.  The time spent on each phase and
+# submission is recorded in metrics.  If only is given, just the concatenated files in it are
+# written.  Returns the new total size of the files concatenated.
+def processGradeables(basepath, config, sources, total_concat, workers, metrics, only=None):
+    user_jobs = []
+    user_outputs = []
+    # every concatenated file, and the version directories to concatenate into it
+    submissions = dict()
+    # the directories of the users with files in only, whose versions need to be found
+    only_users = None if only is None else {os.path.dirname(os.path.dirname(path))
+                                            for path in only}
+    with metrics.phase("find submissions"):
+        for input_dir, output_dir, submission_sizes in sources:
+            for user in findUsers(basepath, config, input_dir):
+                if only_users is not None and os.path.join(output_dir, user) not in only_users:
+                    continue
+                user_jobs.append((config, input_dir, user))
+                user_outputs.append((output_dir, submission_sizes))
+
+        for (_config, _input_dir, user), (output_dir, submission_sizes), versions in \
+                zip(user_jobs, user_outputs, run_in_order(findVersions, user_jobs, workers)):
+            for version, version_path in versions:
+                output_file_path = os.path.join(output_dir, user, version,
+                                                "submission.concatenated")
+                if only is not None and output_file_path not in only:
+                    continue
+                if output_file_path not in submissions:
+                    submissions[output_file_path] = (submission_sizes, f"{user}:{version}", [])
+                submissions[output_file_path][2].append(version_path)
+
+    concat_jobs = [(concatenateSubmission, output_file_path, version_paths, config["regex"])
+                   for output_file_path, (_sizes, _key, version_paths) in submissions.items()]
+    with metrics.phase("concatenate submissions"):
+        for (output_file_path, (submission_sizes, submission_key, _paths)), \
+                (seconds, bytes_written) in zip(submissions.items(),
+                                                run_in_order(timed, concat_jobs, workers)):
+            submission_sizes[submission_key] = bytes_written
+            total_concat += bytes_written
+            metrics.add_submission(Path(output_file_path).parent.relative_to(basepath), seconds,
+                                   bytes_written=bytes_written)
 
             # If we've exceeded the concatenation limit, kill program
             checkTotalSize(total_concat)
@@ -136,9 +227,25 @@ def parse_args():
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("basepath")
     parser.add_argument("datapath")
+    parser.add_argument("--matched", action="store_true",
+                        help="concatenate the submissions of other gradeables read from their "
+                             "fingerprint indexes which matched, once the run is done")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of submissions to read at once (0 uses every available "
+                             "core, defaults to concatenate_workers in lichen_config.json)")
     return parser.parse_args()
 
 
+# returns the number of threads which should find and concatenate submissions at once
+def get_worker_count(args):
+    workers = args.workers
+    if workers is None:
+        workers = LICHEN_CONFIG.get("concatenate_workers", 1)
+    if workers <= 0:
+        workers = len(os.sched_getaffinity(0))
+    return workers
+
+
 def validate(config, args):
     # load parameters from the config to be checked
     regex_patterns = config["regex"]
@@ -194,11 +301,94 @@ def validate(config, args):
             raise SystemExit(f"ERROR: {dir} is not a valid input directory for Lichen")
 
 
+# returns a dict mapping the name of each of the other gradeables to its identity, and a list
+# of (path to gradeable, output directory) pairs to concatenate it from
+def findOtherGradeables(args, config):
+    other_sources = dict()
+    for other_gradeable in config["other_gradeables"]:
+        other_gradeable_name = f"{other_gradeable['other_term']}__{other_gradeable['other_course']}__{other_gradeable['other_gradeable']}"  # noqa: E501
+        output_path = os.path.join(args.basepath, "other_gradeables", other_gradeable_name)
+        paths = []
+        for dir in config["regex_dirs"]:
+            input_path = os.path.join(args.datapath,
+                                      other_gradeable["other_term"],
+                                      other_gradeable["other_course"],
+                                      dir,
+                                      other_gradeable["other_gradeable"])
+            paths.append((input_path, output_path))
+        other_sources[other_gradeable_name] = ([other_gradeable["other_term"],
+                                                other_gradeable["other_course"],
+                                                other_gradeable["other_gradeable"]], paths)
+
+    # take care of any manually-specified paths if they exist
+    # optional field -> other_gradeable_paths=None if key doesn't exist
+    if config.get("other_gradeable_paths") is not None:
+        for path in config["other_gradeable_paths"]:
+            # We hash the path as the name of the gradeable
+            dir_name = hashlib.md5(path.encode('utf-8')).hexdigest()
+            output_path = os.path.join(args.basepath, "other_gradeables", dir_name)
+            other_sources[dir_name] = (path, [(path, output_path)])
+    return other_sources
+
+
+# concatenates the submissions of the other gradeables which were read from their fingerprint
+# indexes, and which match a submission of this gradeable according to match_summary.json.
+# Their tokens, which the matches' positions refer to, are written from the index's archive.
+def concatenateMatched(args, config):
+    start_time = datetime.datetime.now()
+    metrics = StageMetrics("concatenate_matched")
+    attached = {name: entry for name, entry in read_manifest(args.basepath).items()
+                if entry["attached"]}
+    summary_path = os.path.join(args.basepath, "match_summary.json")
+    if len(attached) == 0 or not os.path.isfile(summary_path):
+        return
+
+    with open(summary_path) as summary_file:
+        summary = json.load(summary_file)
+    only = set()
+    # the (user, version, output directory) of the matching submissions of each gradeable
+    matched = {name: set() for name in attached}
+    for submission in summary["submissions"]:
+        for user, version, source_gradeable, _hashes_matched in submission["matches"]:
+            if source_gradeable in attached:
+                output_dir = os.path.join(args.basepath, "other_gradeables", source_gradeable,
+                                          user, str(version))
+                only.add(os.path.join(output_dir, "submission.concatenated"))
+                matched[source_gradeable].add((user, version, output_dir))
+
+    with metrics.phase("write tokens"):
+        directory = index_dir(args.basepath, LICHEN_CONFIG)
+        tokens_written = sum(extract_tokens(tokens_path(directory, attached[name]["key"]),
+                                            sorted(submissions))
+                             for name, submissions in matched.items())
+
+    sources = []
+    other_submission_sizes = dict()
+    for name, (_identity, paths) in findOtherGradeables(args, config).items():
+        if name in attached:
+            sources.extend((input_path, output_path,
+                            other_submission_sizes.setdefault(name, dict()))
+                           for input_path, output_path in paths)
+    total_concat = processGradeables(args.basepath, config, sources, 0, get_worker_count(args),
+                                     metrics, only)
+
+    concatenated = sum(len(sizes) for sizes in other_submission_sizes.values())
+    metrics.set("total_bytes", total_concat)
+    metrics.set("matched_submissions", concatenated)
+    metrics.set("tokens_written", tokens_written)
+    metrics.write(args.basepath)
+    print("Concatenated", concatenated, "matching submissions of indexed gradeables, and wrote",
+          "the tokens of", tokens_written, "of them in",
+          humanize.precisedelta(start_time, format="%1.f") + ",",
+          humanize.naturalsize(total_concat), "concatenated")
+
+
 def main():
     start_time = datetime.datetime.now()
     args = parse_args()
+    metrics = StageMetrics("concatenate_all")
 
-    print("CONCATENATE ALL:", flush=True)
+    print("CONCATENATE MATCHED:" if args.matched else "CONCATENATE ALL:", flush=True)
 
     config_path = os.path.join(args.basepath, "config.json")
     if not os.path.isfile(config_path):
@@ -216,89 +406,73 @@ def main():
     gradeable = config["gradeable"]
     regex_patterns = config["regex"]
     regex_dirs = config["regex_dirs"]
-    other_gradeables = config["other_gradeables"]
-    # optional field -> other_gradeable_paths=None if key doesn't exist
-    other_gradeable_paths = config.get("other_gradeable_paths")
+
+    if args.matched:
+        concatenateMatched(args, config)
+        return
 
     # ==========================================================================
-    # loop through and concatenate the selected files for each user in this gradeable
+    # find the selected files for each user in this gradeable
     total_concat = 0
+    # the number of bytes concatenated for each submission of this gradeable
+    submission_sizes = dict()
+    # the same, for each of the other gradeables
+    other_submission_sizes = dict()
+    # (path to gradeable, output directory, submission sizes) for everything to be concatenated
+    sources = []
 
     for dir in regex_dirs:
         input_path = os.path.join(args.datapath, term, course, dir, gradeable)
         output_path = os.path.join(args.basepath, "users")
-        total_concat = processGradeable(args.basepath, config,
-                                        input_path, output_path, total_concat)
+        sources.append((input_path, output_path, submission_sizes))
 
     # ==========================================================================
-    # loop over all of the other gradeables and concatenate their submissions
-    for other_gradeable in other_gradeables:
-        for dir in regex_dirs:
-            input_path = os.path.join(args.datapath,
-                                      other_gradeable["other_term"],
-                                      other_gradeable["other_course"],
-                                      dir,
-                                      other_gradeable["other_gradeable"])
-
-            output_path = os.path.join(args.basepath, "other_gradeables",
-                                       f"{other_gradeable['other_term']}__{other_gradeable['other_course']}__{other_gradeable['other_gradeable']}")  # noqa: E501
-            total_concat = processGradeable(args.basepath, config,
-                                            input_path, output_path, total_concat)
+    # other gradeables which already have a fingerprint index aren't concatenated
+    other_sources = findOtherGradeables(args, config)
+    with metrics.phase("find fingerprint indexes"):
+        manifest = update_manifest(args.basepath, config, LICHEN_CONFIG,
+                                   {name: (identity, [input_path for input_path, _ in paths])
+                                    for name, (identity, paths) in other_sources.items()})
+
+    for name, (_identity, paths) in other_sources.items():
+        if name in manifest and manifest[name]["attached"]:
+            continue
+        for input_path, output_path in paths:
+            sources.append((input_path, output_path,
+                            other_submission_sizes.setdefault(name, dict())))
 
-    # take care of any manually-specified paths if they exist
-    if other_gradeable_paths is not None:
-        for path in other_gradeable_paths:
-            # We hash the path as the name of the gradeable
-            dir_name = hashlib.md5(path.encode('utf-8')).hexdigest()
-            output_path = os.path.join(args.basepath, "other_gradeables", dir_name)
-            total_concat = processGradeable(args.basepath, config, path,
-                                            output_path, total_concat)
+    # concatenate all of them at once
+    total_concat = processGradeables(args.basepath, config, sources, total_concat,
+                                     get_worker_count(args), metrics)
 
     # ==========================================================================
-    # iterate over all of the created submissions, checking to see if they are empty
-    # and printing a message if so
-
-    empty_directories = []  # holds a list of users who had no files concatenated
-
-    for user in os.listdir(os.path.join(args.basepath, "users")):
-        user_path = os.path.join(args.basepath, "users", user)
-        for version in os.listdir(user_path):
-            version_path = os.path.join(user_path, version)
-            my_concatenated_file = os.path.join(version_path, "submission.concatenated")
-            with open(my_concatenated_file, "r") as my_cf:
-                if my_cf.read() == "":
-                    empty_directories.append(f"{user}:{version}")
+    # print a message for any of the created submissions which are empty, using the number of
+    # bytes concatenated for each of them
+
+    empty_directories = [submission for submission, size in submission_sizes.items() if size == 0]
     if len(empty_directories) > 0:
         print("Warning: No files matched provided regex in selected directories for user(s):",
               ", ".join(empty_directories))
 
     # do the same for the other gradeables
-    for other_gradeable in os.listdir(os.path.join(args.basepath, "other_gradeables")):
-        empty_directories = []
-        for other_user in os.listdir(os.path.join(args.basepath,
-                                                  "other_gradeables", other_gradeable)):
-            other_user_path = os.path.join(args.basepath, "other_gradeables",
-                                           other_gradeable, other_user)
-            for other_version in os.listdir(other_user_path):
-                other_version_path = os.path.join(other_user_path, other_version)
-                my_concatenated_file = os.path.join(other_version_path, "submission.concatenated")
-                with open(my_concatenated_file, "r") as my_cf:
-                    if my_cf.read() == "":
-                        empty_directories.append(f"{other_user}:{other_version}")
+    for other_gradeable, sizes in other_submission_sizes.items():
+        empty_directories = [submission for submission, size in sizes.items() if size == 0]
         if len(empty_directories) > 0:
             print("Warning: No files matched provided regex in selected directories for user(s):",
                   ", ".join(empty_directories), "in gradeable", other_gradeable)
 
     # ==========================================================================
     # concatenate provided code
-    with open(os.path.join(args.basepath, "provided_code",
-                           "submission.concatenated"), "w") as file:
+    with metrics.phase("concatenate provided code"), \
+            open(os.path.join(args.basepath, "provided_code",
+                              "submission.concatenated"), "wb") as file:
         provided_code_files = os.path.join(args.basepath, "provided_code", "files")
-        provided_concatenated_files = getConcatFilesInDir(provided_code_files, regex_patterns)
-        file.write(provided_concatenated_files)
-        total_concat += sys.getsizeof(provided_concatenated_files)
+        total_concat += writeConcatFilesInDir(provided_code_files, regex_patterns, file)
     checkTotalSize(total_concat)
 
+    metrics.set("total_bytes", total_concat)
+    metrics.write(args.basepath)
+
     # ==========================================================================
     print("Concatenation done in", humanize.precisedelta(start_time, format="%1.f") + ",",
           humanize.naturalsize(total_concat), "concatenated")
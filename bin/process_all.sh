@@ -14,7 +14,16 @@ KILL_ERROR_MESSAGE="
 * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
 ";
 
-python3 /Lichen/tokenizer/tokenize_all.py                "/data" || exit 1
-python3 /Lichen/hasher/hash_all.py                       "/data" || exit 1
+# tokenize and hash every submission in a single pass if streaming_pipeline is set in
+# lichen_config.json, and otherwise run each stage on its own
+STREAMING_PIPELINE=$(python3 -c 'import json; print(json.load(open("/Lichen/bin/lichen_config.json")).get("streaming_pipeline", False))')
+if [ "${STREAMING_PIPELINE}" = "True" ]; then
+    python3 /Lichen/bin/stream_all.py                    "/data" || exit 1
+else
+    python3 /Lichen/tokenizer/tokenize_all.py            "/data" || exit 1
+    python3 /Lichen/hasher/hash_all.py                   "/data" || exit 1
+fi
+python3 /Lichen/hasher/minhash_prefilter.py              "/data" || exit 1
 /Lichen/compare_hashes/compare_hashes.out                "/data" || { echo "${KILL_ERROR_MESSAGE}"; exit 1; } 
 python3 /Lichen/similarity_ranking/similarity_ranking.py "/data";
+python3 /Lichen/similarity_ranking/similarity_matrix.py  "/data";
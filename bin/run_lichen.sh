@@ -27,15 +27,22 @@ if [ ! -f "${BASEPATH}/config.json" ]; then
 fi
 
 
-# delete any previous run results
-# TODO: determine if any caching should occur
+# delete any previous run results.  The tokens and hashes of every submission are kept in
+# ${BASEPATH}/cache, keyed by their contents and settings, so unchanged submissions aren't
+# tokenized or hashed again (see common/artifact_cache.py).  The fingerprint indexes of other
+# gradeables are kept for the same reason, in fingerprint_index_dir from lichen_config.json or
+# in ${BASEPATH}/fingerprint_indexes (see common/fingerprint_index.py).
 rm -rf "${BASEPATH}/logs"
 rm -rf "${BASEPATH}/other_gradeables"
 rm -rf "${BASEPATH}/users"
 rm -f "${BASEPATH}/overall_ranking.txt"
+rm -f "${BASEPATH}/match_summary.json"
+rm -f "${BASEPATH}/similarity_matrix.bin"
+rm -f "${BASEPATH}/other_gradeable_candidates.json"
 rm -f "${BASEPATH}/provided_code/submission.concatenated"
 rm -f "${BASEPATH}/provided_code/tokens.json"
 rm -f "${BASEPATH}/provided_code/hashes.txt"
+rm -f "${BASEPATH}/provided_code/hashes.bin"
 
 # Make a logs directory so we can start logging any errors
 mkdir -p "${BASEPATH}/logs"
@@ -58,6 +65,14 @@ mkdir -p "${BASEPATH}/logs"
 
     cd "$(dirname "${0}")" || exit 1
 
+    # the fingerprint indexes shared by every run, if fingerprint_index_dir is set, are mounted
+    # at the same path in the container.  install_lichen.sh creates the directory.
+    FINGERPRINT_INDEX_DIR=$(python3 -c 'import json; print(json.load(open("lichen_config.json")).get("fingerprint_index_dir", ""))') || exit 1
+    if [ -n "${FINGERPRINT_INDEX_DIR}" ] && [ ! -d "${FINGERPRINT_INDEX_DIR}" ]; then
+        echo "ERROR: fingerprint_index_dir ${FINGERPRINT_INDEX_DIR} does not exist, rerun install_lichen.sh"
+        exit 1
+    fi
+
     ############################################################################
     # Do some preprocessing
     echo "Beginning Lichen run: $(date +"%Y-%m-%d %H:%M:%S")"
@@ -66,7 +81,16 @@ mkdir -p "${BASEPATH}/logs"
     ############################################################################
     # Run Lichen
 
-    docker run --rm -v "${BASEPATH}":/data -v "${LICHEN_INSTALLATION_DIR}":/Lichen submitty/lichen
+    if [ -n "${FINGERPRINT_INDEX_DIR}" ]; then
+        docker run --rm -v "${BASEPATH}":/data -v "${LICHEN_INSTALLATION_DIR}":/Lichen -v "${FINGERPRINT_INDEX_DIR}":"${FINGERPRINT_INDEX_DIR}" submitty/lichen
+    else
+        docker run --rm -v "${BASEPATH}":/data -v "${LICHEN_INSTALLATION_DIR}":/Lichen submitty/lichen
+    fi
+
+    ############################################################################
+    # Concatenate the submissions of other gradeables read from their fingerprint indexes
+    # which matched, so that they can be viewed
+    python3 concatenate_all.py "$BASEPATH" "$DATAPATH" --matched || exit 1
 
     ############################################################################
     echo "Lichen run complete: $(date +"%Y-%m-%d %H:%M:%S")"
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Tokenizes and hashes every concatenated submission in a single pass, in place of
+running tokenize_all.py and then hash_all.py.
+
+Each submission is streamed through both stages: a pool of threads hands the
+submissions to tokenizer workers, which send back the value of each token along
+with writing tokens.json, and the values are hashed as soon as they arrive while
+the next submissions are still being tokenized.  The tokens never have to be read
+back from disk, and tokens.json files are only written if keep_tokens is set in
+lichen_config.json or the cache is enabled.  Tokens and hashes are cached exactly as
+tokenize_all.py and hash_all.py cache them, so a rerun copies both from the cache.
+process_all.sh only runs this in place of the separate stages if streaming_pipeline
+is set in lichen_config.json.
+"""
+
+import argparse
+import os
+import sys
+import json
+import datetime
+import humanize
+from functools import partial
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+sys.path.append(str(Path(__file__).resolve().parent.parent / "tokenizer"))
+sys.path.append(str(Path(__file__).resolve().parent.parent / "hasher"))
+from common.artifact_cache import ArtifactCache, file_digest  # noqa: E402
+from common.fingerprint_index import index_dir, index_gradeable, read_manifest  # noqa: E402
+from common.hash_file import hashes_file_name  # noqa: E402
+from common.metrics import StageMetrics, file_size, timed  # noqa: E402
+from common.parallel import run_in_order  # noqa: E402
+from common.token_stream import read_tokens  # noqa: E402
+import tokenize_all  # noqa: E402
+import hash_all  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("basepath")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of submissions to tokenize at once (0 uses every available "
+                             "core, defaults to tokenizer_workers in lichen_config.json)")
+    return parser.parse_args()
+
+
+# tokenizes a single submission, returning anything the tokenizer printed, whether cached
+# tokens were used, and the token_value field of every token, or None if they are only in
+# my_tokenized_file.  The tokens are only written to my_tokenized_file if keep_tokens is set,
+# or if the cache is enabled, since the cache keys of the tokens' hashes are digests of it.
+def tokenize_submission(cache, settings_key, pool, tokenize_func, token_value, keep_tokens,
+                        my_concatenated_file, my_tokenized_file):
+    key = None
+    if cache.enabled():
+        key = cache.key(settings_key, file_digest(my_concatenated_file))
+        if cache.fetch(key, "tokens.json", my_tokenized_file):
+            return "", True, None
+
+    values = None
+    if pool is not None:
+        output = my_tokenized_file if keep_tokens or key is not None else None
+        stderr, values = pool.tokenize_values(my_concatenated_file, output, token_value)
+    else:
+        # tokenizers which aren't run as workers can only write their tokens to a file
+        stderr = tokenize_func(my_concatenated_file, my_tokenized_file)
+
+    # only clean runs are cached so that any problems are reported again on the next run
+    if key is not None and stderr.strip() == "":
+        cache.store(key, "tokens.json", my_tokenized_file)
+    return stderr, False, values
+
+
+# hashes the token values of a submission, or the tokens in my_tokenized_file if values is
+# None, unless identical tokens were already hashed with the same settings, in which case the
+# cached hashes are copied instead, as hash_all.hash_cached does.  Returns whether they were.
+def hash_submission(cache, settings_key, lichen_config, lichen_run_config, token_value,
+                    winnowing_window, values, my_tokenized_file, my_hashes_file):
+    key = None
+    if cache.enabled():
+        key = hash_all.get_hashes_key(cache, settings_key, winnowing_window, my_tokenized_file)
+        if cache.fetch(key, my_hashes_file.name, my_hashes_file):
+            return True
+
+    if values is None:
+        values = [str(x[token_value]) for x in read_tokens(my_tokenized_file)]
+    # truncated files aren't cached so that the truncation is reported again on the next run
+    if not hash_all.hash_values(lichen_config, lichen_run_config, winnowing_window, values,
+                                my_hashes_file) and key is not None:
+        cache.store(key, my_hashes_file.name, my_hashes_file)
+    return False
+
+
+def main():
+    start_time = datetime.datetime.now()
+    args = parse_args()
+    metrics = StageMetrics("stream_all")
+
+    print("TOKENIZE AND HASH ALL:", flush=True)
+    print("[0%                      25%                     50%                     75%                     100%]\n[", end="", flush=True)  # noqa: E501
+
+    with open(Path(args.basepath, "config.json")) as lichen_run_config_file:
+        lichen_run_config = json.load(lichen_run_config_file)
+
+    with open(Path(Path(__file__).resolve().parent, "lichen_config.json")) as lichen_config_file:
+        lichen_config = json.load(lichen_config_file)
+
+    if lichen_config.get("hash_algorithm", "md5") not in hash_all.HASH_ALGORITHMS:
+        raise SystemExit(f"ERROR: Unknown hash algorithm {lichen_config['hash_algorithm']}")
+
+    users_dir = os.path.join(args.basepath, "users")
+    if not os.path.isdir(users_dir):
+        raise SystemExit("ERROR: Unable to find users directory")
+
+    other_gradeables_dir = os.path.join(args.basepath, "other_gradeables")
+    if not os.path.isdir(other_gradeables_dir):
+        raise SystemExit("ERROR: Unable to find other gradeables directory")
+
+    language_token_data, cli_args = tokenize_all.get_tokenizer_config(lichen_run_config)
+    token_value = hash_all.get_token_value(lichen_run_config)
+    winnowing_window = lichen_config.get("winnowing_window", 0)
+    keep_tokens = lichen_config.get("keep_tokens", True)
+
+    with metrics.phase("find submissions"):
+        submissions = tokenize_all.get_submissions(users_dir, other_gradeables_dir)
+
+    # the provided code is tokenized last, and never winnowed (see hash_all.py)
+    provided_code_concat = os.path.join(args.basepath, "provided_code", "submission.concatenated")
+    provided_code_tokenized = os.path.join(args.basepath, "provided_code", "tokens.json")
+    submissions.append((provided_code_concat, provided_code_tokenized))
+
+    if language_token_data.get("persistent_worker", False):
+        pool = tokenize_all.TokenizerPool(language_token_data, cli_args)
+    else:
+        pool = None
+    tokenize_func = partial(tokenize_all.tokenize, language_token_data, cli_args)
+
+    # the tokens and hashes are cached exactly as tokenize_all.py and hash_all.py cache them,
+    # so either pipeline can reuse them
+    cache = ArtifactCache(Path(args.basepath, "cache"),
+                          lichen_config.get("cache_max_total_bytes", 0))
+    settings_key = tokenize_all.get_settings_key(cache, lichen_run_config, language_token_data,
+                                                 cli_args, pool is not None)
+    hash_settings_key = hash_all.get_settings_key(cache, lichen_config, lichen_run_config)
+
+    submissions_done = 0
+    submissions_cached = 0
+    hashes_cached = 0
+    percent_progress = 0
+
+    # the tokens of other gradeables which are indexed on this run are kept until they are
+    # archived with the index (see common/fingerprint_index.py)
+    manifest = read_manifest(args.basepath)
+    indexed_dirs = [Path(other_gradeables_dir, name) for name, entry in manifest.items()
+                    if not entry["attached"]]
+
+    # the tokenizers run ahead on the pool's threads while each submission is hashed here
+    keep = [keep_tokens or any(Path(concatenated).is_relative_to(d) for d in indexed_dirs)
+            for concatenated, _tokenized in submissions]
+    jobs = [(cache, settings_key, pool, tokenize_func, token_value, keep_submission,
+             concatenated, tokenized)
+            for (concatenated, tokenized), keep_submission in zip(submissions, keep)]
+    metrics.start_phase("tokenize and hash")
+    try:
+        for (concatenated, tokenized), keep_submission, \
+                (tokenize_seconds, (stderr, cached, values)) in \
+                zip(submissions, keep,
+                    run_in_order(partial(timed, tokenize_submission), jobs,
+                                 tokenize_all.get_worker_count(args, lichen_config))):
+            if stderr is not None and not stderr.isspace() and stderr != '':
+                print(stderr)
+
+            my_hashes_file = Path(Path(concatenated).parent, hashes_file_name(lichen_config))
+            hash_seconds, hashed_from_cache = timed(
+                hash_submission, cache, hash_settings_key, lichen_config, lichen_run_config,
+                token_value, 0 if concatenated == provided_code_concat else winnowing_window,
+                values, Path(tokenized), my_hashes_file)
+            counts = dict() if values is None else {"tokens": len(values)}
+            hash_all.add_submission_metrics(metrics, args.basepath,
+                                            tokenize_seconds + hash_seconds, concatenated,
+                                            my_hashes_file, cached=cached,
+                                            hashes_cached=hashed_from_cache,
+                                            tokenize_seconds=tokenize_seconds,
+                                            hash_seconds=hash_seconds,
+                                            bytes_written=file_size(my_hashes_file)
+                                            + file_size(tokenized), **counts)
+            if not keep_submission and os.path.exists(tokenized):
+                os.remove(tokenized)
+
+            submissions_done += 1
+            submissions_cached += cached
+            hashes_cached += hashed_from_cache
+            if int((submissions_done / len(jobs)) * 100) > percent_progress:
+                new_percent_progress = int((submissions_done / len(jobs)) * 100)
+                print("|" * (new_percent_progress - percent_progress), end="", flush=True)
+                percent_progress = new_percent_progress
+    finally:
+        if pool is not None:
+            pool.close()
+    metrics.end_phase("tokenize and hash")
+
+    with metrics.phase("evict cache"):
+        cache.evict()
+
+    # ==========================================================================
+    # index the other gradeables which were hashed, so that later runs can skip them
+    with metrics.phase("index other gradeables"):
+        for other_gradeable, entry in sorted(manifest.items()):
+            if not entry["attached"]:
+                index_gradeable(index_dir(args.basepath, lichen_config), entry["key"],
+                                Path(other_gradeables_dir, other_gradeable))
+        if not keep_tokens:
+            for _concatenated, tokenized in submissions:
+                if os.path.exists(tokenized):
+                    os.remove(tokenized)
+    metrics.set("submissions_cached", submissions_cached)
+    metrics.set("hashes_cached", hashes_cached)
+    metrics.write(args.basepath)
+
+    # ==========================================================================
+    print("]\nTokenization and hashing done in", humanize.precisedelta(start_time, format="%1.f"))
+    if cache.enabled():
+        print(f"Reused cached tokens for {submissions_cached} and cached hashes for "
+              f"{hashes_cached} of {len(jobs)} submissions")
+
+
+if __name__ == "__main__":
+    main()
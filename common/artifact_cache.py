@@ -0,0 +1,95 @@
+"""
+A content-addressed cache of the artifacts produced while running Lichen, so
+that rerunning a gradeable only tokenizes and hashes submissions which changed.
+
+Artifacts are stored as <cache_dir>/<first two characters of key>/<key>.<name>,
+where the key is a digest of everything the artifact was computed from.  The
+modification time of each cached file is updated whenever it is used, and the
+least recently used files are evicted once the cache grows past its size limit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+
+# returns the sha256 digest of the contents of the file at path
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir, max_total_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_total_bytes = max_total_bytes
+
+    # a cache with no space is disabled: nothing is fetched from or stored in it
+    def enabled(self):
+        return self.max_total_bytes > 0
+
+    # returns a cache key for the given JSON serializable parts
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key, name):
+        return Path(self.cache_dir, key[:2], f"{key}.{name}")
+
+    # copies the artifact stored under key to destination, returning whether it was found
+    def fetch(self, key, name, destination):
+        if not self.enabled():
+            return False
+
+        cached_path = self.path(key, name)
+        try:
+            shutil.copyfile(cached_path, destination)
+            os.utime(cached_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    # stores a copy of the file at source under key.  The copy is made under a temporary name
+    # and then renamed so that a partially written artifact is never fetched.
+    def store(self, key, name, source):
+        if not self.enabled():
+            return
+
+        cached_path = self.path(key, name)
+        os.makedirs(cached_path.parent, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=cached_path.parent, prefix=".tmp.")
+        os.close(handle)
+        try:
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, cached_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    # removes the least recently used artifacts until the cache fits in max_total_bytes
+    def evict(self):
+        if not self.cache_dir.is_dir():
+            return
+
+        artifacts = []
+        total_bytes = 0
+        for entry_dir in os.scandir(self.cache_dir):
+            if not entry_dir.is_dir():
+                continue
+            for entry in os.scandir(entry_dir.path):
+                stat = entry.stat()
+                artifacts.append((stat.st_mtime, entry.path, stat.st_size))
+                total_bytes += stat.st_size
+
+        artifacts.sort()
+        for _mtime, path, size in artifacts:
+            if total_bytes <= self.max_total_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
@@ -0,0 +1,475 @@
+"""
+Prebuilt fingerprint indexes for other gradeables, so that comparing against a
+past term doesn't require tokenizing and hashing it again on every run.
+
+Indexes are kept in <basepath>/fingerprint_indexes, unless fingerprint_index_dir
+is set in lichen_config.json, in which case they are shared by every run on the
+server from that directory (which install_lichen.sh creates).  Each is named by
+a key made of two digests: one of the other gradeable's identity (its term,
+course and gradeable, or its path) along with every setting and source file
+which affects its hashes, and one of the size and modification time of every
+file in its submission directories, so that finding whether it changed doesn't
+require reading any of them.
+
+concatenate_all.py writes <basepath>/fingerprint_indexes/manifest.json, which maps
+the name of each other gradeable in this run to its key, and whether its index
+already existed when the run started ("attached").  The submissions of an attached
+gradeable aren't concatenated, tokenized or hashed, and compare_hashes reads the
+index instead of their hashes files.  Only the submissions which match one of this
+gradeable's are concatenated, once the run is done, and their tokens.json files are
+written from <key>.tokens.zip, an archive of the tokens kept with the index, so
+that the matches can be viewed.
+Runs attach indexes in a shared directory, and remove out of date ones, while
+holding a lock on it, and an index which another run may still be reading is
+kept until no run has attached it for a day.
+
+An index is a compressed sparse row inverted index which compare_hashes
+memory maps as is, along with the hashes of each submission in order, so that
+the submissions which the MinHash prefilter keeps can be read on their own.  It
+is made up of a 32 byte header:
+    magic            4 bytes  b"LIDX"
+    version          uint16   currently 2
+    reserved         uint16   0
+    submissions      uint32   number of submissions in the gradeable
+    keys             uint32   number of distinct hashes
+    postings         uint32   number of hashes in all of the submissions
+    names size       uint32   size of the names table in bytes
+    reserved         uint64   0
+followed by these little-endian arrays:
+    keys             uint32[keys]         the distinct hashes, sorted
+    offsets          uint32[keys + 1]     the postings of keys[i] are offsets[i] to offsets[i+1]
+    postings         (uint32, int32)[postings]
+                                          the submission and location of each hash, ordered
+                                          by submission and then location for each key
+    submission offsets
+                     uint32[submissions + 1]
+                                          the hashes of submission i are forward[offsets[i]]
+                                          to forward[offsets[i+1]]
+    forward          (uint32, int32)[postings]
+                                          the hash and location of each hash of each
+                                          submission, ordered by submission and location
+    names table      JSON [[user, version], ...] naming each submission
+
+<key>.sketch holds the MinHash sketch of each submission (see common/minhash.py),
+so that the prefilter doesn't need to read the index:
+    magic            4 bytes  b"LSKT"
+    version          uint16   currently 1
+    reserved         uint16   0
+    submissions      uint32   number of submissions in the gradeable
+    entries          uint32   number of fingerprints in all of the sketches
+    offsets          uint32[submissions + 1]
+    fingerprints     uint32[entries]      the sketch of each submission, ordered by rank
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import numpy as np
+
+from common import minhash
+from common.artifact_cache import ArtifactCache, file_digest
+from common.hash_file import find_hashes_file, read_fingerprints
+
+INDEX_DIR_NAME = "fingerprint_indexes"
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".lock"
+# the files kept for each index: the index, the sketches and tokens of its submissions, and
+# the last time a run attached it
+INDEX_SUFFIXES = [".idx", ".sketch", ".tokens.zip", ".used"]
+# an index in a shared directory which no run has used for this long may be removed
+STALE_INDEX_SECONDS = 24 * 60 * 60
+
+MAGIC = b"LIDX"
+VERSION = 2
+HEADER = struct.Struct("<4sHHIIIIQ")
+POSTING_DTYPE = np.dtype([("submission", "<u4"), ("location", "<i4")])
+FORWARD_DTYPE = np.dtype([("hash", "<u4"), ("location", "<i4")])
+
+SKETCH_MAGIC = b"LSKT"
+SKETCH_VERSION = 1
+SKETCH_HEADER = struct.Struct("<4sHHII")
+# the number of fingerprints kept in the sketch of each indexed submission, which is more than
+# the prefilter uses so that enough are left once provided and common code is left out
+INDEX_SKETCH_SIZE = 512
+
+LICHEN_DIR = Path(__file__).resolve().parent.parent
+
+
+# returns the directory the fingerprint indexes are kept in
+def index_dir(basepath, lichen_config):
+    shared_dir = lichen_config.get("fingerprint_index_dir", "")
+    return Path(shared_dir) if shared_dir != "" else Path(basepath, INDEX_DIR_NAME)
+
+
+def index_path(directory, key):
+    return Path(directory, f"{key}.idx")
+
+
+def sketches_path(directory, key):
+    return Path(directory, f"{key}.sketch")
+
+
+def tokens_path(directory, key):
+    return Path(directory, f"{key}.tokens.zip")
+
+
+def manifest_path(basepath):
+    return Path(basepath, INDEX_DIR_NAME, MANIFEST_NAME)
+
+
+# returns a digest of the settings in config.json and lichen_config.json, and of the source
+# files, which determine the hashes produced from a concatenated submission
+def settings_digest(config, lichen_config):
+    with open(Path(LICHEN_DIR, "tokenizer", "tokenizer_config.json")) as token_data_file:
+        tokenizer = json.load(token_data_file)[config["language"]]["tokenizer"]
+
+    sources = [Path("tokenizer", "tokenizer_config.json"),
+               Path("tokenizer", tokenizer),
+               Path("tokenizer", "tokenizer_worker.py"),
+               Path("common", "token_stream.py"),
+               Path("hasher", "hash_all.py"),
+               Path("common", "fingerprint_index.py"),
+               Path("common", "minhash.py")]
+    return ArtifactCache.key(config["language"], config.get("arguments"),
+                             config.get("hash_size"),
+                             lichen_config.get("hash_algorithm", "md5"),
+                             lichen_config["max_sequences_per_file"],
+                             lichen_config.get("winnowing_window", 0),
+                             [file_digest(Path(LICHEN_DIR, source)) for source in sources])
+
+
+# yields the user, version and directory of each submission in an other gradeable's
+# directory, sorted by user and version
+def find_submissions(gradeable_dir):
+    # a gradeable without any submissions doesn't have a directory
+    if not Path(gradeable_dir).is_dir():
+        return
+    for user in sorted(os.listdir(gradeable_dir)):
+        user_dir = Path(gradeable_dir, user)
+        if not user_dir.is_dir():
+            continue
+        for version in sorted(os.listdir(user_dir), key=int):
+            if Path(user_dir, version).is_dir():
+                yield user, int(version), Path(user_dir, version)
+
+
+# returns the relative path, size and modification time of every file in each of input_dirs,
+# which changes whenever a submission is added, removed or modified
+def tree_fingerprint(input_dirs):
+    files = []
+    for i, input_dir in enumerate(input_dirs):
+        for root, _dirs, names in os.walk(input_dir):
+            for name in names:
+                stat = os.stat(os.path.join(root, name))
+                files.append([i, os.path.relpath(os.path.join(root, name), input_dir),
+                              stat.st_size, stat.st_mtime_ns])
+    return sorted(files)
+
+
+# returns the key of the index for an other gradeable, given the identity of the gradeable
+# and the directories its submissions are concatenated from.  The part before the "-" only
+# depends on the gradeable and the settings, and the part after it on its files.
+def gradeable_key(settings, config, identity, input_dirs):
+    source = ArtifactCache.key(settings, identity, config["regex"], config["regex_dirs"],
+                               config["version"], config["ignore_submissions"])
+    return f"{source}-{ArtifactCache.key(tree_fingerprint(input_dirs))}"
+
+
+def read_manifest(basepath):
+    try:
+        with open(manifest_path(basepath)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return dict()
+
+
+# returns the key of every index in directory, mapped to the paths of its files
+def find_indexes(directory):
+    indexes = dict()
+    for entry in os.scandir(directory):
+        for suffix in INDEX_SUFFIXES:
+            if entry.name.endswith(suffix) and not entry.name.startswith("."):
+                indexes.setdefault(entry.name[:-len(suffix)], []).append(entry.path)
+    return indexes
+
+
+# returns the last time the index with the given key in directory was built or attached
+def last_used(directory, key):
+    times = []
+    for suffix in [".idx", ".used"]:
+        try:
+            times.append(os.stat(Path(directory, f"{key}{suffix}")).st_mtime)
+        except FileNotFoundError:
+            pass
+    return max(times, default=0)
+
+
+# marks the index with the given key in directory as used by this run, returning whether it
+# exists.  Indexes are written by the container, so this run may not be able to change them;
+# the time is kept in a separate file instead.
+def attach(directory, key):
+    if not index_path(directory, key).exists():
+        return False
+    Path(directory, f"{key}.used").touch()
+    return True
+
+
+# holds an exclusive lock on the shared directory of indexes, so that indexes aren't removed
+# while another run is attaching them
+@contextmanager
+def locked(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(Path(directory, LOCK_NAME), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+# removes the indexes in directory which manifest doesn't use.  In a shared directory, only
+# the out of date indexes of the same gradeables and settings are removed, and only once no
+# run has built or attached them for STALE_INDEX_SECONDS, since other runs which attached
+# them may still be reading them.
+def remove_unused_indexes(directory, manifest, shared):
+    used = {entry["key"] for entry in manifest.values()}
+    sources = {entry["key"].split("-")[0] for entry in manifest.values()}
+    for key, paths in find_indexes(directory).items():
+        if key in used:
+            continue
+        if shared and (key.split("-")[0] not in sources or
+                       time.time() - last_used(directory, key) < STALE_INDEX_SECONDS):
+            continue
+        for path in paths:
+            # another run may have removed it already
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# finds the index for each of the other gradeables in this run if indexing is enabled, and
+# writes the manifest listing them.  other_gradeables maps the name of each of them to its
+# identity and the list of directories its submissions are concatenated from.  Unused indexes
+# are removed (see remove_unused_indexes).  Returns the manifest.
+def update_manifest(basepath, config, lichen_config, other_gradeables):
+    directory = index_dir(basepath, lichen_config)
+    shared = directory != manifest_path(basepath).parent
+    keys = dict()
+    if lichen_config.get("index_other_gradeables", False):
+        settings = settings_digest(config, lichen_config)
+        for name, (identity, input_dirs) in sorted(other_gradeables.items()):
+            keys[name] = gradeable_key(settings, config, identity, input_dirs)
+
+    if len(keys) == 0 and not manifest_path(basepath).parent.exists():
+        return dict()
+    os.makedirs(manifest_path(basepath).parent, exist_ok=True)
+
+    manifest = dict()
+    with locked(directory) if shared else nullcontext():
+        for name, key in keys.items():
+            manifest[name] = {"key": key, "attached": attach(directory, key)}
+        if directory.exists():
+            remove_unused_indexes(directory, manifest, shared)
+
+    with open(manifest_path(basepath), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    return manifest
+
+
+# writes the index with the given key in directory for the hashed submissions in
+# gradeable_dir, along with the archive of their tokens and their sketches.  The index is
+# written last, so that an index is only found once everything kept with it is there.
+def index_gradeable(directory, key, gradeable_dir):
+    archive_tokens(tokens_path(directory, key), gradeable_dir)
+    submissions = []
+    for user, version, version_dir in find_submissions(gradeable_dir):
+        hashes, locations, _sequences = read_fingerprints(find_hashes_file(version_dir))
+        submissions.append((user, version, hashes, locations))
+    write_sketches(sketches_path(directory, key),
+                   [minhash.ranked_sketch(hashes, INDEX_SKETCH_SIZE)
+                    for _user, _version, hashes, _locations in submissions])
+    write_index(index_path(directory, key), submissions)
+
+
+# writes the tokens.json of each submission in gradeable_dir to a zip archive at path, as
+# <user>/<version>/tokens.json, so that the tokens of the submissions of an attached gradeable
+# which match can be written out without tokenizing them again
+def archive_tokens(path, gradeable_dir):
+    os.makedirs(Path(path).parent, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=Path(path).parent, prefix=".tmp.")
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for user, version, version_dir in find_submissions(gradeable_dir):
+                if Path(version_dir, "tokens.json").exists():
+                    archive.write(Path(version_dir, "tokens.json"), f"{user}/{version}/tokens.json")
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# writes the tokens.json of each of submissions, a list of (user, version, output directory)
+# tuples, from the archive at path.  Returns the number of them which were archived.
+def extract_tokens(path, submissions):
+    extracted = 0
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        for user, version, output_dir in submissions:
+            name = f"{user}/{version}/tokens.json"
+            if name not in names:
+                continue
+            os.makedirs(output_dir, exist_ok=True)
+            with archive.open(name) as source, open(Path(output_dir, "tokens.json"), "wb") as file:
+                shutil.copyfileobj(source, file)
+            extracted += 1
+    return extracted
+
+
+# writes an index of submissions, a list of (user, version, hashes, locations) tuples sorted
+# by user and version, to path
+def write_index(path, submissions):
+    hashes = [np.asarray(submission_hashes, dtype="<u4")
+              for _user, _version, submission_hashes, _locations in submissions]
+    postings = np.empty(sum(len(h) for h in hashes), dtype=POSTING_DTYPE)
+    forward = np.empty(len(postings), dtype=FORWARD_DTYPE)
+    position = 0
+    for submission, (_user, _version, submission_hashes, locations) in enumerate(submissions):
+        postings["submission"][position:position + len(submission_hashes)] = submission
+        postings["location"][position:position + len(submission_hashes)] = locations
+        forward["hash"][position:position + len(submission_hashes)] = submission_hashes
+        forward["location"][position:position + len(submission_hashes)] = locations
+        position += len(submission_hashes)
+    submission_offsets = np.cumsum([0] + [len(h) for h in hashes]).astype("<u4")
+    hashes = np.concatenate(hashes) if len(hashes) > 0 else np.empty(0, dtype="<u4")
+
+    # postings were added in (submission, location) order, which a stable sort keeps
+    order = np.argsort(hashes, kind="stable")
+    hashes = hashes[order]
+    postings = postings[order]
+    keys, offsets = np.unique(hashes, return_index=True)
+    offsets = np.append(offsets, len(hashes)).astype("<u4")
+
+    names = json.dumps([[user, int(version)] for user, version, _hashes, _locations
+                        in submissions]).encode()
+    header = HEADER.pack(MAGIC, VERSION, 0, len(submissions), len(keys), len(hashes),
+                         len(names), 0)
+    write_atomically(path, [header, keys.astype("<u4"), offsets, postings, submission_offsets,
+                            forward, names])
+
+
+# writes each of parts, which are bytes or little-endian arrays, to path.  The file is written
+# under a temporary name and then renamed, so that a partially written file is never used.
+def write_atomically(path, parts):
+    os.makedirs(Path(path).parent, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=Path(path).parent, prefix=".tmp.")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            for part in parts:
+                if isinstance(part, np.ndarray):
+                    if sys.byteorder != "little":
+                        part = part.byteswap()
+                    part = part.tobytes()
+                file.write(part)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# reads the header of the index open as file, returning the number of submissions, keys and
+# postings, the size of the names table, and the offset of each section from the start of the
+# file
+def read_header(file, path):
+    magic, version, _reserved, submissions, num_keys, num_postings, names_size, _ = \
+        HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} fingerprint index")
+    sections = dict()
+    position = HEADER.size
+    for section, size in [("keys", 4 * num_keys), ("offsets", 4 * (num_keys + 1)),
+                          ("postings", POSTING_DTYPE.itemsize * num_postings),
+                          ("submission offsets", 4 * (submissions + 1)),
+                          ("forward", FORWARD_DTYPE.itemsize * num_postings)]:
+        sections[section] = position
+        position += size
+    sections["names"] = position
+    return submissions, num_keys, num_postings, names_size, sections
+
+
+# returns the names table of the index at path
+def read_index_names(path):
+    with open(path, "rb") as file:
+        _submissions, _num_keys, _num_postings, names_size, sections = read_header(file, path)
+        file.seek(sections["names"])
+        return json.loads(file.read(names_size))
+
+
+# returns the names table of the index at path, along with an array of the hashes of each of
+# its submissions, or of the submissions at positions in the names table if it is given.
+# Only the hashes of those submissions are read.
+def read_index_submissions(path, positions=None):
+    with open(path, "rb") as file:
+        submissions, _num_keys, _num_postings, names_size, sections = read_header(file, path)
+        file.seek(sections["submission offsets"])
+        submission_offsets = np.frombuffer(file.read(4 * (submissions + 1)), dtype="<u4")
+        hashes = []
+        for i in range(submissions) if positions is None else positions:
+            file.seek(sections["forward"] + FORWARD_DTYPE.itemsize * int(submission_offsets[i]))
+            forward = np.frombuffer(file.read(FORWARD_DTYPE.itemsize *
+                                              int(submission_offsets[i + 1] -
+                                                  submission_offsets[i])), dtype=FORWARD_DTYPE)
+            hashes.append(forward["hash"].copy())
+        file.seek(sections["names"])
+        names = json.loads(file.read(names_size))
+    return names, hashes
+
+
+# returns the names table of the index at path, along with a dict mapping each hash to its
+# list of (submission, location) postings
+def read_index(path):
+    with open(path, "rb") as file:
+        _submissions, num_keys, num_postings, names_size, sections = read_header(file, path)
+        keys = np.frombuffer(file.read(4 * num_keys), dtype="<u4")
+        offsets = np.frombuffer(file.read(4 * (num_keys + 1)), dtype="<u4")
+        postings = np.frombuffer(file.read(POSTING_DTYPE.itemsize * num_postings),
+                                 dtype=POSTING_DTYPE)
+        file.seek(sections["names"])
+        names = json.loads(file.read(names_size))
+
+    index = dict()
+    for i, key in enumerate(keys.tolist()):
+        index[key] = [(int(p["submission"]), int(p["location"]))
+                      for p in postings[offsets[i]:offsets[i + 1]]]
+    return names, index
+
+
+# writes the sketch of each submission, a list of arrays of fingerprints ordered by rank
+# (see minhash.ranked_sketch), to path
+def write_sketches(path, sketches):
+    offsets = np.cumsum([0] + [len(sketch) for sketch in sketches]).astype("<u4")
+    fingerprints = np.concatenate([np.empty(0, dtype="<u4")] +
+                                  [np.asarray(sketch, dtype="<u4") for sketch in sketches])
+    header = SKETCH_HEADER.pack(SKETCH_MAGIC, SKETCH_VERSION, 0, len(sketches),
+                                len(fingerprints))
+    write_atomically(path, [header, offsets, fingerprints])
+
+
+# returns the sketch of each submission stored at path, as arrays of fingerprints ordered by
+# rank
+def read_sketches(path):
+    with open(path, "rb") as file:
+        magic, version, _reserved, submissions, entries = \
+            SKETCH_HEADER.unpack(file.read(SKETCH_HEADER.size))
+        if magic != SKETCH_MAGIC or version != SKETCH_VERSION:
+            raise ValueError(f"{path} is not a version {SKETCH_VERSION} sketch file")
+        offsets = np.frombuffer(file.read(4 * (submissions + 1)), dtype="<u4")
+        fingerprints = np.frombuffer(file.read(4 * entries), dtype="<u4").astype(np.uint64)
+    return np.split(fingerprints, offsets[1:-1].astype(np.int64))
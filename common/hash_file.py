@@ -0,0 +1,172 @@
+"""
+Reads and writes the files holding the hash of every sequence of tokens in a
+submission.  Hashes are written in one of two formats:
+
+hashes.txt: one 8 character hex hash per line, which is easy to read while debugging
+hashes.bin: a fixed-width binary file which compare_hashes can memory map, made up of
+            a 16 byte header followed by a packed little-endian array of hashes
+
+The binary header holds, in order:
+    magic        4 bytes  b"LHSH"
+    version      uint16   currently 1
+    hash width   uint8    size of each hash in bytes (4 or 8)
+    flags        uint8    FLAG_LOCATIONS or 0
+    hash_size    uint32   number of tokens in each hashed sequence
+    sequences    uint32   number of sequences hashed if FLAG_LOCATIONS is set, otherwise 0
+
+Normally the hash of every sequence is kept, and the hash at index i is the hash of the
+sequence at location i + 1.  When only some of the hashes are kept (see winnowing in
+hash_all.py), the location of each hash is stored as well:
+
+hashes.txt: a "# sequences <count>" line, then "<hex hash> <location>" on each line
+hashes.bin: FLAG_LOCATIONS is set, and the hashes are followed by a uint32 array of locations
+"""
+
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+HEX_FILE_NAME = "hashes.txt"
+BINARY_FILE_NAME = "hashes.bin"
+
+MAGIC = b"LHSH"
+VERSION = 1
+HEADER = struct.Struct("<4sHBBII")
+ARRAY_TYPECODES = {4: "I", 8: "Q"}
+FLAG_LOCATIONS = 1
+
+
+# returns the name of the hashes file to write given the settings in lichen_config.json
+def hashes_file_name(lichen_config):
+    if lichen_config.get("hash_file_format", "hex") == "binary":
+        return BINARY_FILE_NAME
+    return HEX_FILE_NAME
+
+
+# returns the path of the hashes file in directory, preferring the binary format if both exist
+def find_hashes_file(directory):
+    binary_path = Path(directory, BINARY_FILE_NAME)
+    if binary_path.exists():
+        return binary_path
+    return Path(directory, HEX_FILE_NAME)
+
+
+def is_binary(path):
+    return Path(path).name.endswith(".bin")
+
+
+# writes a list of integer hashes to path, in the format implied by its file name.  If only
+# some of the sequences were kept, locations holds the location of each hash and sequences
+# the number of sequences which were hashed.
+def write_hashes(path, hashes, hash_size, hash_width=4, locations=None, sequences=0):
+    if not is_binary(path):
+        with open(path, "w") as file:
+            if locations is None:
+                file.write("\n".join(f"{h:0{hash_width * 2}x}" for h in hashes))
+            else:
+                file.write(f"# sequences {sequences}\n")
+                file.write("\n".join(f"{h:0{hash_width * 2}x} {location}"
+                                     for h, location in zip(hashes, locations)))
+        return
+
+    values = array(ARRAY_TYPECODES[hash_width], hashes)
+    flags = 0
+    if locations is not None:
+        flags = FLAG_LOCATIONS
+        location_values = array("I", locations)
+    else:
+        sequences = 0
+        location_values = array("I")
+    if sys.byteorder != "little":
+        values.byteswap()
+        location_values.byteswap()
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, hash_width, flags, hash_size, sequences))
+        file.write(values.tobytes())
+        file.write(location_values.tobytes())
+
+
+def read_header(file):
+    header = file.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise ValueError(f"{file.name} is too short to be a hashes file")
+    magic, version, hash_width, flags, hash_size, sequences = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or hash_width not in ARRAY_TYPECODES:
+        raise ValueError(f"{file.name} is not a version {VERSION} hashes file")
+    return hash_width, flags, hash_size, sequences
+
+
+# returns the list of integer hashes stored at path, the location of each of them, and the
+# number of sequences which were hashed
+def read_fingerprints(path):
+    if not is_binary(path):
+        hashes = []
+        locations = []
+        sequences = None
+        with open(path, "r") as file:
+            for line in file:
+                if line.startswith("# sequences "):
+                    sequences = int(line.split()[2])
+                elif line.strip() != "" and not line.startswith("#"):
+                    fields = line.split()
+                    hashes.append(int(fields[0], 16))
+                    if len(fields) > 1:
+                        locations.append(int(fields[1]))
+        if len(locations) == 0:
+            locations = list(range(1, len(hashes) + 1))
+        return hashes, locations, len(hashes) if sequences is None else sequences
+
+    with open(path, "rb") as file:
+        hash_width, flags, _hash_size, sequences = read_header(file)
+        data = file.read()
+    values = array(ARRAY_TYPECODES[hash_width])
+    location_values = array("I")
+    if flags & FLAG_LOCATIONS:
+        count = len(data) // (hash_width + location_values.itemsize)
+        values.frombytes(data[:count * hash_width])
+        location_values.frombytes(data[count * hash_width:])
+    else:
+        values.frombytes(data)
+        sequences = len(values)
+        location_values.extend(range(1, len(values) + 1))
+    if sys.byteorder != "little":
+        values.byteswap()
+        if flags & FLAG_LOCATIONS:
+            location_values.byteswap()
+    return values.tolist(), location_values.tolist(), sequences
+
+
+# returns the list of integer hashes stored at path
+def read_hashes(path):
+    return read_fingerprints(path)[0]
+
+
+# returns the number of hashes stored at path without reading them
+def count_hashes(path):
+    if not is_binary(path):
+        with open(path, "r") as file:
+            return len([0 for line in file if not line.startswith("#")])
+
+    with open(path, "rb") as file:
+        hash_width, flags, _hash_size, _sequences = read_header(file)
+    entry_size = hash_width + (4 if flags & FLAG_LOCATIONS else 0)
+    return (os.path.getsize(path) - HEADER.size) // entry_size
+
+
+# returns the number of sequences which were hashed to produce the file at path, which is more
+# than the number of hashes it holds if only some of them were kept
+def count_sequences(path):
+    if not is_binary(path):
+        with open(path, "r") as file:
+            first_line = file.readline()
+        if first_line.startswith("# sequences "):
+            return int(first_line.split()[2])
+        return count_hashes(path)
+
+    with open(path, "rb") as file:
+        _hash_width, flags, _hash_size, sequences = read_header(file)
+    if flags & FLAG_LOCATIONS:
+        return sequences
+    return count_hashes(path)
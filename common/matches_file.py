@@ -0,0 +1,132 @@
+"""
+Reads the files compare_hashes writes the matches of each submission to.  A file is a list
+of regions, each of which is a dict of start, end and type ("match", "common" or
+"provided"), and for regions of type "match", others: a list of the other submissions it
+matches, each with its username, version, source_gradeable and matchingpositions.  The
+regions are written in one of three formats, chosen by matches_file_format in
+lichen_config.json:
+
+matches.json:   "json", a compact JSON array of regions, which is what the UI reads
+matches.ndjson: "ndjson", one region per line as a JSON object
+matches.bin:    "binary", an 8 byte header followed by the packed little-endian regions
+
+The binary header holds, in order:
+    magic        4 bytes  b"LMAT"
+    version      uint16   currently 1
+    reserved     uint16   0
+
+Each region is then its type (uint8, one of REGION_TYPES), start (int32), end (int32) and
+number of other submissions (uint32).  Each of those is its username, version (int32),
+source_gradeable and number of matching positions (uint32), followed by the start and end
+(int32 each) of every matching position.  Strings are their length as a uint16 followed by
+their UTF-8 bytes.
+"""
+
+import json
+import struct
+from pathlib import Path
+
+JSON_FILE_NAME = "matches.json"
+NDJSON_FILE_NAME = "matches.ndjson"
+BINARY_FILE_NAME = "matches.bin"
+
+FILE_NAMES = {"json": JSON_FILE_NAME, "ndjson": NDJSON_FILE_NAME, "binary": BINARY_FILE_NAME}
+
+MAGIC = b"LMAT"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+REGION = struct.Struct("<BiiI")
+POSITION = struct.Struct("<ii")
+REGION_TYPES = ["match", "common", "provided"]
+
+
+# returns the name of the matches file compare_hashes writes given the settings in
+# lichen_config.json
+def matches_file_name(lichen_config):
+    return FILE_NAMES[lichen_config.get("matches_file_format", "json")]
+
+
+# returns the path of the matches file in directory, or None if it doesn't have one
+def find_matches_file(directory):
+    for name in (BINARY_FILE_NAME, NDJSON_FILE_NAME, JSON_FILE_NAME):
+        path = Path(directory, name)
+        if path.exists():
+            return path
+    return None
+
+
+class _BinaryReader:
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+        self.offset = 0
+
+    def at_end(self):
+        return self.offset == len(self.data)
+
+    def unpack(self, layout):
+        if self.offset + layout.size > len(self.data):
+            raise ValueError(f"{self.name} ends in the middle of a region")
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def string(self):
+        length, = self.unpack(struct.Struct("<H"))
+        value = self.data[self.offset:self.offset + length].decode("utf-8")
+        self.offset += length
+        return value
+
+
+def _read_binary_regions(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is too short to be a matches file")
+    magic, version, _reserved = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} matches file")
+
+    reader = _BinaryReader(data, path)
+    reader.offset = HEADER.size
+    int_field = struct.Struct("<i")
+    count_field = struct.Struct("<I")
+    while not reader.at_end():
+        region_type, start, end, other_count = reader.unpack(REGION)
+        region = {"start": start, "end": end, "type": REGION_TYPES[region_type]}
+        if region_type == 0:
+            others = []
+            for _ in range(other_count):
+                username = reader.string()
+                version, = reader.unpack(int_field)
+                source_gradeable = reader.string()
+                position_count, = reader.unpack(count_field)
+                positions = []
+                for _ in range(position_count):
+                    position_start, position_end = reader.unpack(POSITION)
+                    positions.append({"start": position_start, "end": position_end})
+                others.append({"username": username, "version": version,
+                               "source_gradeable": source_gradeable,
+                               "matchingpositions": positions})
+            region["others"] = others
+        yield region
+
+
+# yields the regions stored at path one at a time, in the format implied by its file name
+def read_regions(path):
+    name = Path(path).name
+    if name == BINARY_FILE_NAME:
+        yield from _read_binary_regions(path)
+    elif name == NDJSON_FILE_NAME:
+        with open(path, "r") as file:
+            for line in file:
+                if line.strip() != "":
+                    yield json.loads(line)
+    else:
+        with open(path, "r") as file:
+            yield from json.load(file)
+
+
+# returns the list of regions stored at path
+def read_matches(path):
+    return list(read_regions(path))
@@ -0,0 +1,125 @@
+"""
+Records where each stage of Lichen spends its time, so that runs which take far
+longer than expected can be traced to a configuration or a submission.
+
+Each stage writes logs/metrics/<stage>.json, which holds:
+    wall_seconds, cpu_seconds     for the whole stage, including its child processes
+    peak_rss_bytes                the largest resident set of the stage or any one child
+    io                            bytes read and written by the stage's own process,
+                                  from /proc/self/io (null where it isn't available)
+    phases                        the wall and CPU time of each phase of the stage
+    submissions                   counts and timings for each submission, by its directory
+                                  relative to the gradeable's directory
+    slowest_submissions           the submissions which took the longest, slowest first
+along with any values specific to the stage.  compare_hashes writes the same layout.
+"""
+
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+METRICS_DIR_NAME = Path("logs", "metrics")
+SLOWEST_SUBMISSIONS = 10
+
+
+# returns the CPU time used so far by this process and its child processes which have exited
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+# returns the largest resident set size of this process or any child process which has exited
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+# returns the bytes read and written by this process so far, both through any system call
+# and from storage, or None if they can't be found
+def io_counters():
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = dict(line.split(":") for line in io_file)
+    except OSError:
+        return None
+    return {"bytes_read": int(counters["rchar"]),
+            "bytes_written": int(counters["wchar"]),
+            "storage_bytes_read": int(counters["read_bytes"]),
+            "storage_bytes_written": int(counters["write_bytes"])}
+
+
+# returns the size of the file at path, or 0 if it doesn't exist
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# calls func with args, returning the number of seconds it took along with its result.  This
+# lets the time spent on each job be measured on the thread which runs it.
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+class StageMetrics:
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.phases = dict()
+        self.submissions = dict()
+        self.values = dict()
+
+    # measures the wall and CPU time of everything between start_phase and end_phase
+    def start_phase(self, name):
+        self.phases[name] = {"wall_seconds": time.perf_counter(), "cpu_seconds": cpu_seconds()}
+
+    def end_phase(self, name):
+        self.phases[name] = {
+            "wall_seconds": time.perf_counter() - self.phases[name]["wall_seconds"],
+            "cpu_seconds": cpu_seconds() - self.phases[name]["cpu_seconds"]}
+
+    # measures the wall and CPU time of the code run in a with block
+    @contextmanager
+    def phase(self, name):
+        self.start_phase(name)
+        try:
+            yield
+        finally:
+            self.end_phase(name)
+
+    # records the number of seconds spent on a submission, along with any counts for it
+    def add_submission(self, name, seconds, **counts):
+        self.submissions[str(name)] = dict(counts, seconds=seconds)
+
+    # records a value which is specific to this stage
+    def set(self, name, value):
+        self.values[name] = value
+
+    # writes the metrics to logs/metrics/<stage>.json under basepath
+    def write(self, basepath):
+        slowest = sorted(self.submissions.items(), key=lambda item: item[1]["seconds"],
+                         reverse=True)[:SLOWEST_SUBMISSIONS]
+        metrics = dict(self.values,
+                       stage=self.stage,
+                       wall_seconds=time.perf_counter() - self.start_wall,
+                       cpu_seconds=cpu_seconds() - self.start_cpu,
+                       peak_rss_bytes=peak_rss_bytes(),
+                       io=io_counters(),
+                       phases=self.phases,
+                       submissions=self.submissions,
+                       slowest_submissions=[[name, submission["seconds"]]
+                                            for name, submission in slowest])
+
+        metrics_dir = Path(basepath, METRICS_DIR_NAME)
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(Path(metrics_dir, f"{self.stage}.json"), "w") as metrics_file:
+            json.dump(metrics, metrics_file, indent=4, sort_keys=True)
@@ -0,0 +1,111 @@
+"""
+MinHash sketches of the fingerprints of submissions, which find the submissions
+of other gradeables that are likely to hold code copied into, or from, this
+gradeable's submissions without comparing all of their fingerprints.
+
+Copied code is usually only part of a submission, so a submission of another gradeable is
+measured by its containment in a submission of this gradeable: the fraction of its distinct
+fingerprints which that submission also has.  The sketch of a submission is a random sample
+of its fingerprints, the size it has with the lowest values of a hash function over them (a
+bottom-k MinHash), so the number of them found in a submission with containment c is drawn
+from Binomial(size, c).  The sampled fingerprints are the bands of a locality sensitive hash
+table which the fingerprints of this gradeable's submissions are looked up in, and a
+submission is a candidate if enough of its sample are found in any one of them.  That number
+is the most which keeps submissions with a given containment with at least a target
+probability, which is the recall of the filter.
+"""
+
+import math
+
+import numpy as np
+
+
+# the finalizer of splitmix64, which mixes every bit of x into every bit of the result
+def _mix(x):
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+# returns the distinct fingerprints in hashes, of which only the low 32 bits are used
+def fingerprint_set(hashes):
+    return np.unique(np.asarray(hashes, dtype=np.uint64) & np.uint64(0xffffffff))
+
+
+# returns the probability that at least hits of a sample of samples fingerprints of a
+# submission with the given containment are found
+def recall(containment, samples, hits):
+    return sum(math.comb(samples, i) * containment ** i * (1 - containment) ** (samples - i)
+               for i in range(hits, samples + 1))
+
+
+# returns the number of a sample of samples fingerprints which must be found for a submission
+# to be a candidate: the most which keeps submissions with the given containment with
+# probability at least target_recall, and at least one
+def min_hits(samples, containment, target_recall):
+    tail = 0
+    for hits in range(samples, 1, -1):
+        tail += math.comb(samples, hits) * containment ** hits * \
+            (1 - containment) ** (samples - hits)
+        if tail >= target_recall:
+            return hits
+    return 1
+
+
+# returns the sketch of a submission's fingerprints ordered by rank, lowest first: the size of
+# them with the lowest hashes, or all of them if it has fewer.  Any prefix of it, once
+# fingerprints are left out of it, is the sketch of that size of the fingerprints left.
+def ranked_sketch(hashes, size, seed=0):
+    fingerprints = fingerprint_set(hashes)
+    ranks = _mix(fingerprints ^ _mix(np.array([seed + 1], dtype=np.uint64)))
+    if len(fingerprints) > size:
+        lowest = np.argpartition(ranks, size - 1)[:size]
+        fingerprints, ranks = fingerprints[lowest], ranks[lowest]
+    return fingerprints[np.argsort(ranks, kind="stable")]
+
+
+# returns the sketch of a submission's fingerprints: the size of them with the lowest hashes,
+# or all of them if it has fewer
+def sketch(hashes, size, seed=0):
+    return np.sort(ranked_sketch(hashes, size, seed))
+
+
+# returns, for each array of distinct fingerprints in queries, the most of them found in any
+# one of the arrays of distinct fingerprints in these_sets.  Each fingerprint of queries is a
+# band of one row: containment can't be found by bands of several fingerprints which must all
+# be equal, as copied code only holds some of them.  The bands are put in a table, which every
+# fingerprint of these_sets is looked up in, so that each query is found through the bands it
+# shares with each of these_sets rather than by comparing it with all of them.
+def max_found(queries, these_sets):
+    result = np.zeros(len(queries), dtype=np.int64)
+    if len(queries) == 0 or len(these_sets) == 0:
+        return result
+    bands = np.concatenate(queries)
+    band_owners = np.repeat(np.arange(len(queries), dtype=np.int64), [len(q) for q in queries])
+    order = np.argsort(bands, kind="stable")
+    bands, band_owners = bands[order], band_owners[order]
+
+    these = np.concatenate(these_sets)
+    owners = np.repeat(np.arange(len(these_sets), dtype=np.int64), [len(s) for s in these_sets])
+    starts = np.searchsorted(bands, these, side="left")
+    counts = np.searchsorted(bands, these, side="right") - starts
+
+    # every (query, submission of this gradeable) pair, once for each band they share
+    found = np.repeat(np.arange(len(these)), counts)
+    offsets = np.arange(len(found)) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairs = band_owners[starts[found] + offsets] * len(these_sets) + owners[found]
+    pairs, pair_counts = np.unique(pairs, return_counts=True)
+    np.maximum.at(result, pairs // len(these_sets), pair_counts)
+    return result
+
+
+# returns a boolean array which is true for each of the sketches in other_sketches with enough
+# of its fingerprints found in one of these_sets to be a candidate.  Submissions without
+# fingerprints are never candidates.
+def candidates(other_sketches, these_sets, containment, target_recall):
+    sizes = np.array([len(s) for s in other_sketches], dtype=np.int64)
+    thresholds = np.array([min_hits(size, containment, target_recall)
+                           for size in range(sizes.max() + 1 if len(sizes) > 0 else 1)])
+    return (sizes > 0) & (max_found(other_sketches, these_sets) >= thresholds[sizes])
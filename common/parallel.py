@@ -0,0 +1,26 @@
+"""
+Helpers for running the stages of Lichen on several threads at once.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# calls func on each set of arguments in jobs using a pool of worker threads, yielding the
+# results in the same order as jobs.  This suits jobs which spend most of their time waiting,
+# on a subprocess or on the filesystem.  At most twice as many jobs as workers are queued at
+# once so that memory use stays bounded on large courses.
+def run_in_order(func, jobs, workers):
+    if workers <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(func, *job))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
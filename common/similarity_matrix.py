@@ -0,0 +1,200 @@
+"""
+The number of fingerprints every pair of submissions in a gradeable shares,
+stored as a sparse matrix so that the most similar submissions to any one
+submission can be looked up without reading every matches file.
+
+Two submissions share a fingerprint if both of their hashes files hold it.  Provided and
+common code are left out, as they are by compare_hashes, along with any hash which more
+than threshold students share, and pairs of submissions by the same student aren't
+counted.  From the number of fingerprints shared by submissions a and b and the number
+of distinct fingerprints in each of them:
+    containment of a in b = shared / fingerprints[a]
+    Jaccard similarity    = shared / (fingerprints[a] + fingerprints[b] - shared)
+
+The matrix is written to <basepath>/similarity_matrix.bin, in compressed sparse row
+form, with a row for every submission.  It is made up of a 32 byte header:
+    magic            4 bytes  b"LSIM"
+    version          uint16   currently 1
+    reserved         uint16   0
+    submissions      uint32   number of submissions, and of rows
+    names size       uint32   size of the names table in bytes
+    entries          uint64   number of stored entries, two for every pair
+    reserved         uint64   0
+followed by these little-endian arrays:
+    fingerprints     uint32[submissions]      distinct fingerprints of each submission
+    indptr           uint64[submissions + 1]  the entries of row i are indptr[i] to indptr[i+1]
+    indices          uint32[entries]          the other submission of each entry
+    shared           uint32[entries]          the fingerprints the two submissions share
+    names table      JSON [[user, version], ...] naming each submission
+The entries of each row are sorted from the most fingerprints shared to the least, and
+then by submission, so the first k entries of a row are its k highest containments.
+"""
+
+import json
+import os
+import struct
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+FILE_NAME = "similarity_matrix.bin"
+
+MAGIC = b"LSIM"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIQQ")
+
+SCORES = ("shared", "containment", "jaccard")
+
+
+class SimilarityMatrix:
+    def __init__(self, names, fingerprints, indptr, indices, shared):
+        self.names = [(user, int(version)) for user, version in names]
+        self.fingerprints = np.asarray(fingerprints, dtype=np.uint32)
+        self.indptr = np.asarray(indptr, dtype=np.uint64)
+        self.indices = np.asarray(indices, dtype=np.uint32)
+        self.shared = np.asarray(shared, dtype=np.uint32)
+        self._rows = {name: i for i, name in enumerate(self.names)}
+
+        # the row of each entry, and its containment and Jaccard similarity
+        self.rows = np.repeat(np.arange(len(self.names), dtype=np.uint32),
+                              np.diff(self.indptr).astype(np.int64))
+        shared = self.shared.astype(np.float64)
+        row_fingerprints = self.fingerprints[self.rows].astype(np.float64)
+        column_fingerprints = self.fingerprints[self.indices].astype(np.float64)
+        self.containment = shared / row_fingerprints
+        self.jaccard = shared / (row_fingerprints + column_fingerprints - shared)
+
+    # the number of pairs of submissions which share any fingerprints
+    def pair_count(self):
+        return len(self.indices) // 2
+
+    # returns the row of the submission by user with version
+    def row(self, user, version):
+        return self._rows[(user, int(version))]
+
+    # returns the k submissions with the highest score with the submission by user with
+    # version, as (user, version, shared, containment, jaccard) tuples, highest first
+    def top_k(self, user, version, k, score="containment"):
+        if score not in SCORES:
+            raise ValueError(f"unknown score {score}, expected one of {', '.join(SCORES)}")
+        row = self.row(user, version)
+        start, end = int(self.indptr[row]), int(self.indptr[row + 1])
+        entries = np.arange(start, end)
+        # the entries are already sorted by the number shared, and so by containment
+        if score == "jaccard" and len(entries) > 0:
+            entries = entries[np.lexsort((self.indices[start:end], -self.jaccard[start:end]))]
+        return [(*self.names[self.indices[i]], int(self.shared[i]),
+                 float(self.containment[i]), float(self.jaccard[i]))
+                for i in entries[:k]]
+
+
+# returns the low 32 bits of each distinct hash of a submission, which is all of a hash that
+# compare_hashes uses
+def fingerprint_set(hashes):
+    return np.unique((np.asarray(hashes, dtype=np.uint64) & 0xffffffff).astype(np.uint32))
+
+
+# returns the SimilarityMatrix of submissions, a list of (user, version, hashes) tuples sorted
+# by user and version.  Hashes in excluded, and hashes which more than threshold students
+# share, aren't counted.
+def compute_similarity_matrix(submissions, excluded, threshold):
+    names = [(user, int(version)) for user, version, _hashes in submissions]
+    num_submissions = len(submissions)
+    fingerprint_sets = [fingerprint_set(hashes) for _user, _version, hashes in submissions]
+    hashes = np.concatenate(fingerprint_sets) if num_submissions > 0 \
+        else np.empty(0, dtype=np.uint32)
+    submission_of = np.repeat(np.arange(num_submissions, dtype=np.uint32),
+                              [len(s) for s in fingerprint_sets])
+    # submissions are sorted by user, so each student's submissions are numbered together
+    users = [user for user, _version in names]
+    student_of_submission = np.cumsum([i > 0 and users[i] != users[i - 1]
+                                       for i in range(num_submissions)], dtype=np.int64)
+
+    keep = ~np.isin(hashes, fingerprint_set(excluded))
+    hashes = hashes[keep]
+    submission_of = submission_of[keep]
+
+    # the postings of each hash, ordered by submission
+    order = np.lexsort((submission_of, hashes))
+    hashes = hashes[order]
+    submission_of = submission_of[order]
+    student_of = student_of_submission[submission_of]
+
+    new_hash = np.ones(len(hashes), dtype=bool)
+    new_hash[1:] = hashes[1:] != hashes[:-1]
+    new_student = new_hash.copy()
+    new_student[1:] |= student_of[1:] != student_of[:-1]
+    starts = np.flatnonzero(new_hash)
+    sizes = np.diff(np.append(starts, len(hashes)))
+    students = np.add.reduceat(new_student.astype(np.int64), starts) if len(starts) > 0 \
+        else np.empty(0, dtype=np.int64)
+
+    # common code isn't counted as a fingerprint of any submission
+    common = students > threshold
+    fingerprints = np.bincount(submission_of[~np.repeat(common, sizes)],
+                               minlength=num_submissions)
+
+    # the pairs sharing each hash are found in batches of the hashes with the same number of
+    # postings, which can be laid out as one row of postings for each hash
+    pair_codes = []
+    shared_by_pairs = (students >= 2) & ~common
+    for size in np.unique(sizes[shared_by_pairs]):
+        group_starts = starts[shared_by_pairs & (sizes == size)]
+        postings = submission_of[group_starts[:, None] + np.arange(size)].astype(np.int64)
+        for i in range(size):
+            for j in range(i + 1, size):
+                first, second = postings[:, i], postings[:, j]
+                different = student_of_submission[first] != student_of_submission[second]
+                pair_codes.append(first[different] * num_submissions + second[different])
+
+    codes, shared = np.unique(np.concatenate(pair_codes) if pair_codes
+                              else np.empty(0, dtype=np.int64), return_counts=True)
+    first, second = codes // max(num_submissions, 1), codes % max(num_submissions, 1)
+
+    # every pair is stored in the rows of both of its submissions
+    rows = np.concatenate([first, second])
+    columns = np.concatenate([second, first])
+    shared = np.concatenate([shared, shared])
+    order = np.lexsort((columns, -shared, rows))
+    indptr = np.zeros(num_submissions + 1, dtype=np.uint64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_submissions))
+    return SimilarityMatrix(names, fingerprints, indptr, columns[order], shared[order])
+
+
+def write_similarity_matrix(path, matrix):
+    names = json.dumps([[user, version] for user, version in matrix.names]).encode()
+    header = HEADER.pack(MAGIC, VERSION, 0, len(matrix.names), len(names),
+                         len(matrix.indices), 0)
+
+    # the matrix is written under a temporary name and then renamed, so that a partially
+    # written matrix is never read
+    handle, tmp_path = tempfile.mkstemp(dir=Path(path).parent, prefix=".tmp.")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(header)
+            for array in [matrix.fingerprints.astype("<u4"), matrix.indptr.astype("<u8"),
+                          matrix.indices.astype("<u4"), matrix.shared.astype("<u4")]:
+                if sys.byteorder != "little":
+                    array = array.byteswap()
+                file.write(array.tobytes())
+            file.write(names)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_similarity_matrix(path):
+    with open(path, "rb") as file:
+        magic, version, _reserved, submissions, names_size, entries, _ = \
+            HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} similarity matrix")
+        fingerprints = np.frombuffer(file.read(4 * submissions), dtype="<u4")
+        indptr = np.frombuffer(file.read(8 * (submissions + 1)), dtype="<u8")
+        indices = np.frombuffer(file.read(4 * entries), dtype="<u4")
+        shared = np.frombuffer(file.read(4 * entries), dtype="<u4")
+        names = json.loads(file.read(names_size))
+    return SimilarityMatrix(names, fingerprints, indptr, indices, shared)
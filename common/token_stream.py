@@ -0,0 +1,49 @@
+"""
+Reads and writes tokens.json files.
+
+Tokenizer workers write tokens in a compact layout which is still a valid JSON
+array, so anything that loads tokens.json keeps working, but which holds exactly
+one token per line:
+
+[
+{"char": 1, "line": 1, "type": "string", "value": "hello"},
+{"char": 7, "line": 1, "type": "string", "value": "world"}
+]
+
+This lets tokens be written to disk as they are produced and read back one at
+a time, rather than holding the whole pretty-printed document in memory.
+"""
+
+import json
+
+
+# writes each token in tokens to file, one per line
+def write_tokens(tokens, file):
+    file.write("[")
+    separator = "\n"
+    for token in tokens:
+        file.write(separator)
+        file.write(json.dumps(token, sort_keys=True))
+        separator = ",\n"
+    file.write("\n]\n")
+
+
+# yields each token stored in the tokens.json file at path.  Files in the compact layout
+# are read one line at a time.  Any other JSON (such as the pretty-printed output of a
+# tokenizer run from the command line, or null) is loaded in full.
+def read_tokens(path):
+    with open(path, 'r', encoding='ISO-8859-1') as file:
+        if file.readline().strip() == "[":
+            line = file.readline()
+            if line.strip() == "]":
+                return
+            if line.startswith("{"):
+                while line != "" and line.strip() != "]":
+                    yield json.loads(line.rstrip().rstrip(","))
+                    line = file.readline()
+                return
+
+        file.seek(0)
+        tokens = json.load(file)
+        if tokens is not None:
+            yield from tokens
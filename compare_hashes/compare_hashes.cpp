@@ -8,7 +8,14 @@
 #include <fstream>
 #include <set>
 #include <iomanip>
-#include <time.h>
+#include <algorithm>
+#include <functional>
+#include <tuple>
+#include <chrono>
+#include <sched.h>
+#include <atomic>
+#include <mutex>
+#include <thread>
 
 #include "boost/filesystem/operations.hpp"
 #include "boost/filesystem/path.hpp"
@@ -17,6 +24,11 @@
 #include "lichen_config.h"
 #include "submission.h"
 #include "hash_location.h"
+#include "hash_file.h"
+#include "hash_index.h"
+#include "hash_partitions.h"
+#include "matches_file.h"
+#include "stage_metrics.h"
 
 
 // =============================================================================
@@ -27,49 +39,191 @@ typedef unsigned int hash;
 typedef std::string user_id;
 typedef unsigned int version_number;
 
+// the number of hash ranges the hashes are split into when they don't all fit in memory
+static const unsigned int HASH_PARTITIONS = 1024;
+// roughly how much memory each hash takes while its partition is being looked up, which is
+// used to fit as many partitions as possible in the memory budget at once
+static const unsigned long long BYTES_PER_POSTING = 48;
+
+
+// a submission found on disk, in either this gradeable or another one.  The hashes of a
+// submission in a fingerprint index are read from the index, at the given position, instead
+// of its directory.
+struct FoundSubmission {
+  FoundSubmission(const std::string &sg, const user_id &s, version_number v, const boost::filesystem::path &p, const HashIndex* i = nullptr, unsigned int pos = 0) : source_gradeable(sg), student(s), version(v), path(p), index(i), position(pos) {}
+  std::string source_gradeable;
+  user_id student;
+  version_number version;
+  boost::filesystem::path path;
+  const HashIndex* index;
+  unsigned int position;
+};
+
+// a loaded submission, identified by its index in the table of all submissions.  Students and
+// gradeables are interned as indexes into the tables of their names, which are only looked
+// up when writing output.
+struct SubmissionInfo {
+  unsigned int student;
+  version_number version;
+  unsigned int source_gradeable;
+};
+
+inline bool operator < (const SubmissionInfo &s1, const SubmissionInfo &s2) {
+  return std::tie(s1.student, s1.version, s1.source_gradeable) < std::tie(s2.student, s2.version, s2.source_gradeable);
+}
+
 
 // =============================================================================
 // helper functions
 
-// ensures that all of the regions in the two parameters are adjacent
-bool matchingPositionsAreAdjacent(const nlohmann::json &first, const nlohmann::json &second) {
-  // they can't all be adjacent if there are an unequal number between the two lists
-  if (first["matchingpositions"].size() != second["matchingpositions"].size()) {
+// returns true if a region can be merged into the region before it, which it has the same type
+// as.  Hashes at every location are merged only with the region which ends one token before
+// them, while winnowed fingerprints, which may be several tokens apart, are merged with a
+// region they overlap or touch.  Regions of suspicious matches can only be merged if they match
+// the same submissions, with every matching position ending as many tokens after the same
+// position of the region before it as the region does.
+bool regionsCanBeMerged(const MatchRegion &prev, const MatchRegion &curr, bool winnowed) {
+  if (curr.type != prev.type) {
     return false;
   }
-
-  nlohmann::json::const_iterator itr1 = first["matchingpositions"].begin();
-  nlohmann::json::const_iterator itr2 = second["matchingpositions"].begin();
-  // iterate over each matching submission (first and second are the same length
-  // so we don't have to check for the end of second)
-  for (; itr1 != first["matchingpositions"].end(); itr1++, itr2++) {
-    if ((*itr1)["end"].get<int>() + 1 != (*itr2)["end"].get<int>()) {
+  if (winnowed ? curr.start > prev.end + 1 || curr.end <= prev.end : curr.end != prev.end + 1) {
+    return false;
+  }
+  if (prev.type != REGION_MATCH) {
+    return true;
+  }
+  // easy check to see if they can't be merged for certain
+  if (prev.others.size() != curr.others.size()) {
+    return false;
+  }
+  for (unsigned int i = 0; i < prev.others.size(); i++) {
+    const OtherSubmission &prev_other = prev.others[i];
+    const OtherSubmission &curr_other = curr.others[i];
+    // we can't merge the two regions if they are different in any way, except for the ending positions
+    if (prev_other.username != curr_other.username || prev_other.version != curr_other.version ||
+        prev_other.source_gradeable != curr_other.source_gradeable ||
+        prev_other.matchingpositions.size() != curr_other.matchingpositions.size()) {
       return false;
     }
+    for (unsigned int j = 0; j < prev_other.matchingpositions.size(); j++) {
+      if (curr_other.matchingpositions[j].end - prev_other.matchingpositions[j].end != curr.end - prev.end) {
+        return false;
+      }
+    }
   }
   return true;
 }
 
 
-// increments the end position for each of the matches in the json provided,
-// merging overlapping regions where necessary
-void incrementEndPositionsForMatches(nlohmann::json &others) {
-  nlohmann::json::iterator itr = others.begin();
-  for (; itr != others.end(); itr++) {
-    nlohmann::json::iterator itr2 = (*itr)["matchingpositions"].begin();
-    nlohmann::json::iterator itr3 = ++((*itr)["matchingpositions"].begin());
-    for (; itr3 != (*itr)["matchingpositions"].end();) {
-      if ((*itr2)["end"].get<int>() >= (*itr3)["start"]) {
-        (*itr2)["end"] = (*itr3)["end"].get<int>();
-        itr3 = (*itr)["matchingpositions"].erase(itr3);
+// extends the end position for each of the matches provided by as many tokens as their region
+// was extended, merging overlapping positions where necessary.  The positions are compacted in
+// place in a single pass.
+void extendEndPositionsForMatches(std::vector<OtherSubmission> &others, location_in_submission extension) {
+  for (std::vector<OtherSubmission>::iterator itr = others.begin(); itr != others.end(); ++itr) {
+    std::vector<MatchingPosition> &positions = itr->matchingpositions;
+    unsigned int last = 0;
+    for (unsigned int next = 1; next < positions.size(); next++) {
+      if (positions[last].end >= positions[next].start) {
+        positions[last].end = positions[next].end;
       }
       else {
-        (*itr2)["end"] = (*itr2)["end"].get<int>() + 1;
-        itr2++;
-        itr3++;
+        positions[last].end += extension;
+        positions[++last] = positions[next];
       }
     }
-    (*itr2)["end"] = (*itr2)["end"].get<int>() + 1;
+    positions[last].end += extension;
+    positions.resize(last + 1);
+  }
+}
+
+
+// counts the number of hashes matched in a submission, and the number matched with each of the
+// submissions it matches, from the merged regions of its matches file as they are written.
+// Each region of suspicious matches counts once for every submission it matches, leaving out
+// any part of it which overlaps the region before it.
+class MatchCounter {
+public:
+  MatchCounter() : hashes_matched(0), prev_end(0) {}
+
+  void add(const MatchRegion &region) {
+    if (region.type != REGION_MATCH) {
+      return;
+    }
+    int matched = region.end - std::max(prev_end, region.start - 1);
+    for (std::vector<OtherSubmission>::const_iterator other = region.others.begin(); other != region.others.end(); ++other) {
+      MatchedSubmission key(other->username, other->version, other->source_gradeable);
+      std::map<MatchedSubmission, unsigned int>::const_iterator index = match_indexes.find(key);
+      if (index == match_indexes.end()) {
+        index = match_indexes.insert(std::make_pair(key, matches.size())).first;
+        matches.push_back(std::make_pair(key, 0));
+      }
+      matches[index->second].second += matched;
+    }
+    hashes_matched += matched;
+    prev_end = region.end;
+  }
+
+  // adds the counts to the submission's summary.  The matched submissions are listed from the
+  // most hashes matched to the least, and otherwise in the order they were first matched.
+  void summarize(nlohmann::json &summary) {
+    std::stable_sort(matches.begin(), matches.end(),
+                     [](const std::pair<MatchedSubmission, int> &a, const std::pair<MatchedSubmission, int> &b) {
+                       return a.second > b.second;
+                     });
+    summary["hashes_matched"] = hashes_matched;
+    summary["matches"] = nlohmann::json::array();
+    for (std::vector<std::pair<MatchedSubmission, int>>::const_iterator itr = matches.begin(); itr != matches.end(); ++itr) {
+      summary["matches"].push_back({*std::get<0>(itr->first), std::get<1>(itr->first), *std::get<2>(itr->first), itr->second});
+    }
+  }
+
+private:
+  // the username, version and source gradeable of a matched submission
+  typedef std::tuple<const std::string*, int, const std::string*> MatchedSubmission;
+
+  std::vector<std::pair<MatchedSubmission, int>> matches;
+  std::map<MatchedSubmission, unsigned int> match_indexes;
+  int hashes_matched;
+  int prev_end;
+};
+
+
+// returns the number of hashes in an index and statistics on the lengths of their posting
+// lists, which determine how much work each lookup does
+nlohmann::json postingListStats(const HashIndex &index) {
+  std::vector<unsigned int> lengths;
+  unsigned long long postings = 0;
+  for (unsigned int i = 0; i < index.numKeys(); i++) {
+    lengths.push_back(index.postingListLength(i));
+    postings += lengths.back();
+  }
+  std::sort(lengths.begin(), lengths.end());
+
+  nlohmann::json stats;
+  stats["keys"] = lengths.size();
+  stats["postings"] = postings;
+  stats["mean"] = lengths.empty() ? 0.0 : postings / (double) lengths.size();
+  stats["median"] = lengths.empty() ? 0 : lengths[lengths.size() / 2];
+  stats["p90"] = lengths.empty() ? 0 : lengths[lengths.size() * 9 / 10];
+  stats["p99"] = lengths.empty() ? 0 : lengths[lengths.size() * 99 / 100];
+  stats["max"] = lengths.empty() ? 0 : lengths.back();
+  return stats;
+}
+
+
+// calls func(i) for each i from 0 to threads - 1, each on its own thread unless there is
+// only one
+void runOnThreads(int threads, const std::function<void(int)> &func) {
+  if (threads == 1) {
+    func(0);
+    return;
+  }
+  std::vector<std::thread> workers;
+  for (int i = 0; i < threads; i++) {
+    workers.push_back(std::thread(func, i));
+  }
+  for (std::vector<std::thread>::iterator itr = workers.begin(); itr != workers.end(); ++itr) {
+    itr->join();
   }
 }
 
@@ -80,8 +234,7 @@ void incrementEndPositionsForMatches(nlohmann::json &others) {
 int main(int argc, char* argv[]) {
   std::cout << "COMPARE HASHES:" << std::endl;
   fflush(stdout);
-  time_t overall_start, overall_end;
-  time(&overall_start);
+  StageMetrics metrics("compare_hashes");
 
 
   // ===========================================================================
@@ -94,8 +247,24 @@ int main(int argc, char* argv[]) {
   // ===========================================================================
   // load config info
 
-  assert(argc == 2);
+  // usage: compare_hashes.out <gradeable path> [--threads <number of threads>]
+  assert(argc == 2 || (argc == 4 && std::string(argv[2]) == "--threads"));
   std::string lichen_gradeable_path_str = argv[1];
+  // 0 threads uses every available core
+  int threads = argc == 4 ? std::stoi(argv[3]) : lichen_config.value("compare_hashes_threads", 1);
+  if (threads <= 0) {
+    cpu_set_t cpus;
+    threads = sched_getaffinity(0, sizeof(cpus), &cpus) == 0 ? CPU_COUNT(&cpus) : 1;
+  }
+  int max_matching_positions = lichen_config.value("max_matching_positions", 30);
+  // if set, hashes are split into partitions on disk so that no more than about this many
+  // bytes of them are in memory at once.  Otherwise every hash is loaded at once.
+  unsigned long long memory_budget = lichen_config.value("compare_hashes_memory_budget_bytes", 0ULL);
+  MatchesFileFormat matches_file_format;
+  if (!parseMatchesFileFormat(lichen_config.value("matches_file_format", "json"), matches_file_format)) {
+    std::cerr << "ERROR: unknown matches_file_format " << lichen_config["matches_file_format"] << std::endl;
+    return 1;
+  }
   boost::filesystem::path lichen_gradeable_path = boost::filesystem::system_complete(lichen_gradeable_path_str);
   boost::filesystem::path config_file_json_path = lichen_gradeable_path / "config.json";
 
@@ -117,10 +286,10 @@ int main(int argc, char* argv[]) {
     exit(0);
   }
 
-  // the file path where we expect to find the hashed instructor provided code file
-  boost::filesystem::path provided_code_file = lichen_gradeable_path / "provided_code" / "hashes.txt";
-  // if file exists in that location, the provided code mode is enabled.
-  config.provided_code_enabled = boost::filesystem::exists(provided_code_file);
+  // the directory where we expect to find the hashed instructor provided code file
+  boost::filesystem::path provided_code_dir = lichen_gradeable_path / "provided_code";
+  // if a hashes file exists in that location, the provided code mode is enabled.
+  config.provided_code_enabled = hashesFileExists(provided_code_dir);
   // path to other gradeables' data
   boost::filesystem::path other_gradeables_dir = lichen_gradeable_path / "other_gradeables";
 
@@ -128,38 +297,180 @@ int main(int argc, char* argv[]) {
   // ===========================================================================
   // loop over all submissions and populate the all_hashes and all_submissions structures
 
-  // Stores all the hashes and their locations across all submissions (sorted in "bins" of student names)
-  std::unordered_map<hash, std::unordered_map<user_id, std::vector<HashLocation>>> all_hashes;
-  // Stores all submissions
+  // Stores every submission in this and other gradeables, indexed by submission_id
+  std::vector<SubmissionInfo> submissions;
+  // The names of the students and gradeables interned in submissions
+  std::vector<user_id> student_names;
+  std::vector<std::string> gradeable_names;
+  // Stores all the hashes and their locations across all submissions
+  HashIndex all_hashes;
+  // Stores the submissions of this gradeable
   std::vector<Submission*> all_submissions;
+  // The submission_id of each submission in this gradeable, in increasing order, and the
+  // number of hashes and of sequences hashed in each submission
+  std::vector<submission_id> this_gradeable_ids;
+  std::vector<unsigned int> hash_counts;
+  std::vector<unsigned int> sequence_counts;
+  // whether the hashes file of each submission stores the location of each hash, as it does
+  // for winnowed fingerprints, which are several tokens apart
+  std::vector<bool> winnowed;
+  // if there is a memory budget, every hash is written to these partitions instead of being
+  // loaded into all_hashes or other_gradeables
+  HashPartitions* partitions = nullptr;
   // Stores all hashes from the instructor provided code
   std::unordered_set<hash> provided_code;
+  // Stores the hashes of common code: those which more than threshold students in this gradeable
+  // share, which are found before any hash is looked up, and those read from common_code_paths
+  std::unordered_set<hash> common_code;
+  // the common code found in this gradeable, which is written to common_code/hashes.txt
+  std::vector<hash> found_common_code;
   // stores all hashes from other gradeables
-  std::unordered_map<hash, std::unordered_map<user_id, std::vector<HashLocation>>> other_gradeables;
+  HashIndex other_gradeables;
+  // the fingerprint indexes of other gradeables which were indexed by a previous run, and for
+  // each of them the submission_id of each of the submissions in its postings
+  std::vector<HashIndex*> attached_indexes;
+  std::vector<std::vector<submission_id>> attached_submission_ids;
+  // the fingerprint indexes of other gradeables which the prefilter picked candidates from,
+  // whose candidates are loaded like any other submission, only until they are loaded
+  std::vector<HashIndex*> candidate_indexes;
+  // the submissions of other gradeables kept by the MinHash prefilter, by gradeable.  Only
+  // these submissions of the listed gradeables are compared (see hasher/minhash_prefilter.py).
+  std::map<std::string, std::set<std::pair<user_id, version_number>>> prefilter_candidates;
   // a map of "user_id:version" strings to the non-zero number of times their matching positions array was truncated
-  std::unordered_map<std::string, int> matching_positions_truncations;
+  std::map<std::string, int> matching_positions_truncations;
 
 
-  time_t start, end;
-  time(&start);
+  metrics.startPhase("load");
 
   if (config.provided_code_enabled) {
     // load the instructor provided code's hashes
-    std::ifstream istr(provided_code_file.string());
-    assert(istr.good());
-    hash instructor_hash;
-    while (istr >> instructor_hash) {
-      provided_code.insert(instructor_hash);
+    std::vector<hash> instructor_hashes;
+    std::vector<location_in_submission> instructor_locations;
+    unsigned int instructor_sequences;
+    bool loaded = loadHashes(provided_code_dir, instructor_hashes, instructor_locations, instructor_sequences);
+    assert(loaded);
+    provided_code.insert(instructor_hashes.begin(), instructor_hashes.end());
+  }
+
+  // load the common code found by earlier runs, of this gradeable or others, from each of the
+  // common_code_paths in config.json.  Each path is either the common_code directory written
+  // below, or the directory of the gradeable it was written in.
+  unsigned int imported_common_code = 0;
+  std::vector<std::string> common_code_paths = config_file_json.value("common_code_paths", std::vector<std::string>());
+  for (std::vector<std::string>::const_iterator itr = common_code_paths.begin(); itr != common_code_paths.end(); ++itr) {
+    boost::filesystem::path common_code_dir(*itr);
+    if (!hashesFileExists(common_code_dir)) {
+      common_code_dir /= "common_code";
+    }
+    std::vector<hash> common_hashes;
+    std::vector<location_in_submission> common_locations;
+    unsigned int common_sequences;
+    if (!loadHashes(common_code_dir, common_hashes, common_locations, common_sequences)) {
+      std::cerr << "ERROR: unable to load common code from " << *itr << std::endl;
+      return 1;
     }
+    common_code.insert(common_hashes.begin(), common_hashes.end());
+    imported_common_code += common_hashes.size();
   }
 
-  // load other gradeables' hashes
-  // iterate over all other gradeables
+  // this gradeable's submissions are listed before those of other gradeables
+  std::vector<FoundSubmission> found_submissions;
+  std::string this_gradeable_str = config.term + "__" + config.course + "__" + config.gradeable;
+
+  // find this gradeable's submissions
+  // loop over all users
   boost::filesystem::directory_iterator end_iter;
+  for (boost::filesystem::directory_iterator dir_itr( users_root_directory ); dir_itr != end_iter; ++dir_itr) {
+    boost::filesystem::path username_path = dir_itr->path();
+    assert (is_directory(username_path));
+    std::string username = dir_itr->path().filename().string();
+
+    // loop over all versions
+    for (boost::filesystem::directory_iterator username_itr( username_path ); username_itr != end_iter; ++username_itr) {
+      boost::filesystem::path version_path = username_itr->path();
+      assert (is_directory(version_path));
+      std::string str_version = username_itr->path().filename().string();
+      version_number version = std::stoi(str_version);
+      assert (version > 0);
+
+      found_submissions.push_back(FoundSubmission(this_gradeable_str, username, version, version_path));
+    }
+  }
+  unsigned int this_gradeable_count = found_submissions.size();
+
+  boost::filesystem::path prefilter_candidates_path = lichen_gradeable_path / "other_gradeable_candidates.json";
+  if (boost::filesystem::exists(prefilter_candidates_path)) {
+    std::ifstream candidates_istr(prefilter_candidates_path.string());
+    assert(candidates_istr.good());
+    nlohmann::json candidates_json = nlohmann::json::parse(candidates_istr);
+    for (nlohmann::json::const_iterator itr = candidates_json.begin(); itr != candidates_json.end(); ++itr) {
+      std::set<std::pair<user_id, version_number>> &candidates = prefilter_candidates[itr.key()];
+      for (nlohmann::json::const_iterator candidate = itr->begin(); candidate != itr->end(); ++candidate) {
+        candidates.insert(std::make_pair((*candidate)[0].get<user_id>(), (*candidate)[1].get<version_number>()));
+      }
+    }
+  }
+  // returns whether a submission of an other gradeable is compared, which it is unless the
+  // prefilter listed its gradeable without it
+  unsigned int prefilter_skipped = 0;
+  auto isCandidate = [&](const std::string &gradeable, const user_id &student, version_number version) {
+    std::map<std::string, std::set<std::pair<user_id, version_number>>>::const_iterator candidates = prefilter_candidates.find(gradeable);
+    if (candidates == prefilter_candidates.end() || candidates->second.count(std::make_pair(student, version)) > 0) {
+      return true;
+    }
+    prefilter_skipped++;
+    return false;
+  };
+
+  // map the fingerprint indexes of other gradeables listed as attached in the manifest, which
+  // weren't concatenated, tokenized or hashed on this run (see common/fingerprint_index.py)
+  std::set<std::string> attached_gradeables;
+  // the indexes are kept in fingerprint_index_dir if it is set, and beside the manifest otherwise
+  boost::filesystem::path manifest_dir = lichen_gradeable_path / "fingerprint_indexes";
+  boost::filesystem::path fingerprint_indexes_dir = lichen_config.value("fingerprint_index_dir", std::string());
+  if (fingerprint_indexes_dir.empty()) {
+    fingerprint_indexes_dir = manifest_dir;
+  }
+  if (boost::filesystem::exists(manifest_dir / "manifest.json")) {
+    std::ifstream manifest_istr((manifest_dir / "manifest.json").string());
+    assert(manifest_istr.good());
+    nlohmann::json manifest = nlohmann::json::parse(manifest_istr);
+    for (nlohmann::json::const_iterator itr = manifest.begin(); itr != manifest.end(); ++itr) {
+      if (!(*itr)["attached"].get<bool>()) {
+        continue;
+      }
+      HashIndex* index = new HashIndex();
+      std::vector<std::pair<user_id, version_number>> names;
+      bool mapped = index->map((fingerprint_indexes_dir / ((*itr)["key"].get<std::string>() + ".idx")).string(), names);
+      assert(mapped);
+      attached_gradeables.insert(itr.key());
+      // if the prefilter picked candidates from the index, only their hashes are read from it
+      // and loaded.  Otherwise every submission is compared, and its postings are looked up
+      // in the mapped index as they are.
+      if (prefilter_candidates.count(itr.key()) > 0) {
+        candidate_indexes.push_back(index);
+      } else {
+        attached_indexes.push_back(index);
+        attached_submission_ids.push_back(std::vector<submission_id>(names.size()));
+      }
+      for (unsigned int i = 0; i < names.size(); i++) {
+        if (!isCandidate(itr.key(), names[i].first, names[i].second)) {
+          continue;
+        }
+        found_submissions.push_back(FoundSubmission(itr.key(), names[i].first, names[i].second, other_gradeables_dir / itr.key() / names[i].first / std::to_string(names[i].second), index, i));
+      }
+    }
+  }
+
+  // find other gradeables' submissions
+  // iterate over all other gradeables
   for (boost::filesystem::directory_iterator other_gradeable_itr(other_gradeables_dir); other_gradeable_itr != end_iter; ++other_gradeable_itr) {
     boost::filesystem::path other_gradeable_path = other_gradeable_itr->path();
     assert (is_directory(other_gradeable_path));
     std::string other_gradeable_str = other_gradeable_itr->path().filename().string();
+    if (attached_gradeables.count(other_gradeable_str) > 0) {
+      continue;
+    }
 
     // loop over every user
     for (boost::filesystem::directory_iterator other_user_itr(other_gradeable_path); other_user_itr != end_iter; ++other_user_itr) {
@@ -174,364 +485,646 @@ int main(int argc, char* argv[]) {
         std::string str_other_version = other_version_itr->path().filename().string();
         version_number other_version = std::stoi(str_other_version);
         assert (other_version > 0);
-
-        // load the hashes from this submission from another gradeable
-        boost::filesystem::path other_hash_file = other_version_path / "hashes.txt";
-        std::ifstream istr(other_hash_file.string());
-        assert(istr.good());
-        std::string input_hash_str;
-        int location = 0;
-        while (istr >> input_hash_str) {
-          hash input_hash = (unsigned int)(stoul(input_hash_str, 0, 16));
-          location++;
-          other_gradeables[input_hash][other_username].push_back(HashLocation(other_username, other_version, location, other_gradeable_str));
+        if (!isCandidate(other_gradeable_str, other_username, other_version)) {
+          continue;
         }
+
+        found_submissions.push_back(FoundSubmission(other_gradeable_str, other_username, other_version, other_version_path));
       }
     }
   }
 
+  // intern the student and gradeable names.  Students are numbered in reverse alphabetical
+  // order and this gradeable is numbered first, so that sorting submissions by their ids
+  // sorts them in the order their matches are written out.
+  std::map<user_id, unsigned int, std::greater<user_id>> student_ids;
+  std::map<std::string, unsigned int> gradeable_ids;
+  for (std::vector<FoundSubmission>::const_iterator itr = found_submissions.begin(); itr != found_submissions.end(); ++itr) {
+    student_ids[itr->student] = 0;
+    if (itr->source_gradeable != this_gradeable_str) {
+      gradeable_ids[itr->source_gradeable] = 0;
+    }
+  }
+  for (std::map<user_id, unsigned int>::iterator itr = student_ids.begin(); itr != student_ids.end(); ++itr) {
+    itr->second = student_names.size();
+    student_names.push_back(itr->first);
+  }
+  gradeable_names.push_back(this_gradeable_str);
+  for (std::map<std::string, unsigned int>::iterator itr = gradeable_ids.begin(); itr != gradeable_ids.end(); ++itr) {
+    itr->second = gradeable_names.size();
+    gradeable_names.push_back(itr->first);
+  }
+  gradeable_ids[this_gradeable_str] = 0;
+
+  // number the submissions in sorted order, so that each student's submissions are numbered
+  // consecutively and the postings in the indexes don't depend on directory order
+  std::vector<std::pair<SubmissionInfo, unsigned int>> sorted_submissions;
+  for (unsigned int i = 0; i < found_submissions.size(); i++) {
+    SubmissionInfo info;
+    info.student = student_ids[found_submissions[i].student];
+    info.version = found_submissions[i].version;
+    info.source_gradeable = gradeable_ids[found_submissions[i].source_gradeable];
+    sorted_submissions.push_back(std::make_pair(info, i));
+  }
+  std::sort(sorted_submissions.begin(), sorted_submissions.end());
+  if (memory_budget > 0) {
+    partitions = new HashPartitions(lichen_gradeable_path / "hash_partitions", HASH_PARTITIONS);
+  }
+
+  // load the hashes from every submission
+  unsigned int indexed_candidates = 0;
+  for (submission_id id = 0; id < sorted_submissions.size(); id++) {
+    submissions.push_back(sorted_submissions[id].first);
+    unsigned int found_index = sorted_submissions[id].second;
+    hash_counts.push_back(0);
+    sequence_counts.push_back(0);
+    winnowed.push_back(false);
+
+    // submissions in a mapped attached index are already loaded, their postings just need to
+    // be translated to this submission_id
+    const FoundSubmission &found = found_submissions[found_index];
+    std::vector<HashIndex*>::const_iterator attached = std::find(attached_indexes.begin(), attached_indexes.end(), found.index);
+    if (found.index != nullptr && attached != attached_indexes.end()) {
+      attached_submission_ids[attached - attached_indexes.begin()][found.position] = id;
+      continue;
+    }
 
-  // loop over all users
-  for (boost::filesystem::directory_iterator dir_itr( users_root_directory ); dir_itr != end_iter; ++dir_itr) {
-    boost::filesystem::path username_path = dir_itr->path();
-    assert (is_directory(username_path));
-    std::string username = dir_itr->path().filename().string();
+    std::vector<hash> input_hashes;
+    std::vector<location_in_submission> input_locations;
+    if (found.index != nullptr) {
+      std::pair<const IndexedHash*, const IndexedHash*> indexed_hashes = found.index->submissionHashes(found.position);
+      for (const IndexedHash* itr = indexed_hashes.first; itr != indexed_hashes.second; ++itr) {
+        input_hashes.push_back(itr->h);
+        input_locations.push_back(itr->location);
+      }
+      indexed_candidates++;
+    } else {
+      bool loaded = loadHashes(found.path, input_hashes, input_locations, sequence_counts[id]);
+      assert(loaded);
+      winnowed[id] = !input_locations.empty();
+      // hashes files without locations have a hash at every location
+      if (input_locations.empty()) {
+        for (unsigned int i = 0; i < input_hashes.size(); i++) {
+          input_locations.push_back(i + 1);
+        }
+      }
+    }
 
-    // loop over all versions
-    for (boost::filesystem::directory_iterator username_itr( username_path ); username_itr != end_iter; ++username_itr) {
-      boost::filesystem::path version_path = username_itr->path();
-      assert (is_directory(version_path));
-      std::string str_version = username_itr->path().filename().string();
-      version_number version = std::stoi(str_version);
-      assert (version > 0);
+    bool this_gradeable = found_index < this_gradeable_count;
+    hash_counts[id] = input_hashes.size();
+    if (this_gradeable) {
+      this_gradeable_ids.push_back(id);
+    }
+
+    // only this gradeable's hashes are looked up, so they are numbered in the order they
+    // should be added to their submission
+    if (partitions != nullptr) {
+      for (unsigned int i = 0; i < input_hashes.size(); i++) {
+        partitions->add(input_hashes[i], id, input_locations[i], this_gradeable ? i : NOT_LOOKED_UP);
+      }
+      continue;
+    }
 
-      // create a submission object and load to the main submissions structure
-      Submission* curr_submission = new Submission(username, version, config);
-
-      // load the hashes from this submission
-      boost::filesystem::path hash_file = version_path;
-      hash_file /= "hashes.txt";
-      std::ifstream istr(hash_file.string());
-      assert(istr.good());
-      std::string input_hash_str;
-      int location = 0;
-      while (istr >> input_hash_str) {
-        hash input_hash = (unsigned int)(stoul(input_hash_str, 0, 16));
-        location++;
-        all_hashes[input_hash][username].push_back(HashLocation(username, version, location, config.term + "__" + config.course + "__" + config.gradeable));
-        curr_submission->addHash(input_hash, location);
+    // load submissions from other gradeables into their own index
+    if (!this_gradeable) {
+      for (unsigned int i = 0; i < input_hashes.size(); i++) {
+        other_gradeables.add(input_hashes[i], id, input_locations[i]);
       }
+      continue;
+    }
 
-      all_submissions.push_back(curr_submission);
+    for (unsigned int i = 0; i < input_hashes.size(); i++) {
+      all_hashes.add(input_hashes[i], id, input_locations[i]);
     }
+    // create a submission object and load to the main submissions structure
+    Submission* curr_submission = new Submission(id, config);
+    curr_submission->setHashes(input_hashes, input_locations);
+    all_submissions.push_back(curr_submission);
+  }
+  if (partitions != nullptr) {
+    partitions->flush();
+  }
+  other_gradeables.build();
+  all_hashes.build();
+  for (std::vector<HashIndex*>::iterator itr = candidate_indexes.begin(); itr != candidate_indexes.end(); ++itr) {
+    delete *itr;
   }
 
-  time(&end);
-  double diff = difftime(end, start);
+  double diff = metrics.endPhase("load");
   std::cout << "Finished loading in " << diff  << " seconds" << std::endl;
+  if (prefilter_skipped > 0) {
+    std::cout << "Skipped " << prefilter_skipped << " submissions of other gradeables which the prefilter didn't keep" << std::endl;
+  }
+  if (indexed_candidates > 0) {
+    std::cout << "Loaded " << indexed_candidates << " candidates from fingerprint indexes" << std::endl;
+  }
+
+  nlohmann::json posting_lists;
+  posting_lists["this_gradeable"] = postingListStats(all_hashes);
+  posting_lists["other_gradeables"] = postingListStats(other_gradeables);
+  for (unsigned int k = 0; k < attached_indexes.size(); k++) {
+    posting_lists["attached_indexes"].push_back(postingListStats(*attached_indexes[k]));
+  }
+  metrics.set("posting_lists", posting_lists);
+  metrics.set("threads", threads);
+  metrics.set("matches_file", matchesFileName(matches_file_format));
+  metrics.set("prefilter_skipped", prefilter_skipped);
+  metrics.set("indexed_candidates", indexed_candidates);
 
 
   // ===========================================================================
-  // THIS IS THE MAIN PLAGIARISM DETECTION ALGORITHM
+  // FINDING THE COMMON CODE
+
+  // Every hash of this gradeable which more than threshold students share is common code.  The
+  // postings of each hash in an index of this gradeable's hashes are ordered by submission, so
+  // each student's postings are next to each other and the students can be counted in a single
+  // pass, once for each hash rather than every time it is looked up.
+  auto findCommonCode = [&](const HashIndex &this_index) {
+    // common code must also be shared with another student, even if the threshold is 0
+    unsigned int min_students = std::max(config.threshold, 1) + 1;
+    for (unsigned int i = 0; i < this_index.numKeys(); i++) {
+      std::pair<const HashLocation*, const HashLocation*> occurences = this_index.postingList(i);
+      if ((unsigned int) (occurences.second - occurences.first) < min_students) {
+        continue;
+      }
+      unsigned int students_with_hash = 0;
+      for (const HashLocation* itr = occurences.first; itr != occurences.second && students_with_hash < min_students; ++itr) {
+        if (itr == occurences.first || submissions[itr->submission].student != submissions[(itr - 1)->submission].student) {
+          students_with_hash++;
+        }
+      }
+      if (students_with_hash >= min_students) {
+        common_code.insert(this_index.key(i));
+        found_common_code.push_back(this_index.key(i));
+      }
+    }
+  };
 
-  // Used to calculate current progress (printed to the log)
-  int my_counter = 0;
-  int my_percent = 0;
-  time(&start);
+  // if the hashes were split into partitions, each batch of them is checked as it's looked up
+  if (partitions == nullptr) {
+    metrics.startPhase("find common code");
+    findCommonCode(all_hashes);
+    metrics.endPhase("find common code");
+  }
 
-  std::cout << "[0%                      25%                     50%                     75%                     100%]" << std::endl << "[";
-  fflush(stdout);
 
-  // walk over every Submission
-  for (std::vector<Submission*>::iterator submission_itr = all_submissions.begin();
-       submission_itr != all_submissions.end(); ++submission_itr) {
+  // ===========================================================================
+  // THIS IS THE MAIN PLAGIARISM DETECTION ALGORITHM
 
-    // =========================================================================
-    // FINDING THE MATCHES
+  // looks up a hash from a submission by curr_student in this_index and other_index, which
+  // hold the hashes of this gradeable and of other gradeables, and in the attached indexes,
+  // storing what was found in matches.  Only reads the structures loaded above, so several
+  // hashes can be looked up at once.
+  auto matchHash = [&](hash curr_hash, unsigned int curr_student, const HashIndex &this_index, const HashIndex &other_index, HashMatches &matches) {
+    // if provided code was enabled, look for the submission hash in the provided code's hashes
+    if (config.provided_code_enabled && provided_code.find(curr_hash) != provided_code.end()) {
+      matches.provided = true;
+      return;
+    }
 
-    // walk over every hash in that submission
-    std::vector<std::pair<hash, location_in_submission>>::const_iterator hash_itr = (*submission_itr)->getHashes().begin();
-    for (; hash_itr != (*submission_itr)->getHashes().end(); ++hash_itr) {
-
-      // if provided code was enabled, look for the submission hash in the provided code's hashes
-      bool provided_match_found = false;
-      if (config.provided_code_enabled) {
-        std::unordered_set<hash>::iterator provided_match_itr = provided_code.find(hash_itr->first);
-        if (provided_match_itr != provided_code.end()) {
-          provided_match_found = true;
-          // add provded match
-          (*submission_itr)->addProvidedMatch(hash_itr->second);
+    // if the hash doesn't match any of the provided code's hashes, try to find matches between
+    // other students, unless it is common code
+    if (common_code.find(curr_hash) != common_code.end()) {
+      matches.common = true;
+    } else {
+      std::pair<const HashLocation*, const HashLocation*> occurences = this_index.find(curr_hash);
+      // loop over all other occurences of the matching hash
+      for (const HashLocation* itr = occurences.first; itr != occurences.second; ++itr) {
+        // don't look for matches across submissions of the same student
+        if (submissions[itr->submission].student != curr_student) {
+          // save the match as a suspicous match
+          matches.suspicious.push_back(*itr);
         }
       }
+    }
 
-      // if the hash doesn't match any of the provided code's hashes, try to find matches between other students
-      if (!provided_match_found) {
-        // look up that hash in the all_hashes table, loop over all other students that have the same hash
-        std::unordered_map<std::string, std::vector<HashLocation>> occurences = all_hashes[hash_itr->first];
-        std::unordered_map<std::string, std::vector<HashLocation>>::iterator occurences_itr = occurences.begin();
-        for (; occurences_itr != occurences.end(); ++occurences_itr) {
-
-          // don't look for matches across submissions of the same student
-          if (occurences_itr->first == (*submission_itr)->student()) {
-            continue;
-          }
-
-          // save the locations of all other occurences of the matching hash in other students' submissions
-          std::vector<HashLocation>::iterator itr = occurences_itr->second.begin();
-          for (; itr != occurences_itr->second.end(); ++itr) {
-
-            if (occurences.size() > (unsigned int) config.threshold) {
-              // if the number of students with matching code is more
-              // than the threshold, it is considered common code
-              (*submission_itr)->addCommonMatch(hash_itr->second);
-            } else {
-              // save the match as a suspicous match
-              (*submission_itr)->addSuspiciousMatch(hash_itr->second, *itr, hash_itr->first);
-            }
-          }
-        }
-
-        // look up the that hash in the other_gradeables table, loop over all other students that have the same hash
-        std::unordered_map<std::string, std::vector<HashLocation>> other_occurences = other_gradeables[hash_itr->first];
-        std::unordered_map<std::string, std::vector<HashLocation>>::iterator other_occurences_itr = other_occurences.begin();
-        for (; other_occurences_itr != other_occurences.end(); ++other_occurences_itr) {
+    // look up the that hash in the other gradeables' indexes, loop over all of its occurences
+    // Note: we DO look for matches across submissions of the same student for self-plagiarism
+    std::pair<const HashLocation*, const HashLocation*> other_occurences = other_index.find(curr_hash);
+    matches.suspicious.insert(matches.suspicious.end(), other_occurences.first, other_occurences.second);
+    for (unsigned int k = 0; k < attached_indexes.size(); k++) {
+      other_occurences = attached_indexes[k]->find(curr_hash);
+      for (const HashLocation* itr = other_occurences.first; itr != other_occurences.second; ++itr) {
+        matches.suspicious.push_back(HashLocation(attached_submission_ids[k][itr->submission], itr->location));
+      }
+    }
+  };
 
-          // Note: we DO look for matches across submissions of the same student for self-plagiarism
+  // finds the matches for every hash of a submission which was loaded into all_hashes
+  auto findMatches = [&](Submission* curr_submission) {
+    const SubmissionInfo &curr_info = submissions[curr_submission->id()];
 
-          // save the locations of all other occurences from prior term submissions
-          std::vector<HashLocation>::iterator itr = other_occurences_itr->second.begin();
-          for (; itr != other_occurences_itr->second.end(); ++itr) {
-            (*submission_itr)->addSuspiciousMatch(hash_itr->second, *itr, hash_itr->first);
-          }
-        }
-      }
+    // walk over every hash in that submission
+    const std::vector<hash> &curr_hashes = curr_submission->getHashes();
+    const std::vector<location_in_submission> &curr_locations = curr_submission->getLocations();
+    HashMatches matches;
+    for (unsigned int i = 0; i < curr_hashes.size(); i++) {
+      matches.clear();
+      matchHash(curr_hashes[i], curr_info.student, all_hashes, other_gradeables, matches);
+      curr_submission->addMatches(curr_locations[i], matches);
     }
+  };
+
+  // writes the matches file of a submission once all of its matches have been found,
+  // counting any truncated matching positions arrays in truncations and setting bytes_written
+  // to the size of the file.  Returns the submission's summary for match_summary.json.
+  auto writeMatches = [&](Submission* curr_submission, std::map<std::string, int> &truncations, unsigned long long &bytes_written) -> nlohmann::json {
+    const SubmissionInfo &curr_info = submissions[curr_submission->id()];
+    nlohmann::json summary;
+    summary["username"] = student_names[curr_info.student];
+    summary["version"] = curr_info.version;
+    summary["sequences"] = sequence_counts[curr_submission->id()];
+    summary["hashes_matched"] = 0;
+    summary["matches"] = nlohmann::json::array();
 
     // If no suspicious matches were found, don't attempt to create any output files
-    if ((*submission_itr)->getSuspiciousMatches().size() == 0) {
-      delete (*submission_itr);
-      (*submission_itr) = nullptr;
-      continue;
+    if (curr_submission->getSuspiciousMatches().size() == 0) {
+      return summary;
     }
 
     // =========================================================================
-    // Write matches.json file
+    // Write the matches file
 
-    // holds the JSON file to be written
-    std::vector<nlohmann::json> result;
+    boost::filesystem::path submission_dir = users_root_directory / student_names[curr_info.student] / std::to_string(curr_info.version);
+    boost::filesystem::create_directories(submission_dir);
+    MatchesWriter writer(submission_dir / matchesFileName(matches_file_format), matches_file_format);
+    MatchCounter counter;
+
+    // the regions are produced in order, and each one is merged into the region before it
+    // where it can be, to shrink the file in size.  The region before it is written as soon
+    // as a region can't be merged into it, so only one region is held at a time.
+    MatchRegion prevPosition;
+    bool has_prev = false;
+    bool curr_winnowed = winnowed[curr_submission->id()];
+    auto addRegion = [&](MatchRegion &currPosition) {
+      if (has_prev && regionsCanBeMerged(prevPosition, currPosition, curr_winnowed)) {
+        if (prevPosition.type == REGION_MATCH) {
+          extendEndPositionsForMatches(prevPosition.others, currPosition.end - prevPosition.end);
+        }
+        prevPosition.end = currPosition.end;
+        return;
+      }
+
+      if (has_prev) {
+        counter.add(prevPosition);
+        writer.write(prevPosition);
+      }
+      prevPosition = std::move(currPosition);
+      has_prev = true;
+    };
 
 
     // **********  WRITE THE SUSPICIOUS MATCHES  **********
     // all of the suspicious matches for this submission
-    std::map<location_in_submission, std::set<HashLocation> > suspicious_matches = (*submission_itr)->getSuspiciousMatches();
+    const std::map<location_in_submission, std::set<HashLocation> > &suspicious_matches = curr_submission->getSuspiciousMatches();
 
     // loop over each of the suspicious locations in the current submission
     for (std::map<location_in_submission, std::set<HashLocation> >::const_iterator location_itr
          =suspicious_matches.begin(); location_itr != suspicious_matches.end(); ++location_itr) {
 
-      // stores matches of hash locations across other submssions in the class
-      std::vector<nlohmann::json> others;
-
-      {
-        // generate a specific element of the "others" vector
-        // set the variables to their initial values
-        std::set<HashLocation>::const_iterator matching_positions_itr = location_itr->second.begin();
-        nlohmann::json other;
-        other["username"] = matching_positions_itr->student;
-        other["version"] = matching_positions_itr->version;
-        other["source_gradeable"] = matching_positions_itr->source_gradeable;
-        std::vector<nlohmann::json> matchingpositions;
-        nlohmann::json position;
-        position["start"] = matching_positions_itr->location;
-        position["end"] = matching_positions_itr->location + config.hash_size - 1;
-        matchingpositions.push_back(position);
-
-        // search for all matching positions of the suspicious match in other submissions
-        if (location_itr->second.size() > 1) {
-          ++matching_positions_itr;
-
-          // loop over all of the other matching positions
-          for (; matching_positions_itr != location_itr->second.end(); ++matching_positions_itr) {
-
-            // keep iterating and editing the same object until a we get to a different submission
-            if (matching_positions_itr->student != other["username"]
-                || matching_positions_itr->version != other["version"]
-                || matching_positions_itr->source_gradeable != other["source_gradeable"]
-                || matchingpositions.size() >= lichen_config["max_matching_positions"]) {
-
-              // found a different one, we push the old one and start over
-              other["matchingpositions"] = matchingpositions;
-              others.push_back(other);
-
-              if (matchingpositions.size() >= lichen_config["max_matching_positions"]) {
-                matching_positions_truncations[std::string(other["username"]) + std::string(":") + std::to_string(other["version"].get<int>())]++;
-                break;
-              }
-
-              matchingpositions.clear();
-              other["username"] = matching_positions_itr->student;
-              other["version"] = matching_positions_itr->version;
-              other["source_gradeable"] = matching_positions_itr->source_gradeable;
+      MatchRegion info;
+      info.start = location_itr->first;
+      info.end = location_itr->first + config.hash_size - 1;
+      info.type = REGION_MATCH;
+
+      // generate a specific element of the "others" vector
+      // set the variables to their initial values
+      std::set<HashLocation>::const_iterator matching_positions_itr = location_itr->second.begin();
+      OtherSubmission other;
+      auto startOther = [&](submission_id other_submission) {
+        other.username = &student_names[submissions[other_submission].student];
+        other.version = submissions[other_submission].version;
+        other.source_gradeable = &gradeable_names[submissions[other_submission].source_gradeable];
+        other.matchingpositions.clear();
+      };
+      submission_id other_submission = matching_positions_itr->submission;
+      startOther(other_submission);
+      MatchingPosition position;
+      position.start = matching_positions_itr->location;
+      position.end = matching_positions_itr->location + config.hash_size - 1;
+      other.matchingpositions.push_back(position);
+
+      // search for all matching positions of the suspicious match in other submissions
+      if (location_itr->second.size() > 1) {
+        ++matching_positions_itr;
+
+        // loop over all of the other matching positions
+        for (; matching_positions_itr != location_itr->second.end(); ++matching_positions_itr) {
+
+          // keep iterating and editing the same object until a we get to a different submission
+          if (matching_positions_itr->submission != other_submission
+              || other.matchingpositions.size() >= (unsigned int) max_matching_positions) {
+
+            // found a different one, we push the old one and start over
+            info.others.push_back(other);
+
+            if (other.matchingpositions.size() >= (unsigned int) max_matching_positions) {
+              truncations[*other.username + std::string(":") + std::to_string(other.version)]++;
+              break;
             }
-            position["start"] = matching_positions_itr->location;
-            position["end"] = matching_positions_itr->location + config.hash_size - 1;
-            matchingpositions.push_back(position);
+
+            other_submission = matching_positions_itr->submission;
+            startOther(other_submission);
           }
+          position.start = matching_positions_itr->location;
+          position.end = matching_positions_itr->location + config.hash_size - 1;
+          other.matchingpositions.push_back(position);
         }
-
-        other["matchingpositions"] = matchingpositions;
-        others.push_back(other);
       }
 
-      nlohmann::json info;
-      info["start"] = location_itr->first;
-      info["end"] = location_itr->first + config.hash_size - 1;
-      info["type"] = "match";
-      info["others"] = others;
-
-      result.push_back(info);
+      info.others.push_back(other);
+      addRegion(info);
     }
     // ****************************************************
 
 
     // ************* WRITE THE COMMON MATCHES *************
     // all of the common matches for this submission
-    std::set<location_in_submission> common_matches = (*submission_itr)->getCommonMatches();
+    const std::set<location_in_submission> &common_matches = curr_submission->getCommonMatches();
     for (std::set<location_in_submission>::const_iterator location_itr = common_matches.begin();
          location_itr != common_matches.end(); ++location_itr) {
 
-      nlohmann::json info;
-      info["start"] = *location_itr;
-      info["end"] = *location_itr + config.hash_size - 1;
-      info["type"] = "common";
+      MatchRegion info;
+      info.start = *location_itr;
+      info.end = *location_itr + config.hash_size - 1;
+      info.type = REGION_COMMON;
 
-      result.push_back(info);
+      addRegion(info);
     }
     // ****************************************************
 
 
     // *********** WRITE THE PROVIDED MATCHES *************
     // all of the provided code matches for this submission
-    std::set<location_in_submission> provided_matches = (*submission_itr)->getProvidedMatches();
+    const std::set<location_in_submission> &provided_matches = curr_submission->getProvidedMatches();
     for (std::set<location_in_submission>::const_iterator location_itr = provided_matches.begin();
          location_itr != provided_matches.end(); ++location_itr) {
 
-      nlohmann::json info;
-      info["start"] = *location_itr;
-      info["end"] = *location_itr + config.hash_size - 1;
-      info["type"] = "provided";
+      MatchRegion info;
+      info.start = *location_itr;
+      info.end = *location_itr + config.hash_size - 1;
+      info.type = REGION_PROVIDED;
 
-      result.push_back(info);
+      addRegion(info);
     }
     // ****************************************************
 
+    if (has_prev) {
+      counter.add(prevPosition);
+      writer.write(prevPosition);
+    }
+    writer.close();
+    bytes_written = writer.bytesWritten();
 
-    // =========================================================================
-    // Done creating the JSON file/objects, now we merge them to shrink them in size
-
-    // Merge matching regions:
-    if (!result.empty()) { // check to make sure that there are more than 1 positions (if it's 1, we can't merge anyway)
-      // loop through all positions
-      for (unsigned int position = 1; position < result.size(); position++) {
-        nlohmann::json* prevPosition = &result[position - 1];
-        nlohmann::json* currPosition = &result[position];
-        // check whether they are next to each other and have the same type
-        if ((*currPosition)["end"].get<int>() == (*prevPosition)["end"].get<int>() + 1 && (*currPosition)["type"] == (*prevPosition)["type"]) {
-          bool canBeMerged = true;
-
-          // if they are both of type match, we have to do extra steps to make sure they are mergeable
-          if ((*prevPosition)["type"] == "match") {
-            // easy check to see if they can't be merged for certain
-            if ((*prevPosition)["others"].size() != (*currPosition)["others"].size()) {
-              canBeMerged = false;
-            }
-            else {
-              nlohmann::json::iterator prevPosItr = (*prevPosition)["others"].begin();
-              nlohmann::json::iterator currPosItr = (*currPosition)["others"].begin();
-              for (; prevPosItr != (*prevPosition)["others"].end() && currPosItr != (*currPosition)["others"].end(); prevPosItr++, currPosItr++) {
-                // we can't merge the two positions if they are different in any way, except for the ending positions
-                if ((*prevPosItr)["username"] != (*currPosItr)["username"] ||
-                    (*prevPosItr)["version"] != (*currPosItr)["version"] ||
-                    (*prevPosItr)["source_gradeable"] != (*currPosItr)["source_gradeable"] ||
-                    !matchingPositionsAreAdjacent((*prevPosItr), (*currPosItr))) {
-                  canBeMerged = false;
-                  break;
-                }
-              }
-            }
+    counter.summarize(summary);
+    return summary;
+  };
+
+  // ===========================================================================
+  // LOOKING UP THE PARTITIONS
+
+  // If the hashes were split into partitions, the partitions are loaded in batches of
+  // consecutive hash ranges which fit in the memory budget.  Whatever is found for each of this
+  // gradeable's hashes in a batch is written to disk, sorted by submission, so that it can be
+  // read back below one submission at a time.  The files written for each batch, in order:
+  std::vector<std::vector<boost::filesystem::path>> event_files;
+  if (partitions != nullptr) {
+    metrics.startPhase("look up partitions");
+    unsigned long long max_postings = std::max(1ULL, memory_budget / BYTES_PER_POSTING);
+    unsigned long long largest_batch = 0;
+    for (unsigned int first = 0; first < partitions->count();) {
+      // add partitions to the batch until the next one would go over the budget.  A partition
+      // which doesn't fit on its own is still looked up, in a batch by itself.
+      unsigned long long batch_postings = partitions->size(first);
+      unsigned int last = first + 1;
+      while (last < partitions->count() && batch_postings + partitions->size(last) <= max_postings) {
+        batch_postings += partitions->size(last);
+        last++;
+      }
+      largest_batch = std::max(largest_batch, batch_postings);
+
+      HashIndex this_index;
+      HashIndex other_index;
+      std::vector<PartitionPosting> lookups;
+      {
+        std::vector<PartitionPosting> postings;
+        for (unsigned int p = first; p < last; p++) {
+          partitions->take(p, postings);
+        }
+        for (std::vector<PartitionPosting>::const_iterator itr = postings.begin(); itr != postings.end(); ++itr) {
+          if (itr->ordinal == NOT_LOOKED_UP) {
+            other_index.add(itr->h, itr->submission, itr->location);
+          } else {
+            this_index.add(itr->h, itr->submission, itr->location);
+            lookups.push_back(*itr);
+          }
+        }
+      }
+      this_index.build();
+      other_index.build();
+      findCommonCode(this_index);
+      std::sort(lookups.begin(), lookups.end(), [](const PartitionPosting &a, const PartitionPosting &b) {
+        return std::tie(a.submission, a.ordinal) < std::tie(b.submission, b.ordinal);
+      });
+
+      // each thread looks up a contiguous share of the sorted hashes and writes its own file,
+      // so that the batch's files can be read back in order as a single sorted sequence
+      std::vector<boost::filesystem::path> files;
+      for (int t = 0; t < threads; t++) {
+        files.push_back(lichen_gradeable_path / "hash_partitions" / ("events_" + std::to_string(event_files.size()) + "_" + std::to_string(t) + ".bin"));
+      }
+      runOnThreads(threads, [&](int t) {
+        std::ofstream ostr(files[t].string(), std::ios::binary);
+        MatchEvent event;
+        for (size_t i = lookups.size() * t / threads; i < lookups.size() * (t + 1) / threads; i++) {
+          event.matches.clear();
+          matchHash(lookups[i].h, submissions[lookups[i].submission].student, this_index, other_index, event.matches);
+          if (!event.matches.empty()) {
+            event.submission = lookups[i].submission;
+            event.ordinal = lookups[i].ordinal;
+            event.location = lookups[i].location;
+            writeMatchEvent(ostr, event);
           }
+        }
+        assert(ostr.good());
+      });
+      event_files.push_back(files);
+      first = last;
+    }
 
-          //if it's possible to do the merging, do it here by adjusting the end of the previous position and erasing the current position
-          if (canBeMerged && (*prevPosition)["type"] == "match") {
-            (*prevPosition)["end"] = (*currPosition)["end"].get<int>(); // (should be the equivalent of prevPosition["end"]++)
+    diff = metrics.endPhase("look up partitions");
+    std::cout << "Looked up " << partitions->count() << " hash partitions in " << event_files.size() << " batches in " << diff << " seconds" << std::endl;
+    nlohmann::json partition_stats;
+    partition_stats["memory_budget_bytes"] = memory_budget;
+    partition_stats["partitions"] = partitions->count();
+    partition_stats["batches"] = event_files.size();
+    partition_stats["largest_batch_postings"] = largest_batch;
+    metrics.set("hash_partitions", partition_stats);
+  }
 
-            // increment end positions for each element
-            incrementEndPositionsForMatches((*prevPosition)["others"]);
+  // readers of the files written for each batch, which are shared by every thread
+  std::vector<MatchEventReader*> event_readers;
+  for (std::vector<std::vector<boost::filesystem::path>>::const_iterator itr = event_files.begin(); itr != event_files.end(); ++itr) {
+    event_readers.push_back(new MatchEventReader(*itr));
+  }
 
-            result.erase(result.begin() + position);
-            position--;
-          }
-          else if (canBeMerged) { // common code or provided code that can be matched
-            (*prevPosition)["end"] = (*currPosition)["end"].get<int>();
+  // Each thread repeatedly takes the next submission which hasn't been compared yet.  Every
+  // submission writes its own matches.json, so the output doesn't depend on the number of
+  // threads.  Truncations are counted per thread and summed once each thread is done.
+  std::atomic<unsigned int> next_submission(0);
+  std::mutex events_mutex;
+
+  // returns the next submission which hasn't been compared yet with all of its matches found,
+  // or nullptr once every submission has been taken
+  auto takeSubmission = [&]() -> Submission* {
+    if (partitions == nullptr) {
+      unsigned int i = next_submission++;
+      if (i >= all_submissions.size()) {
+        return nullptr;
+      }
+      Submission* curr_submission = all_submissions[i];
+      all_submissions[i] = nullptr;
+      findMatches(curr_submission);
+      return curr_submission;
+    }
 
-            result.erase(result.begin() + position);
-            position--;
-          }
+    // the submissions are taken in increasing order, which is the order of each batch's events
+    std::vector<MatchEvent> events;
+    submission_id id;
+    {
+      std::lock_guard<std::mutex> lock(events_mutex);
+      if (next_submission >= this_gradeable_ids.size()) {
+        return nullptr;
+      }
+      id = this_gradeable_ids[next_submission++];
+      submission_id event_submission;
+      for (std::vector<MatchEventReader*>::iterator itr = event_readers.begin(); itr != event_readers.end(); ++itr) {
+        while ((*itr)->peek(event_submission) && event_submission == id) {
+          events.push_back(MatchEvent());
+          (*itr)->next(events.back());
         }
       }
     }
 
-    // save the file with matches per user
-    nlohmann::json match_data = result;
-    boost::filesystem::path submission_dir = users_root_directory / (*submission_itr)->student() / std::to_string((*submission_itr)->version());
-    boost::filesystem::create_directories(submission_dir);
-    boost::filesystem::path matches_file = submission_dir / "matches.json";
-    std::ofstream ostr(matches_file.string());
-    assert(ostr.good());
-    ostr << match_data.dump(4) << std::endl;
+    // add the matches in the order of the submission's hashes, as they would have been found
+    // with every hash in memory
+    std::sort(events.begin(), events.end(), [](const MatchEvent &a, const MatchEvent &b) {
+      return a.ordinal < b.ordinal;
+    });
+    Submission* curr_submission = new Submission(id, config);
+    for (std::vector<MatchEvent>::const_iterator itr = events.begin(); itr != events.end(); ++itr) {
+      curr_submission->addMatches(itr->location, itr->matches);
+    }
+    return curr_submission;
+  };
 
-    // =========================================================================
-    // Cleanup
-
-    // Done with this submission. discard the data and clear the memory
-    delete (*submission_itr);
-    (*submission_itr) = nullptr;
-
-    // Print current progress
-    my_counter++;
-    if (int((my_counter / float(all_submissions.size())) * 100) > my_percent) {
-      int new_my_percent = int((my_counter / float(all_submissions.size())) * 100);
-      for (int i=0; i < new_my_percent - my_percent; i++) {
-        std::cout << "|";
+  // Used to calculate current progress (printed to the log)
+  int my_counter = 0;
+  int my_percent = 0;
+  metrics.startPhase("compare");
+
+  std::cout << "[0%                      25%                     50%                     75%                     100%]" << std::endl << "[";
+  fflush(stdout);
+
+  // the summary of each submission in this gradeable, by submission_id
+  std::vector<nlohmann::json> summaries(submissions.size());
+  std::mutex progress_mutex;
+  runOnThreads(threads, [&](int) {
+    std::map<std::string, int> truncations;
+    while (true) {
+      std::chrono::steady_clock::time_point submission_start = std::chrono::steady_clock::now();
+      Submission* curr_submission = takeSubmission();
+      if (curr_submission == nullptr) {
+        break;
+      }
+      unsigned long long matches_bytes = 0;
+      summaries[curr_submission->id()] = writeMatches(curr_submission, truncations, matches_bytes);
+      std::chrono::duration<double> seconds = std::chrono::steady_clock::now() - submission_start;
+
+      const SubmissionInfo &info = submissions[curr_submission->id()];
+      nlohmann::json counts;
+      counts["hashes"] = hash_counts[curr_submission->id()];
+      counts["suspicious_locations"] = curr_submission->getSuspiciousMatches().size();
+      counts["common_locations"] = curr_submission->getCommonMatches().size();
+      counts["provided_locations"] = curr_submission->getProvidedMatches().size();
+      counts["matches_bytes"] = matches_bytes;
+
+      // Done with this submission. discard the data and clear the memory
+      delete curr_submission;
+
+      // Print current progress
+      std::lock_guard<std::mutex> lock(progress_mutex);
+      metrics.addSubmission("users/" + student_names[info.student] + "/" + std::to_string(info.version), seconds.count(), counts);
+      my_counter++;
+      if (int((my_counter / float(this_gradeable_ids.size())) * 100) > my_percent) {
+        int new_my_percent = int((my_counter / float(this_gradeable_ids.size())) * 100);
+        for (int j=0; j < new_my_percent - my_percent; j++) {
+          std::cout << "|";
+        }
+        fflush(stdout);
+        my_percent = new_my_percent;
       }
-      fflush(stdout);
-      my_percent = new_my_percent;
     }
-  }
+
+    std::lock_guard<std::mutex> lock(progress_mutex);
+    for (std::map<std::string, int>::const_iterator itr = truncations.begin(); itr != truncations.end(); itr++) {
+      matching_positions_truncations[itr->first] += itr->second;
+    }
+  });
 
   // Finish printing any remaining portion of the progress bar
   for (int i=0; i < 100 - my_percent; i++) {
     std::cout << "|";
   }
 
-  time(&end);
-  diff = difftime(end, start);
+  metrics.endPhase("compare");
   std::cout << "]" << std::endl;
 
+  // write the summary of every submission, which similarity_ranking.py ranks them by
+  nlohmann::json match_summary;
+  match_summary["hash_size"] = config.hash_size;
+  match_summary["submissions"] = nlohmann::json::array();
+  for (std::vector<submission_id>::const_iterator itr = this_gradeable_ids.begin(); itr != this_gradeable_ids.end(); ++itr) {
+    match_summary["submissions"].push_back(summaries[*itr]);
+  }
+  std::ofstream summary_ostr((lichen_gradeable_path / "match_summary.json").string());
+  assert(summary_ostr.good());
+  summary_ostr << match_summary.dump() << std::endl;
+
+  // write the common code found in this gradeable, so that later runs can reuse it
+  std::sort(found_common_code.begin(), found_common_code.end());
+  boost::filesystem::create_directories(lichen_gradeable_path / "common_code");
+  bool common_code_written = writeHashes(lichen_gradeable_path / "common_code", found_common_code);
+  assert(common_code_written);
+  nlohmann::json common_code_stats;
+  common_code_stats["found"] = found_common_code.size();
+  common_code_stats["imported"] = imported_common_code;
+  metrics.set("common_code", common_code_stats);
+
   // Print out the list of users who had their matching positions array truncated
   if (matching_positions_truncations.size() > 0) {
     std::cout << "Matching positions array truncated for user(s): ";
-    for (std::unordered_map<std::string, int>::const_iterator itr = matching_positions_truncations.begin();
+    for (std::map<std::string, int>::const_iterator itr = matching_positions_truncations.begin();
         itr != matching_positions_truncations.end(); itr++) {
       std::cout << itr->first << " (" << itr->second << "), ";
     }
     std::cout << std::endl << "  - Try increasing the hash size or adding a regex to fix this problem." << std::endl;
   }
 
+  for (std::vector<HashIndex*>::iterator itr = attached_indexes.begin(); itr != attached_indexes.end(); ++itr) {
+    delete *itr;
+  }
+  for (std::vector<MatchEventReader*>::iterator itr = event_readers.begin(); itr != event_readers.end(); ++itr) {
+    delete *itr;
+  }
+  if (partitions != nullptr) {
+    delete partitions;
+    boost::filesystem::remove_all(lichen_gradeable_path / "hash_partitions");
+  }
+
   // ===========================================================================
   // Done!
 
-  time(&overall_end);
-  double overall_diff = difftime(overall_end, overall_start);
-  std::cout << "Hash comparison done in " << overall_diff << " seconds" << std::endl;
+  metrics.write(lichen_gradeable_path.string());
+  std::cout << "Hash comparison done in " << metrics.elapsedSeconds() << " seconds" << std::endl;
 }
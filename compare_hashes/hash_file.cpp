@@ -0,0 +1,207 @@
+#include <algorithm>
+#include <cstring>
+#include <cstdint>
+#include <fstream>
+#include <iomanip>
+#include <iterator>
+#include <string>
+#include <vector>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "boost/filesystem/operations.hpp"
+#include "boost/filesystem/path.hpp"
+
+#include "hash_file.h"
+
+typedef int location_in_submission;
+typedef unsigned int hash;
+
+// the fixed size header at the start of every hashes.bin file
+struct HashFileHeader {
+  char magic[4];
+  uint16_t version;
+  uint8_t hash_width;
+  uint8_t flags;
+  uint32_t hash_size;
+  uint32_t sequences;
+};
+
+static const char HASH_FILE_MAGIC[4] = {'L', 'H', 'S', 'H'};
+static const uint16_t HASH_FILE_VERSION = 1;
+// set in the header's flags if the location of each hash is stored after the hashes
+static const uint8_t HASH_FILE_FLAG_LOCATIONS = 1;
+
+
+// memory maps a hashes.bin file and copies the packed hashes, and their locations and the
+// number of sequences hashed if the file has them, out of it
+static bool loadBinaryHashes(const boost::filesystem::path &hash_file, std::vector<hash> &hashes,
+                             std::vector<location_in_submission> &locations, unsigned int &sequences) {
+  int fd = open(hash_file.string().c_str(), O_RDONLY);
+  if (fd < 0) {
+    return false;
+  }
+  struct stat file_stat;
+  if (fstat(fd, &file_stat) != 0 || (size_t) file_stat.st_size < sizeof(HashFileHeader)) {
+    close(fd);
+    return false;
+  }
+  size_t file_size = file_stat.st_size;
+  void* data = mmap(NULL, file_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (data == MAP_FAILED) {
+    return false;
+  }
+
+  HashFileHeader header;
+  memcpy(&header, data, sizeof(HashFileHeader));
+  bool has_locations = header.flags & HASH_FILE_FLAG_LOCATIONS;
+  // each hash is followed by nothing, or by a 4 byte location in the array after the hashes
+  size_t entry_size = header.hash_width + (has_locations ? sizeof(uint32_t) : 0);
+  bool valid = memcmp(header.magic, HASH_FILE_MAGIC, sizeof(HASH_FILE_MAGIC)) == 0 &&
+               header.version == HASH_FILE_VERSION &&
+               (header.hash_width == 4 || header.hash_width == 8) &&
+               (file_size - sizeof(HashFileHeader)) % entry_size == 0;
+
+  if (valid) {
+    // hashes are stored little-endian, which is the byte order of every platform we build on
+    const char* values = static_cast<const char*>(data) + sizeof(HashFileHeader);
+    size_t count = (file_size - sizeof(HashFileHeader)) / entry_size;
+    hashes.reserve(hashes.size() + count);
+    if (header.hash_width == 4) {
+      const uint32_t* begin = reinterpret_cast<const uint32_t*>(values);
+      hashes.insert(hashes.end(), begin, begin + count);
+    }
+    else {
+      const uint64_t* begin = reinterpret_cast<const uint64_t*>(values);
+      for (size_t i = 0; i < count; i++) {
+        hashes.push_back((hash) begin[i]);
+      }
+    }
+
+    if (has_locations) {
+      const uint32_t* begin = reinterpret_cast<const uint32_t*>(values + count * header.hash_width);
+      locations.insert(locations.end(), begin, begin + count);
+      sequences = header.sequences;
+    }
+    else {
+      sequences = count;
+    }
+  }
+
+  munmap(data, file_size);
+  return valid;
+}
+
+
+// parses a hashes.txt file, which has one hex hash per line, optionally followed by a space and
+// its decimal location.  Lines starting with # are comments, except for the "# sequences <count>"
+// line which files with locations start with.
+static bool loadHexHashes(const boost::filesystem::path &hash_file, std::vector<hash> &hashes,
+                          std::vector<location_in_submission> &locations, unsigned int &sequences) {
+  std::ifstream istr(hash_file.string(), std::ios::binary);
+  if (!istr.good()) {
+    return false;
+  }
+  const std::string contents((std::istreambuf_iterator<char>(istr)), std::istreambuf_iterator<char>());
+
+  size_t hashes_before = hashes.size();
+  size_t locations_before = locations.size();
+  const std::string sequences_comment = "# sequences ";
+  bool has_sequences = false;
+  std::string::const_iterator itr = contents.begin();
+  while (itr != contents.end()) {
+    std::string::const_iterator line_end = std::find(itr, contents.end(), '\n');
+    if (*itr == '#') {
+      if (std::string(itr, line_end).compare(0, sequences_comment.size(), sequences_comment) == 0) {
+        sequences = std::stoul(std::string(itr + sequences_comment.size(), line_end));
+        has_sequences = true;
+      }
+      itr = line_end;
+    }
+
+    uint64_t value = 0;
+    bool in_hash = false;
+    for (; itr != line_end && *itr != ' ' && *itr != '\r'; ++itr) {
+      char c = *itr;
+      int digit;
+      if (c >= '0' && c <= '9') {
+        digit = c - '0';
+      }
+      else if (c >= 'a' && c <= 'f') {
+        digit = c - 'a' + 10;
+      }
+      else if (c >= 'A' && c <= 'F') {
+        digit = c - 'A' + 10;
+      }
+      else {
+        return false;
+      }
+      value = (value << 4) | digit;
+      in_hash = true;
+    }
+    if (in_hash) {
+      hashes.push_back((hash) value);
+    }
+
+    if (itr != line_end && *itr == ' ') {
+      location_in_submission location = 0;
+      bool in_location = false;
+      for (++itr; itr != line_end && *itr >= '0' && *itr <= '9'; ++itr) {
+        location = location * 10 + (*itr - '0');
+        in_location = true;
+      }
+      if (!in_hash || !in_location) {
+        return false;
+      }
+      locations.push_back(location);
+    }
+
+    if (itr != line_end && *itr != '\r') {
+      return false;
+    }
+    itr = line_end == contents.end() ? line_end : line_end + 1;
+  }
+
+  if (!has_sequences) {
+    sequences = hashes.size() - hashes_before;
+  }
+
+  // either every hash has a location or none of them do
+  size_t num_locations = locations.size() - locations_before;
+  return num_locations == 0 || num_locations == hashes.size() - hashes_before;
+}
+
+
+bool hashesFileExists(const boost::filesystem::path &directory) {
+  return boost::filesystem::exists(directory / "hashes.bin") ||
+         boost::filesystem::exists(directory / "hashes.txt");
+}
+
+
+bool loadHashes(const boost::filesystem::path &directory, std::vector<hash> &hashes,
+                std::vector<location_in_submission> &locations, unsigned int &sequences) {
+  boost::filesystem::path binary_file = directory / "hashes.bin";
+  if (boost::filesystem::exists(binary_file)) {
+    return loadBinaryHashes(binary_file, hashes, locations, sequences);
+  }
+  return loadHexHashes(directory / "hashes.txt", hashes, locations, sequences);
+}
+
+bool writeHashes(const boost::filesystem::path &directory, const std::vector<hash> &hashes) {
+  std::ofstream ostr((directory / "hashes.txt").string());
+  if (!ostr.good()) {
+    return false;
+  }
+  ostr << std::hex << std::setfill('0');
+  for (std::vector<hash>::const_iterator itr = hashes.begin(); itr != hashes.end(); ++itr) {
+    if (itr != hashes.begin()) {
+      ostr << '\n';
+    }
+    ostr << std::setw(8) << *itr;
+  }
+  return ostr.good();
+}
@@ -0,0 +1,30 @@
+#ifndef HASH_FILE_H
+#define HASH_FILE_H
+
+#include <vector>
+
+#include "boost/filesystem/path.hpp"
+
+typedef int location_in_submission;
+typedef unsigned int hash;
+
+// returns true if the directory contains a hashes.bin or hashes.txt file
+bool hashesFileExists(const boost::filesystem::path &directory);
+
+// reads the hashes of a single submission from the directory's hashes.bin file if it
+// has one, or from its hashes.txt file otherwise (see common/hash_file.py for both
+// formats).  Hashes wider than 32 bits are truncated to their low 32 bits.
+// If the file stores the location of each hash (as it does for winnowed fingerprints),
+// they are read into locations.  Otherwise locations is left as is, and the hash at
+// index i is at location i + 1.
+// sequences is set to the number of sequences hashed, which is the number of hashes unless
+// only some of them were kept.
+// Returns false if the file is missing or malformed.
+bool loadHashes(const boost::filesystem::path &directory, std::vector<hash> &hashes,
+                std::vector<location_in_submission> &locations, unsigned int &sequences);
+
+// writes hashes to the directory's hashes.txt file, one 8 character hex hash per line, in the
+// same format as hash_all.py.  Returns false if the file can't be written.
+bool writeHashes(const boost::filesystem::path &directory, const std::vector<hash> &hashes);
+
+#endif
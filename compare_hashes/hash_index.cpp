@@ -0,0 +1,146 @@
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <utility>
+#include <vector>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "nlohmann/json.hpp"
+
+#include "hash_index.h"
+
+typedef int location_in_submission;
+typedef unsigned int hash;
+typedef unsigned int submission_id;
+
+// the fixed size header at the start of every fingerprint index
+struct HashIndexHeader {
+  char magic[4];
+  uint16_t version;
+  uint16_t reserved;
+  uint32_t num_submissions;
+  uint32_t num_keys;
+  uint32_t num_postings;
+  uint32_t names_size;
+  uint64_t reserved2;
+};
+
+static const char HASH_INDEX_MAGIC[4] = {'L', 'I', 'D', 'X'};
+static const uint16_t HASH_INDEX_VERSION = 2;
+
+// postings are mapped straight from the file's array of (uint32, int32) pairs
+static_assert(sizeof(HashLocation) == 8, "HashLocation must match the fingerprint index layout");
+static_assert(sizeof(IndexedHash) == 8, "IndexedHash must match the fingerprint index layout");
+
+
+HashIndex::HashIndex() : keys(nullptr), num_keys(0), offsets(nullptr), postings(nullptr),
+                         submission_offsets(nullptr), forward(nullptr), mapping(nullptr),
+                         mapping_size(0) {}
+
+HashIndex::~HashIndex() {
+  if (mapping != nullptr) {
+    munmap(mapping, mapping_size);
+  }
+}
+
+void HashIndex::add(hash h, submission_id submission, location_in_submission location) {
+  unsorted.push_back(std::make_pair(h, HashLocation(submission, location)));
+}
+
+void HashIndex::build() {
+  // postings were added in (submission, location) order, so a stable sort on the hash alone
+  // leaves each hash's postings in that order
+  std::stable_sort(unsorted.begin(), unsorted.end(),
+                   [](const std::pair<hash, HashLocation> &a, const std::pair<hash, HashLocation> &b) {
+                     return a.first < b.first;
+                   });
+
+  keys_storage.clear();
+  offsets_storage.clear();
+  postings_storage.clear();
+  postings_storage.reserve(unsorted.size());
+  for (std::vector<std::pair<hash, HashLocation>>::const_iterator itr = unsorted.begin(); itr != unsorted.end(); ++itr) {
+    if (keys_storage.empty() || keys_storage.back() != itr->first) {
+      keys_storage.push_back(itr->first);
+      offsets_storage.push_back(postings_storage.size());
+    }
+    postings_storage.push_back(itr->second);
+  }
+  offsets_storage.push_back(postings_storage.size());
+
+  // release the memory used while building
+  std::vector<std::pair<hash, HashLocation>>().swap(unsorted);
+
+  keys = keys_storage.data();
+  num_keys = keys_storage.size();
+  offsets = offsets_storage.data();
+  postings = postings_storage.data();
+}
+
+bool HashIndex::map(const std::string &path, std::vector<std::pair<user_id, version_number>> &names) {
+  int fd = open(path.c_str(), O_RDONLY);
+  if (fd < 0) {
+    return false;
+  }
+  struct stat file_stat;
+  if (fstat(fd, &file_stat) != 0 || (size_t) file_stat.st_size < sizeof(HashIndexHeader)) {
+    close(fd);
+    return false;
+  }
+  size_t file_size = file_stat.st_size;
+  void* data = mmap(NULL, file_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (data == MAP_FAILED) {
+    return false;
+  }
+
+  HashIndexHeader header;
+  memcpy(&header, data, sizeof(HashIndexHeader));
+  // the arrays are stored little-endian, which is the byte order of every platform we build on
+  size_t keys_start = sizeof(HashIndexHeader);
+  size_t offsets_start = keys_start + (size_t) header.num_keys * sizeof(uint32_t);
+  size_t postings_start = offsets_start + ((size_t) header.num_keys + 1) * sizeof(uint32_t);
+  size_t submission_offsets_start = postings_start + (size_t) header.num_postings * sizeof(HashLocation);
+  size_t forward_start = submission_offsets_start + ((size_t) header.num_submissions + 1) * sizeof(uint32_t);
+  size_t names_start = forward_start + (size_t) header.num_postings * sizeof(IndexedHash);
+  if (memcmp(header.magic, HASH_INDEX_MAGIC, sizeof(HASH_INDEX_MAGIC)) != 0 ||
+      header.version != HASH_INDEX_VERSION ||
+      names_start + header.names_size != file_size) {
+    munmap(data, file_size);
+    return false;
+  }
+
+  const char* bytes = static_cast<const char*>(data);
+  nlohmann::json names_json = nlohmann::json::parse(bytes + names_start, bytes + file_size, nullptr, false);
+  if (!names_json.is_array() || names_json.size() != header.num_submissions) {
+    munmap(data, file_size);
+    return false;
+  }
+  for (nlohmann::json::const_iterator itr = names_json.begin(); itr != names_json.end(); ++itr) {
+    names.push_back(std::make_pair((*itr)[0].get<user_id>(), (*itr)[1].get<version_number>()));
+  }
+
+  mapping = data;
+  mapping_size = file_size;
+  keys = reinterpret_cast<const hash*>(bytes + keys_start);
+  num_keys = header.num_keys;
+  offsets = reinterpret_cast<const unsigned int*>(bytes + offsets_start);
+  postings = reinterpret_cast<const HashLocation*>(bytes + postings_start);
+  submission_offsets = reinterpret_cast<const unsigned int*>(bytes + submission_offsets_start);
+  forward = reinterpret_cast<const IndexedHash*>(bytes + forward_start);
+  return true;
+}
+
+std::pair<const HashLocation*, const HashLocation*> HashIndex::find(hash h) const {
+  const hash* key = std::lower_bound(keys, keys + num_keys, h);
+  if (key == keys + num_keys || *key != h) {
+    return std::make_pair(nullptr, nullptr);
+  }
+  unsigned int i = key - keys;
+  return std::make_pair(postings + offsets[i], postings + offsets[i + 1]);
+}
@@ -0,0 +1,88 @@
+#ifndef HASH_INDEX_H
+#define HASH_INDEX_H
+
+#include <string>
+#include <utility>
+#include <vector>
+
+#include "hash_location.h"
+
+typedef int location_in_submission;
+typedef unsigned int hash;
+typedef unsigned int submission_id;
+typedef std::string user_id;
+typedef unsigned int version_number;
+
+// a hash of a submission and its location, as a fingerprint index stores each submission's
+// hashes
+struct IndexedHash {
+  hash h;
+  location_in_submission location;
+};
+
+// An inverted index from each hash to every place it occurs, stored in compressed
+// sparse row form: a sorted array of the distinct hashes, and for each one a
+// contiguous run of its postings ordered by submission and then location.
+//
+// An index is either built in memory, by adding hashes while loading submissions and
+// calling build() once they are all loaded, or memory mapped from a fingerprint index
+// written by hash_all.py (see common/fingerprint_index.py).  Either way it is read-only
+// once it is ready.  A mapped index also holds the hashes of each of its submissions in
+// order, so that some of its submissions can be loaded without reading the others.
+class HashIndex {
+public:
+  HashIndex();
+  ~HashIndex();
+
+  // MODIFIERS
+  // postings must be added in increasing order of submission, and of location within each
+  // submission
+  void add(hash h, submission_id submission, location_in_submission location);
+  void build();
+  // maps the fingerprint index at path, storing the user and version of each of its
+  // submissions in names.  The submissions in its postings are indexes into names.
+  // Returns false if the file is not a valid index.
+  bool map(const std::string &path, std::vector<std::pair<user_id, version_number>> &names);
+
+  // GETTERS
+  // the postings for a hash, as the range [begin, end), which is empty if it never occurs
+  std::pair<const HashLocation*, const HashLocation*> find(hash h) const;
+  // the number of distinct hashes, and the number of postings of the i-th smallest of them
+  unsigned int numKeys() const { return num_keys; }
+  unsigned int postingListLength(unsigned int i) const { return offsets[i + 1] - offsets[i]; }
+  // the i-th smallest hash, and its postings as the range [begin, end)
+  hash key(unsigned int i) const { return keys[i]; }
+  std::pair<const HashLocation*, const HashLocation*> postingList(unsigned int i) const { return std::make_pair(postings + offsets[i], postings + offsets[i + 1]); }
+  // the hashes of the i-th submission of a mapped index in order of location, as the range
+  // [begin, end)
+  std::pair<const IndexedHash*, const IndexedHash*> submissionHashes(unsigned int i) const { return std::make_pair(forward + submission_offsets[i], forward + submission_offsets[i + 1]); }
+
+private:
+  // an index may point into a memory mapping, so it can't be copied
+  HashIndex(const HashIndex &);
+  HashIndex& operator=(const HashIndex &);
+
+  // (hash, posting) pairs, only used until the index is built
+  std::vector<std::pair<hash, HashLocation>> unsorted;
+
+  // the arrays of an index built in memory
+  std::vector<hash> keys_storage;
+  std::vector<unsigned int> offsets_storage;
+  std::vector<HashLocation> postings_storage;
+
+  // the index's arrays, which are either the vectors above or in the mapped file.  The
+  // postings of keys[i] are postings[offsets[i]] to postings[offsets[i+1]]
+  const hash* keys;
+  unsigned int num_keys;
+  const unsigned int* offsets;
+  const HashLocation* postings;
+  // the hashes of the i-th submission of a mapped index are forward[submission_offsets[i]]
+  // to forward[submission_offsets[i+1]]
+  const unsigned int* submission_offsets;
+  const IndexedHash* forward;
+
+  void* mapping;
+  size_t mapping_size;
+};
+
+#endif
@@ -1,29 +1,21 @@
 #ifndef HASH_LOCATION_H
 #define HASH_LOCATION_H
 
-#include <string>
-#include <unordered_map>
-
 typedef int location_in_submission;
-typedef unsigned int hash;
-typedef std::string user_id;
-typedef unsigned int version_number;
+typedef unsigned int submission_id;
 
-// represents the location of a hash within
-// a unique student and version pair
+// represents the location of a hash within a submission, which is identified by its
+// index in the table of every submission compare_hashes loaded
 struct HashLocation {
-  HashLocation(const user_id &s, version_number v, location_in_submission l, const std::string &sg) : student(s), version(v), location(l), source_gradeable(sg) {}
-  std::string student;
-  version_number version;
+  HashLocation(submission_id s, location_in_submission l) : submission(s), location(l) {}
+  submission_id submission;
   location_in_submission location;
-  std::string source_gradeable;
 };
 
 // inline keyword is necessary to prevent linker errors when multiple .cpp files include this header and are then linked
 inline bool operator < (const HashLocation &hl1, const HashLocation &hl2) {
-  return hl1.student > hl2.student ||
-         (hl1.student == hl2.student && hl1.version < hl2.version) ||
-         (hl1.student == hl2.student && hl1.version == hl2.version && hl1.location < hl2.location);
+  return hl1.submission < hl2.submission ||
+         (hl1.submission == hl2.submission && hl1.location < hl2.location);
 }
 
 #endif
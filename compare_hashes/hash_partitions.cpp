@@ -0,0 +1,140 @@
+#include <cassert>
+#include <cstdint>
+#include <fstream>
+#include <string>
+#include <vector>
+
+#include "boost/filesystem/operations.hpp"
+#include "boost/filesystem/path.hpp"
+
+#include "hash_partitions.h"
+
+typedef int location_in_submission;
+typedef unsigned int hash;
+typedef unsigned int submission_id;
+
+// the number of postings buffered for each partition before they are written to its file
+static const unsigned int PARTITION_BUFFER_POSTINGS = 256;
+
+// the fixed size part of a match event, which is followed by its suspicious matches
+struct MatchEventHeader {
+  uint32_t submission;
+  uint32_t ordinal;
+  int32_t location;
+  uint8_t provided;
+  uint8_t common;
+  uint16_t reserved;
+  uint32_t suspicious;
+};
+
+// events and postings are written to disk as they are laid out in memory, and read back by
+// the same process
+static_assert(sizeof(PartitionPosting) == 16, "PartitionPosting must not be padded");
+static_assert(sizeof(MatchEventHeader) == 20, "MatchEventHeader must not be padded");
+
+
+HashPartitions::HashPartitions(const boost::filesystem::path &d, unsigned int count)
+  : directory(d), buffers(count), sizes(count, 0) {
+  boost::filesystem::remove_all(directory);
+  boost::filesystem::create_directories(directory);
+}
+
+void HashPartitions::add(hash h, submission_id submission, location_in_submission location, unsigned int ordinal) {
+  // each partition holds a contiguous range of hashes
+  unsigned int p = ((unsigned long long) h * sizes.size()) >> 32;
+  PartitionPosting posting = {h, submission, location, ordinal};
+  buffers[p].push_back(posting);
+  sizes[p]++;
+  if (buffers[p].size() >= PARTITION_BUFFER_POSTINGS) {
+    flush(p);
+  }
+}
+
+void HashPartitions::flush() {
+  for (unsigned int p = 0; p < buffers.size(); p++) {
+    flush(p);
+  }
+}
+
+void HashPartitions::flush(unsigned int p) {
+  if (buffers[p].empty()) {
+    return;
+  }
+  std::ofstream ostr(file(p).string(), std::ios::binary | std::ios::app);
+  ostr.write(reinterpret_cast<const char*>(buffers[p].data()), buffers[p].size() * sizeof(PartitionPosting));
+  assert(ostr.good());
+  buffers[p].clear();
+}
+
+void HashPartitions::take(unsigned int p, std::vector<PartitionPosting> &postings) {
+  if (sizes[p] == 0) {
+    return;
+  }
+  size_t start = postings.size();
+  postings.resize(start + sizes[p]);
+  std::ifstream istr(file(p).string(), std::ios::binary);
+  istr.read(reinterpret_cast<char*>(postings.data() + start), sizes[p] * sizeof(PartitionPosting));
+  assert(istr.good());
+  istr.close();
+  boost::filesystem::remove(file(p));
+}
+
+boost::filesystem::path HashPartitions::file(unsigned int p) const {
+  return directory / ("partition_" + std::to_string(p) + ".bin");
+}
+
+
+void writeMatchEvent(std::ofstream &ostr, const MatchEvent &event) {
+  MatchEventHeader header = {event.submission, event.ordinal, event.location,
+                             event.matches.provided, event.matches.common, 0,
+                             (uint32_t) event.matches.suspicious.size()};
+  ostr.write(reinterpret_cast<const char*>(&header), sizeof(header));
+  ostr.write(reinterpret_cast<const char*>(event.matches.suspicious.data()), event.matches.suspicious.size() * sizeof(HashLocation));
+}
+
+
+MatchEventReader::MatchEventReader(const std::vector<boost::filesystem::path> &f)
+  : files(f), next_file(0), has_event(false) {
+  has_event = readEvent();
+}
+
+bool MatchEventReader::peek(submission_id &submission) {
+  if (has_event) {
+    submission = event.submission;
+  }
+  return has_event;
+}
+
+bool MatchEventReader::next(MatchEvent &e) {
+  if (!has_event) {
+    return false;
+  }
+  e = event;
+  has_event = readEvent();
+  return true;
+}
+
+bool MatchEventReader::readEvent() {
+  MatchEventHeader header;
+  while (!istr.is_open() || !istr.read(reinterpret_cast<char*>(&header), sizeof(header))) {
+    if (istr.is_open()) {
+      istr.close();
+    }
+    if (next_file == files.size()) {
+      return false;
+    }
+    istr.clear();
+    istr.open(files[next_file++].string(), std::ios::binary);
+    assert(istr.good());
+  }
+
+  event.submission = header.submission;
+  event.ordinal = header.ordinal;
+  event.location = header.location;
+  event.matches.provided = header.provided;
+  event.matches.common = header.common;
+  event.matches.suspicious.assign(header.suspicious, HashLocation(0, 0));
+  istr.read(reinterpret_cast<char*>(event.matches.suspicious.data()), header.suspicious * sizeof(HashLocation));
+  assert(istr.good());
+  return true;
+}
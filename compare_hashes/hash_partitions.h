@@ -0,0 +1,91 @@
+#ifndef HASH_PARTITIONS_H
+#define HASH_PARTITIONS_H
+
+#include <fstream>
+#include <vector>
+
+#include "boost/filesystem/path.hpp"
+
+#include "hash_location.h"
+#include "submission.h"
+
+typedef int location_in_submission;
+typedef unsigned int hash;
+typedef unsigned int submission_id;
+
+// a hash of a submission, as stored in a partition.  Hashes of this gradeable's submissions
+// are looked up, and are numbered by their position in the submission's hashes file so that
+// whatever is found for them can be added to the submission in the same order as they were
+// loaded.  Hashes of other gradeables are only looked up against.
+struct PartitionPosting {
+  hash h;
+  submission_id submission;
+  location_in_submission location;
+  unsigned int ordinal;
+};
+
+// the ordinal of a hash which isn't looked up
+static const unsigned int NOT_LOOKED_UP = 0xffffffff;
+
+// Splits the hashes of every submission by hash range into files on disk, so that
+// compare_hashes can look up one range of hashes at a time when every submission's hashes
+// won't fit in memory at once.  Postings are buffered for each partition and appended to
+// its file when the buffer fills, so only one file is open at a time.  Within a partition,
+// postings are stored in the order they were added.
+class HashPartitions {
+public:
+  HashPartitions(const boost::filesystem::path &directory, unsigned int count);
+
+  // MODIFIERS
+  void add(hash h, submission_id submission, location_in_submission location, unsigned int ordinal);
+  // writes out everything which is still buffered
+  void flush();
+  // appends the postings of partition p to postings, and deletes its file
+  void take(unsigned int p, std::vector<PartitionPosting> &postings);
+
+  // GETTERS
+  unsigned int count() const { return sizes.size(); }
+  // the number of postings in partition p
+  unsigned long long size(unsigned int p) const { return sizes[p]; }
+
+private:
+  boost::filesystem::path file(unsigned int p) const;
+  void flush(unsigned int p);
+
+  boost::filesystem::path directory;
+  std::vector<std::vector<PartitionPosting>> buffers;
+  std::vector<unsigned long long> sizes;
+};
+
+// something found for one of the hashes of this gradeable's submissions, which is written
+// out while looking up a partition and added to the submission once every partition is done
+struct MatchEvent {
+  submission_id submission;
+  unsigned int ordinal;
+  location_in_submission location;
+  HashMatches matches;
+};
+
+void writeMatchEvent(std::ofstream &ostr, const MatchEvent &event);
+
+// reads the match events written to a list of files, in order, as a single sequence
+class MatchEventReader {
+public:
+  explicit MatchEventReader(const std::vector<boost::filesystem::path> &files);
+
+  // returns true and sets submission to the submission of the next event, if there is one
+  bool peek(submission_id &submission);
+  // reads the next event, returning false if there are none left
+  bool next(MatchEvent &event);
+
+private:
+  bool readEvent();
+
+  std::vector<boost::filesystem::path> files;
+  unsigned int next_file;
+  std::ifstream istr;
+  bool has_event;
+  MatchEvent event;
+};
+
+#endif
@@ -1,6 +1,8 @@
 #ifndef LICHEN_CONFIG_H
 #define LICHEN_CONFIG_H
 
+#include <string>
+
 struct LichenConfig {
     std::string term;
     std::string course;
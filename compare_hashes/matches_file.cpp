@@ -0,0 +1,183 @@
+#include <cassert>
+#include <cstdint>
+#include <fstream>
+#include <string>
+
+#include "boost/filesystem/path.hpp"
+#include "nlohmann/json.hpp"
+
+#include "matches_file.h"
+
+static const char MATCHES_FILE_MAGIC[4] = {'L', 'M', 'A', 'T'};
+static const uint16_t MATCHES_FILE_VERSION = 1;
+
+// the name of each RegionType in JSON
+static const char* const REGION_TYPE_NAMES[] = {"match", "common", "provided"};
+
+
+bool parseMatchesFileFormat(const std::string &name, MatchesFileFormat &format) {
+  if (name == "json") {
+    format = MATCHES_JSON;
+  } else if (name == "ndjson") {
+    format = MATCHES_NDJSON;
+  } else if (name == "binary") {
+    format = MATCHES_BINARY;
+  } else {
+    return false;
+  }
+  return true;
+}
+
+std::string matchesFileName(MatchesFileFormat format) {
+  switch (format) {
+    case MATCHES_NDJSON:
+      return "matches.ndjson";
+    case MATCHES_BINARY:
+      return "matches.bin";
+    default:
+      return "matches.json";
+  }
+}
+
+
+MatchesWriter::MatchesWriter(const boost::filesystem::path &path, MatchesFileFormat f)
+  : ostr(path.string(), std::ios::binary), format(f), regions(0), bytes_written(0) {
+  assert(ostr.good());
+  if (format == MATCHES_JSON) {
+    writeRaw("[", 1);
+  } else if (format == MATCHES_BINARY) {
+    uint16_t reserved = 0;
+    writeRaw(MATCHES_FILE_MAGIC, sizeof(MATCHES_FILE_MAGIC));
+    writeRaw(&MATCHES_FILE_VERSION, sizeof(MATCHES_FILE_VERSION));
+    writeRaw(&reserved, sizeof(reserved));
+  }
+}
+
+MatchesWriter::~MatchesWriter() {
+  close();
+}
+
+void MatchesWriter::write(const MatchRegion &region) {
+  if (format == MATCHES_BINARY) {
+    writeBinaryRegion(region);
+  } else {
+    buffer.clear();
+    if (format == MATCHES_JSON && regions > 0) {
+      buffer += ',';
+    }
+    writeJSONRegion(region);
+    if (format == MATCHES_NDJSON) {
+      buffer += '\n';
+    }
+    writeString(buffer);
+  }
+  regions++;
+}
+
+void MatchesWriter::close() {
+  if (!ostr.is_open()) {
+    return;
+  }
+  if (format == MATCHES_JSON) {
+    writeRaw("]\n", 2);
+  }
+  ostr.close();
+}
+
+void MatchesWriter::writeRaw(const void* data, size_t size) {
+  ostr.write(reinterpret_cast<const char*>(data), size);
+  assert(ostr.good());
+  bytes_written += size;
+}
+
+void MatchesWriter::writeString(const std::string &s) {
+  writeRaw(s.data(), s.size());
+}
+
+// appends a string to the buffer as a JSON string.  Names are almost always plain ASCII, which
+// is written as is, and anything else is escaped by nlohmann.
+void MatchesWriter::writeJSONString(const std::string &s) {
+  for (std::string::const_iterator c = s.begin(); c != s.end(); ++c) {
+    if ((unsigned char) *c < 0x20 || *c == '"' || *c == '\\' || (unsigned char) *c >= 0x80) {
+      buffer += nlohmann::json(s).dump();
+      return;
+    }
+  }
+  buffer += '"';
+  buffer += s;
+  buffer += '"';
+}
+
+// appends a region to the buffer as a JSON object, with its keys sorted as nlohmann sorts them
+void MatchesWriter::writeJSONRegion(const MatchRegion &region) {
+  buffer += "{\"end\":";
+  buffer += std::to_string(region.end);
+  if (region.type == REGION_MATCH) {
+    buffer += ",\"others\":[";
+    for (std::vector<OtherSubmission>::const_iterator other = region.others.begin(); other != region.others.end(); ++other) {
+      if (other != region.others.begin()) {
+        buffer += ',';
+      }
+      buffer += "{\"matchingpositions\":[";
+      for (std::vector<MatchingPosition>::const_iterator position = other->matchingpositions.begin();
+           position != other->matchingpositions.end(); ++position) {
+        if (position != other->matchingpositions.begin()) {
+          buffer += ',';
+        }
+        buffer += "{\"end\":";
+        buffer += std::to_string(position->end);
+        buffer += ",\"start\":";
+        buffer += std::to_string(position->start);
+        buffer += '}';
+      }
+      buffer += "],\"source_gradeable\":";
+      writeJSONString(*other->source_gradeable);
+      buffer += ",\"username\":";
+      writeJSONString(*other->username);
+      buffer += ",\"version\":";
+      buffer += std::to_string(other->version);
+      buffer += '}';
+    }
+    buffer += ']';
+  }
+  buffer += ",\"start\":";
+  buffer += std::to_string(region.start);
+  buffer += ",\"type\":\"";
+  buffer += REGION_TYPE_NAMES[region.type];
+  buffer += "\"}";
+}
+
+// writes a region as its type, start, end and number of other submissions, then each other
+// submission as its username, version, source gradeable and matching positions.  Strings are
+// written as their length followed by their bytes.  Like hashes.bin, every field is written
+// as it is laid out in memory, which is little-endian on the machines Lichen runs on.
+void MatchesWriter::writeBinaryRegion(const MatchRegion &region) {
+  uint8_t type = region.type;
+  int32_t start = region.start;
+  int32_t end = region.end;
+  uint32_t others = region.others.size();
+  writeRaw(&type, sizeof(type));
+  writeRaw(&start, sizeof(start));
+  writeRaw(&end, sizeof(end));
+  writeRaw(&others, sizeof(others));
+
+  for (std::vector<OtherSubmission>::const_iterator other = region.others.begin(); other != region.others.end(); ++other) {
+    uint16_t username_length = other->username->size();
+    int32_t version = other->version;
+    uint16_t source_gradeable_length = other->source_gradeable->size();
+    uint32_t positions = other->matchingpositions.size();
+    writeRaw(&username_length, sizeof(username_length));
+    writeString(*other->username);
+    writeRaw(&version, sizeof(version));
+    writeRaw(&source_gradeable_length, sizeof(source_gradeable_length));
+    writeString(*other->source_gradeable);
+    writeRaw(&positions, sizeof(positions));
+    for (std::vector<MatchingPosition>::const_iterator position = other->matchingpositions.begin();
+         position != other->matchingpositions.end(); ++position) {
+      int32_t position_start = position->start;
+      int32_t position_end = position->end;
+      writeRaw(&position_start, sizeof(position_start));
+      writeRaw(&position_end, sizeof(position_end));
+    }
+  }
+}
@@ -0,0 +1,88 @@
+#ifndef MATCHES_FILE_H
+#define MATCHES_FILE_H
+
+#include <fstream>
+#include <string>
+#include <vector>
+
+#include "boost/filesystem/path.hpp"
+
+typedef int location_in_submission;
+
+// the encodings a submission's matches can be written in, chosen by matches_file_format in
+// lichen_config.json (see common/matches_file.py for all three)
+enum MatchesFileFormat {
+  MATCHES_JSON,    // matches.json, a compact JSON array of regions, which the UI reads
+  MATCHES_NDJSON,  // matches.ndjson, one region per line
+  MATCHES_BINARY   // matches.bin, a packed little-endian encoding of the regions
+};
+
+// the kinds of region in a matches file, numbered as they are in matches.bin
+enum RegionType {
+  REGION_MATCH = 0,     // "match", tokens which are suspiciously similar to other submissions
+  REGION_COMMON = 1,    // "common", tokens which too many submissions have in common
+  REGION_PROVIDED = 2   // "provided", tokens which match the instructor provided code
+};
+
+// the range of tokens in another submission which matches a region
+struct MatchingPosition {
+  location_in_submission start;
+  location_in_submission end;
+};
+
+// another submission which a region matches.  Names point to the tables of interned names in
+// compare_hashes, so two of them are of the same submission exactly when their pointers and
+// versions are equal.
+struct OtherSubmission {
+  const std::string* username;
+  int version;
+  const std::string* source_gradeable;
+  std::vector<MatchingPosition> matchingpositions;
+};
+
+// a range of tokens in a submission, and for regions of type REGION_MATCH, every other
+// submission it matches
+struct MatchRegion {
+  location_in_submission start;
+  location_in_submission end;
+  RegionType type;
+  std::vector<OtherSubmission> others;
+};
+
+// returns the format named by matches_file_format, or false if there isn't one by that name
+bool parseMatchesFileFormat(const std::string &name, MatchesFileFormat &format);
+// returns the name of the file the matches of a submission are written to in format
+std::string matchesFileName(MatchesFileFormat format);
+
+// Writes the regions of a submission's matches to its matches file one at a time, as they
+// are produced, so that they never have to be held in memory together.
+class MatchesWriter {
+public:
+  MatchesWriter(const boost::filesystem::path &path, MatchesFileFormat format);
+  ~MatchesWriter();
+
+  // MODIFIERS
+  void write(const MatchRegion &region);
+  // finishes the file.  Called by the destructor if it hasn't been already.
+  void close();
+
+  // GETTERS
+  // the number of bytes written so far
+  unsigned long long bytesWritten() const { return bytes_written; }
+
+private:
+  void writeRaw(const void* data, size_t size);
+  void writeString(const std::string &s);
+  void writeJSONString(const std::string &s);
+  void writeJSONRegion(const MatchRegion &region);
+  void writeBinaryRegion(const MatchRegion &region);
+
+  std::ofstream ostr;
+  // the text of the region being written as JSON
+  std::string buffer;
+  MatchesFileFormat format;
+  unsigned long long regions;
+  unsigned long long bytes_written;
+};
+
+#endif
@@ -0,0 +1,112 @@
+#include <algorithm>
+#include <fstream>
+#include <sstream>
+#include <string>
+#include <utility>
+#include <vector>
+
+#include <sys/resource.h>
+
+#include "boost/filesystem/operations.hpp"
+#include "boost/filesystem/path.hpp"
+
+#include "stage_metrics.h"
+
+// the number of the slowest submissions which are listed
+static const unsigned int SLOWEST_SUBMISSIONS = 10;
+
+
+// returns the CPU time used so far by this process
+static double cpuSeconds() {
+  struct rusage usage;
+  getrusage(RUSAGE_SELF, &usage);
+  return usage.ru_utime.tv_sec + usage.ru_stime.tv_sec +
+         (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec) / 1e6;
+}
+
+// returns the bytes read and written by this process so far, or null if they can't be found
+static nlohmann::json ioCounters() {
+  std::ifstream istr("/proc/self/io");
+  if (!istr.good()) {
+    return nullptr;
+  }
+  std::map<std::string, unsigned long long> counters;
+  std::string line;
+  while (std::getline(istr, line)) {
+    std::istringstream line_stream(line);
+    std::string name;
+    unsigned long long value;
+    if (std::getline(line_stream, name, ':') && line_stream >> value) {
+      counters[name] = value;
+    }
+  }
+  nlohmann::json io;
+  io["bytes_read"] = counters["rchar"];
+  io["bytes_written"] = counters["wchar"];
+  io["storage_bytes_read"] = counters["read_bytes"];
+  io["storage_bytes_written"] = counters["write_bytes"];
+  return io;
+}
+
+
+StageMetrics::StageMetrics(const std::string &s) : stage(s), start_wall(std::chrono::steady_clock::now()),
+                                                   start_cpu(cpuSeconds()), phases(nlohmann::json::object()),
+                                                   submissions(nlohmann::json::object()), values(nlohmann::json::object()) {}
+
+void StageMetrics::startPhase(const std::string &name) {
+  phase_starts[name] = std::make_pair(std::chrono::steady_clock::now(), cpuSeconds());
+}
+
+double StageMetrics::endPhase(const std::string &name) {
+  std::chrono::duration<double> wall = std::chrono::steady_clock::now() - phase_starts[name].first;
+  phases[name]["wall_seconds"] = wall.count();
+  phases[name]["cpu_seconds"] = cpuSeconds() - phase_starts[name].second;
+  return wall.count();
+}
+
+void StageMetrics::addSubmission(const std::string &name, double seconds, nlohmann::json counts) {
+  counts["seconds"] = seconds;
+  submissions[name] = counts;
+}
+
+void StageMetrics::set(const std::string &name, const nlohmann::json &value) {
+  values[name] = value;
+}
+
+double StageMetrics::elapsedSeconds() const {
+  std::chrono::duration<double> wall = std::chrono::steady_clock::now() - start_wall;
+  return wall.count();
+}
+
+void StageMetrics::write(const std::string &gradeable_path) const {
+  std::vector<std::pair<double, std::string>> slowest;
+  for (nlohmann::json::const_iterator itr = submissions.begin(); itr != submissions.end(); ++itr) {
+    slowest.push_back(std::make_pair((*itr)["seconds"].get<double>(), itr.key()));
+  }
+  std::sort(slowest.begin(), slowest.end(), [](const std::pair<double, std::string> &a, const std::pair<double, std::string> &b) {
+    return a.first > b.first;
+  });
+  nlohmann::json slowest_submissions = nlohmann::json::array();
+  for (unsigned int i = 0; i < slowest.size() && i < SLOWEST_SUBMISSIONS; i++) {
+    slowest_submissions.push_back({slowest[i].second, slowest[i].first});
+  }
+
+  struct rusage usage;
+  getrusage(RUSAGE_SELF, &usage);
+
+  nlohmann::json metrics = values;
+  metrics["stage"] = stage;
+  metrics["wall_seconds"] = elapsedSeconds();
+  metrics["cpu_seconds"] = cpuSeconds() - start_cpu;
+  // ru_maxrss is in kilobytes on Linux
+  metrics["peak_rss_bytes"] = 1024LL * usage.ru_maxrss;
+  metrics["io"] = ioCounters();
+  metrics["phases"] = phases;
+  metrics["submissions"] = submissions;
+  metrics["slowest_submissions"] = slowest_submissions;
+
+  boost::filesystem::path metrics_dir = boost::filesystem::path(gradeable_path) / "logs" / "metrics";
+  boost::filesystem::create_directories(metrics_dir);
+  std::ofstream ostr((metrics_dir / (stage + ".json")).string());
+  ostr << metrics.dump(4) << std::endl;
+}
@@ -0,0 +1,41 @@
+#ifndef STAGE_METRICS_H
+#define STAGE_METRICS_H
+
+#include <chrono>
+#include <map>
+#include <string>
+
+#include "nlohmann/json.hpp"
+
+// Records where compare_hashes spends its time, in the same layout as the metrics files
+// written by the Python stages (see common/metrics.py), to logs/metrics/<stage>.json.
+class StageMetrics {
+public:
+  explicit StageMetrics(const std::string &stage);
+
+  // MODIFIERS
+  // measures the wall and CPU time of everything between startPhase and endPhase, returning
+  // the wall time in seconds from endPhase
+  void startPhase(const std::string &name);
+  double endPhase(const std::string &name);
+  // records the number of seconds spent on a submission, along with any counts for it
+  void addSubmission(const std::string &name, double seconds, nlohmann::json counts);
+  // records a value which is specific to this stage
+  void set(const std::string &name, const nlohmann::json &value);
+
+  // the wall time in seconds since the stage started
+  double elapsedSeconds() const;
+  // writes the metrics to logs/metrics/<stage>.json under gradeable_path
+  void write(const std::string &gradeable_path) const;
+
+private:
+  std::string stage;
+  std::chrono::steady_clock::time_point start_wall;
+  double start_cpu;
+  std::map<std::string, std::pair<std::chrono::steady_clock::time_point, double>> phase_starts;
+  nlohmann::json phases;
+  nlohmann::json submissions;
+  nlohmann::json values;
+};
+
+#endif
@@ -1,58 +1,114 @@
-#include <map>
-#include <set>
-#include <vector>
-
-#include "hash_location.h"
-#include "submission.h"
-
-typedef int location_in_submission;
-typedef unsigned int hash;
-typedef std::string user_id;
-typedef unsigned int version_number;
-
-void Submission::addSuspiciousMatch(location_in_submission location, const HashLocation &matching_location, const hash &matched_hash) {
-  // figure out if there is an overlap between this hash and a common/provided match
-  int hash_size = config_.hash_size;
-  for (int i = location - 1; i > location - hash_size && i >= 0; i--) {
-    if (common_matches.find(i) != common_matches.end() || provided_matches.find(i) != provided_matches.end()) {
-      return;
-    }
-  }
-
-  // save the found match
-  suspicious_matches[location].insert(matching_location);
-  // update the students_matched container
-  students_matched[matching_location.source_gradeable][matching_location.student][matching_location.version].insert(matched_hash);
-}
-
-void Submission::addCommonMatch(location_in_submission location) {
-  // figure out if there is an overlap between this hash and a match
-  int hash_size = config_.hash_size;
-  for (int i = location - 1; i > location - hash_size && i >= 0; i--) {
-    std::map<location_in_submission, std::set<HashLocation> >::const_iterator find_i = suspicious_matches.find(i);
-    // if there is an overlap, remove the suspicious match that overlaps
-    // hopefully this doesn't cause problems with other submissions thinking
-    // this hash still matches...
-    if (find_i != suspicious_matches.end()) {
-      suspicious_matches.erase(find_i);
-    }
-  }
-
-  common_matches.insert(location);
-}
-
-void Submission::addProvidedMatch(location_in_submission location) {
-  // figure out if there is an overlap between this hash and a match
-  int hash_size = config_.hash_size;
-  for (int i = location - 1; i > location - hash_size && i >= 0; i--) {
-    std::map<location_in_submission, std::set<HashLocation> >::const_iterator find_i = suspicious_matches.find(i);
-    // if there is an overlap, remove the suspicious match that overlaps
-    // hopefully this doesn't cause problems with other submissions thinking
-    // this hash still matches...
-    if (find_i != suspicious_matches.end()) {
-      suspicious_matches.erase(find_i);
-    }
-  }
-
-  provided_matches.insert(location);
-}
+#include <algorithm>
+#include <cstdint>
+#include <map>
+#include <set>
+#include <vector>
+
+#include "hash_location.h"
+#include "submission.h"
+
+typedef int location_in_submission;
+
+void LocationBitmap::insert(location_in_submission location) {
+  unsigned int word = location / 64;
+  if (word >= words.size()) {
+    words.resize(std::max<size_t>(word + 1, words.size() * 2), 0);
+  }
+  words[word] |= uint64_t(1) << (location % 64);
+}
+
+void LocationBitmap::erase(location_in_submission location) {
+  unsigned int word = location / 64;
+  if (word < words.size()) {
+    words[word] &= ~(uint64_t(1) << (location % 64));
+  }
+}
+
+bool LocationBitmap::any(location_in_submission first, location_in_submission last) const {
+  first = std::max(first, 0);
+  last = std::min<long long>(last, (long long) words.size() * 64 - 1);
+  if (first > last) {
+    return false;
+  }
+  unsigned int first_word = first / 64;
+  unsigned int last_word = last / 64;
+  // the bits of the first and last words which are in the range
+  uint64_t first_mask = ~uint64_t(0) << (first % 64);
+  uint64_t last_mask = ~uint64_t(0) >> (63 - last % 64);
+  if (first_word == last_word) {
+    return words[first_word] & first_mask & last_mask;
+  }
+  if (words[first_word] & first_mask) {
+    return true;
+  }
+  for (unsigned int word = first_word + 1; word < last_word; word++) {
+    if (words[word]) {
+      return true;
+    }
+  }
+  return words[last_word] & last_mask;
+}
+
+
+// a match at location overlaps the hash_size - 1 locations before it, which is the window
+// checked here and in eraseSuspiciousMatchesBefore
+bool Submission::followsCoveredLocation(location_in_submission location) const {
+  return covered_locations.any(location - config_.hash_size + 1, location - 1);
+}
+
+void Submission::eraseSuspiciousMatchesBefore(location_in_submission location) {
+  location_in_submission first = std::max(location - config_.hash_size + 1, 0);
+  if (!suspicious_locations.any(first, location - 1)) {
+    return;
+  }
+  // if there is an overlap, remove the suspicious matches that overlap
+  // hopefully this doesn't cause problems with other submissions thinking
+  // this hash still matches...
+  std::map<location_in_submission, std::set<HashLocation> >::iterator itr = suspicious_matches.lower_bound(first);
+  while (itr != suspicious_matches.end() && itr->first < location) {
+    suspicious_locations.erase(itr->first);
+    itr = suspicious_matches.erase(itr);
+  }
+}
+
+void Submission::addSuspiciousMatch(location_in_submission location, const HashLocation &matching_location) {
+  // figure out if there is an overlap between this hash and a common/provided match
+  if (followsCoveredLocation(location)) {
+    return;
+  }
+
+  // save the found match
+  suspicious_matches[location].insert(matching_location);
+  suspicious_locations.insert(location);
+}
+
+void Submission::addCommonMatch(location_in_submission location) {
+  // figure out if there is an overlap between this hash and a match
+  eraseSuspiciousMatchesBefore(location);
+  common_matches.insert(location);
+  covered_locations.insert(location);
+}
+
+void Submission::addProvidedMatch(location_in_submission location) {
+  // figure out if there is an overlap between this hash and a match
+  eraseSuspiciousMatchesBefore(location);
+  provided_matches.insert(location);
+  covered_locations.insert(location);
+}
+
+void Submission::addMatches(location_in_submission location, const HashMatches &matches) {
+  if (matches.provided) {
+    addProvidedMatch(location);
+    return;
+  }
+  if (matches.common) {
+    addCommonMatch(location);
+  }
+  // the location is checked for overlaps once, however many locations it matches
+  if (matches.suspicious.empty() || followsCoveredLocation(location)) {
+    return;
+  }
+  std::set<HashLocation> &matching_locations = suspicious_matches[location];
+  matching_locations.insert(matches.suspicious.begin(), matches.suspicious.end());
+  suspicious_locations.insert(location);
+}
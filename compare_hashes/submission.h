@@ -1,10 +1,8 @@
 #ifndef SUBMISSION_H
 #define SUBMISSION_H
 
-#include <string>
-#include <unordered_map>
+#include <cstdint>
 #include <map>
-#include <unordered_set>
 #include <set>
 #include <vector>
 
@@ -13,45 +11,75 @@
 
 typedef int location_in_submission;
 typedef unsigned int hash;
-typedef std::string user_id;
-typedef unsigned int version_number;
+typedef unsigned int submission_id;
+
+// what was found when looking up one of a submission's hashes: whether it is in the provided
+// code, whether it is common code, and the locations it suspiciously matches
+struct HashMatches {
+  HashMatches() : provided(false), common(false) {}
+  void clear() { provided = false; common = false; suspicious.clear(); }
+  bool empty() const { return !provided && !common && suspicious.empty(); }
+  bool provided;
+  bool common;
+  std::vector<HashLocation> suspicious;
+};
+
+// a set of locations in a submission, stored as one bit per location so that whether any
+// location in a range is in the set can be checked a 64 bit word at a time.  It grows to
+// fit the largest location inserted.
+class LocationBitmap {
+public:
+  void insert(location_in_submission location);
+  void erase(location_in_submission location);
+  // returns true if any location from first to last, inclusive, is in the set
+  bool any(location_in_submission first, location_in_submission last) const;
+
+private:
+  std::vector<uint64_t> words;
+};
 
 // represents a unique student-version pair, all its
 // hashes, and other submissions with those hashes
 class Submission {
 public:
   // CONSTRUCTOR
-  Submission(const user_id &s, version_number v, const LichenConfig &c) : student_(s), version_(v), config_(c) {}
+  Submission(submission_id id, const LichenConfig &c) : id_(id), config_(c) {}
 
   // GETTERS
-  const user_id& student() const { return student_; }
-  version_number version() const { return version_; }
+  submission_id id() const { return id_; }
 
   const std::map<location_in_submission, std::set<HashLocation> >& getSuspiciousMatches() const { return suspicious_matches; }
   const std::set<location_in_submission>& getCommonMatches() const { return common_matches; }
   const std::set<location_in_submission>& getProvidedMatches() const { return provided_matches; }
-  const std::unordered_map<std::string, std::unordered_map<user_id, std::unordered_map<version_number, std::unordered_set<hash>>>>& getStudentsMatched() const { return students_matched; }
-  const std::vector<std::pair<hash, location_in_submission>> & getHashes() const { return hashes; }
+  // the hash at index i is found at locations[i] in the submission
+  const std::vector<hash>& getHashes() const { return hashes; }
+  const std::vector<location_in_submission>& getLocations() const { return locations; }
 
   // MODIFIERS
-  void addHash(const hash &h, location_in_submission l) { hashes.push_back(std::make_pair(h, l)); }
-  void addSuspiciousMatch(location_in_submission location, const HashLocation &matching_location, const hash &matched_hash);
+  void setHashes(std::vector<hash> &h, std::vector<location_in_submission> &l) { hashes.swap(h); locations.swap(l); }
+  void addSuspiciousMatch(location_in_submission location, const HashLocation &matching_location);
   void addCommonMatch(location_in_submission location);
   void addProvidedMatch(location_in_submission location);
+  // adds everything found for the hash at location
+  void addMatches(location_in_submission location, const HashMatches &matches);
 
 private:
-  user_id student_;
-  version_number version_;
-  LichenConfig config_;
-  std::vector<std::pair<hash, location_in_submission> > hashes;
+  // returns true if common or provided code was found within hash_size tokens before location
+  bool followsCoveredLocation(location_in_submission location) const;
+  // removes any suspicious matches within hash_size tokens before location
+  void eraseSuspiciousMatchesBefore(location_in_submission location);
+
+  submission_id id_;
+  const LichenConfig &config_;
+  std::vector<hash> hashes;
+  std::vector<location_in_submission> locations;
   std::map<location_in_submission, std::set<HashLocation> > suspicious_matches;
   std::set<location_in_submission> common_matches;
   std::set<location_in_submission> provided_matches;
-
-  // a container to keep track of all the students this submission
-  // matched and the number of matching hashes per submission
-  // <source_gradeable, <username, <version, <hashes>> > >
-  std::unordered_map<std::string, std::unordered_map<user_id, std::unordered_map<version_number, std::unordered_set<hash>>>> students_matched;
+  // the locations of suspicious_matches, and of common_matches and provided_matches together,
+  // which are checked for overlaps as each match is added
+  LocationBitmap suspicious_locations;
+  LocationBitmap covered_locations;
 };
 
 #endif
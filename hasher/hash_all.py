@@ -7,11 +7,21 @@ the tokenized files.
 
 import argparse
 import os
+import sys
 import json
 import hashlib
 from pathlib import Path
 import humanize
 import datetime
+import numpy as np
+from collections import deque
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.artifact_cache import ArtifactCache, file_digest  # noqa: E402
+from common.fingerprint_index import index_dir, index_gradeable, read_manifest  # noqa: E402
+from common.hash_file import count_hashes, count_sequences, hashes_file_name, write_hashes  # noqa: E402,E501
+from common.metrics import StageMetrics, file_size, timed  # noqa: E402
+from common.token_stream import read_tokens  # noqa: E402
 
 
 def parse_args():
@@ -20,38 +30,189 @@ def parse_args():
     return parser.parse_args()
 
 
-def hasher(lichen_config, lichen_run_config, my_tokenized_file, my_hashes_file):
-    language = lichen_run_config["language"]
-    hash_size = int(lichen_run_config["hash_size"])
-
+# returns the hash of every sequence of hash_size consecutive token values, computed by
+# running md5 over the concatenated values of each sequence
+def md5_hashes(token_values, hash_size):
+    return [int(hashlib.md5(''.join(token_values[x:x+hash_size]).encode()).hexdigest()[0:8], 16)
+            for x in range(0, len(token_values)-hash_size+1)]
+
+
+# constants for the polynomial rolling hash (mod 2^64).  The base is odd, so it has a
+# multiplicative inverse which is used to divide out the position of each sequence.
+ROLLING_HASH_BASE = 0x100000001b3
+ROLLING_HASH_BASE_INVERSE = pow(ROLLING_HASH_BASE, -1, 2**64)
+
+
+# returns the hash of every sequence of hash_size consecutive token values as a polynomial
+# rolling hash.  Each distinct token value is interned to a 64 bit integer once, after which
+# every sequence is hashed in a single batch of numpy operations, independent of hash_size:
+#     hash(i) = sum(value[t] * B^(i+hash_size-1-t) for t in the sequence starting at i)
+#             = B^(i+hash_size-1) * (prefix(i+hash_size) - prefix(i))
+# where prefix(i) = sum(value[t] * B^-t for t < i), all mod 2^64.  Each 64 bit hash is then
+# mixed and truncated to 32 bits, like the md5 hashes.
+def rolling_hashes(token_values, hash_size):
+    num_sequences = len(token_values) - hash_size + 1
+    if num_sequences <= 0:
+        return []
+
+    interned = dict()
+    for value in token_values:
+        if value not in interned:
+            interned[value] = int.from_bytes(
+                hashlib.blake2b(value.encode(), digest_size=8).digest(), "little")
+    values = np.fromiter((interned[value] for value in token_values), dtype=np.uint64,
+                         count=len(token_values))
+
+    powers = np.full(len(token_values), ROLLING_HASH_BASE, dtype=np.uint64)
+    powers[0] = 1
+    powers = np.cumprod(powers, dtype=np.uint64)
+    inverse_powers = np.full(len(token_values), ROLLING_HASH_BASE_INVERSE, dtype=np.uint64)
+    inverse_powers[0] = 1
+    inverse_powers = np.cumprod(inverse_powers, dtype=np.uint64)
+
+    prefix = np.zeros(len(token_values) + 1, dtype=np.uint64)
+    np.cumsum(values * inverse_powers, dtype=np.uint64, out=prefix[1:])
+    hashes = (prefix[hash_size:] - prefix[:num_sequences]) * powers[hash_size - 1:]
+
+    # splitmix64 finalizer, so that every bit of the result depends on every token
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return (hashes >> np.uint64(32)).tolist()
+
+
+HASH_ALGORITHMS = {
+    "md5": md5_hashes,
+    "rolling": rolling_hashes,
+}
+
+
+# selects fingerprints from hashes by winnowing (Schleimer et al., "Winnowing: Local
+# Algorithms for Document Fingerprinting"): the minimum hash in every window of `window`
+# consecutive hashes is kept, the rightmost one if there is a tie.  Any match at least
+# window + hash_size - 1 tokens long is guaranteed to share a fingerprint.  Returns the
+# selected hashes along with their locations, counted from 1 like the unselected hashes.
+def winnow(hashes, window):
+    locations = []
+    # indexes of the current window whose hashes are smaller than every hash after them
+    minimums = deque()
+    for i, h in enumerate(hashes):
+        while minimums and hashes[minimums[-1]] >= h:
+            minimums.pop()
+        minimums.append(i)
+        if minimums[0] <= i - window:
+            minimums.popleft()
+
+        # a file shorter than the window is treated as a single window
+        if (i >= window - 1 or i == len(hashes) - 1) and \
+                (not locations or locations[-1] != minimums[0] + 1):
+            locations.append(minimums[0] + 1)
+
+    return [hashes[location - 1] for location in locations], locations
+
+
+# returns the name of the token field which is hashed for the configured language
+def get_token_value(lichen_run_config):
     data_json_path = Path(Path(__file__).resolve().parent.parent,
                           "tokenizer", "tokenizer_config.json")
     with open(data_json_path) as token_data_file:
         token_data = json.load(token_data_file)
+    return token_data[lichen_run_config["language"]]["token_value"]
+
+
+# hashes the token_value field of the tokens in my_tokenized_file, returning whether the
+# hashes had to be truncated
+def hasher(lichen_config, lichen_run_config, token_value, winnowing_window,
+           my_tokenized_file, my_hashes_file):
+    # tokens are read one at a time, and only the hashed field of each is kept.  An empty
+    # hashes file is written if the tokens file was empty (such as when there is no
+    # provided code)
+    token_values = [str(x[token_value]) for x in read_tokens(my_tokenized_file)]
+    return hash_values(lichen_config, lichen_run_config, winnowing_window, token_values,
+                       my_hashes_file)
+
+
+# hashes a list of token values and writes the hashes to my_hashes_file, returning whether
+# the hashes had to be truncated.  If winnowing_window is not 0, only the fingerprints
+# selected by winnowing are written.
+def hash_values(lichen_config, lichen_run_config, winnowing_window, token_values,
+                my_hashes_file):
+    hash_size = int(lichen_run_config["hash_size"])
 
-    with open(my_tokenized_file, 'r', encoding='ISO-8859-1') as my_tf:
-        with open(my_hashes_file, 'w') as my_hf:
-            tokens = json.load(my_tf)
-            # write empty hashes file if the tokens file was empty (such as
-            # when there is no provided code)
-            if tokens is not None:
-                token_values = [str(x[token_data[language]["token_value"]]) for x in tokens]
-                num = len(tokens)
-                # FIXME: this truncation should be adjusted after testing
-                token_hashed_values = [(hashlib.md5(''.join(
-                    token_values[x:x+hash_size]).encode())
-                    .hexdigest())[0:8] for x in range(0, num-hash_size+1)]
-
-                if len(token_hashed_values) > lichen_config["max_sequences_per_file"]:
-                    token_hashed_values = token_hashed_values[slice(0, lichen_config["max_sequences_per_file"])]  # noqa E501
-                    print(f"File {my_hashes_file} truncated after exceeding max sequence limit")
-
-                my_hf.write('\n'.join(token_hashed_values))
+    truncated = False
+    # FIXME: this truncation should be adjusted after testing
+    hash_algorithm = HASH_ALGORITHMS[lichen_config.get("hash_algorithm", "md5")]
+    token_hashed_values = hash_algorithm(token_values, hash_size)
+
+    locations = None
+    sequences = len(token_hashed_values)
+    if winnowing_window > 0:
+        token_hashed_values, locations = winnow(token_hashed_values, winnowing_window)
+
+    if len(token_hashed_values) > lichen_config["max_sequences_per_file"]:
+        token_hashed_values = token_hashed_values[slice(0, lichen_config["max_sequences_per_file"])]  # noqa E501
+        if locations is not None:
+            locations = locations[:lichen_config["max_sequences_per_file"]]
+        print(f"File {my_hashes_file} truncated after exceeding max sequence limit")
+        truncated = True
+
+    write_hashes(my_hashes_file, token_hashed_values, hash_size, locations=locations,
+                 sequences=sequences)
+    return truncated
+
+
+# returns the part of the cache key of every submission's hashes which doesn't depend on its
+# tokens.  The tokens already reflect the language and tokenizer arguments, so the hashes only
+# depend on the tokens, the settings used to hash them, and the code which writes them.
+def get_settings_key(cache, lichen_config, lichen_run_config):
+    return cache.key(lichen_run_config["language"], int(lichen_run_config["hash_size"]),
+                     lichen_config["max_sequences_per_file"],
+                     lichen_config.get("hash_algorithm", "md5"), file_digest(__file__),
+                     file_digest(Path(Path(__file__).resolve().parent.parent,
+                                      'common', 'hash_file.py')))
+
+
+# returns the cache key of the hashes of the tokens in my_tokenized_file
+def get_hashes_key(cache, settings_key, winnowing_window, my_tokenized_file):
+    return cache.key(settings_key, winnowing_window, file_digest(my_tokenized_file))
+
+
+# hashes the tokens in my_tokenized_file unless identical tokens were already hashed with the
+# same settings, in which case the cached hashes are copied instead
+def hash_cached(cache, settings_key, lichen_config, lichen_run_config, token_value,
+                winnowing_window, my_tokenized_file, my_hashes_file):
+    if not cache.enabled():
+        hasher(lichen_config, lichen_run_config, token_value, winnowing_window,
+               my_tokenized_file, my_hashes_file)
+        return
+
+    key = get_hashes_key(cache, settings_key, winnowing_window, my_tokenized_file)
+    if cache.fetch(key, my_hashes_file.name, my_hashes_file):
+        return
+
+    # truncated files aren't cached so that the truncation is reported again on the next run
+    if not hasher(lichen_config, lichen_run_config, token_value, winnowing_window,
+                  my_tokenized_file, my_hashes_file):
+        cache.store(key, my_hashes_file.name, my_hashes_file)
+
+
+# records the seconds spent on a submission in metrics, along with the number of sequences
+# which were hashed, the number of hashes which were kept, and the size of the file they
+# were hashed from
+def add_submission_metrics(metrics, basepath, seconds, my_input_file, my_hashes_file, **counts):
+    counts.setdefault("bytes_written", file_size(my_hashes_file))
+    metrics.add_submission(Path(my_hashes_file).parent.relative_to(basepath), seconds,
+                           sequences=count_sequences(my_hashes_file),
+                           hashes=count_hashes(my_hashes_file),
+                           bytes_read=file_size(my_input_file), **counts)
 
 
 def main():
     start_time = datetime.datetime.now()
     args = parse_args()
+    metrics = StageMetrics("hash_all")
 
     with open(Path(args.basepath, "config.json")) as lichen_run_config_file:
         lichen_run_config = json.load(lichen_run_config_file)
@@ -60,6 +221,18 @@ def main():
                    'bin', 'lichen_config.json')) as lichen_config_file:
         lichen_config = json.load(lichen_config_file)
 
+    cache = ArtifactCache(Path(args.basepath, "cache"),
+                          lichen_config.get("cache_max_total_bytes", 0))
+    settings_key = get_settings_key(cache, lichen_config, lichen_run_config)
+
+    token_value = get_token_value(lichen_run_config)
+    # submissions are winnowed if enabled.  The provided code never is, since any of its hashes
+    # may be the one selected from a submission which copied it.
+    winnowing_window = lichen_config.get("winnowing_window", 0)
+
+    if lichen_config.get("hash_algorithm", "md5") not in HASH_ALGORITHMS:
+        raise SystemExit(f"ERROR: Unknown hash algorithm {lichen_config['hash_algorithm']}")
+
     print("HASH ALL:", flush="True")
     print("[0%                      25%                     50%                     75%                     100%]\n[", end="", flush=True)  # noqa: E501
 
@@ -75,6 +248,7 @@ def main():
     for dir in os.listdir(other_gradeables_dir):
         total_users += len(os.listdir(os.path.join(other_gradeables_dir, dir)))
 
+    metrics.start_phase("hash")
     users_hashed = 0
     percent_progress = 0
 
@@ -92,8 +266,12 @@ def main():
                 continue
 
             my_tokenized_file = Path(my_dir, "tokens.json")
-            my_hashes_file = Path(my_dir, "hashes.txt")
-            hasher(lichen_config, lichen_run_config, my_tokenized_file, my_hashes_file)
+            my_hashes_file = Path(my_dir, hashes_file_name(lichen_config))
+            seconds, _ = timed(hash_cached, cache, settings_key, lichen_config,
+                               lichen_run_config, token_value, winnowing_window,
+                               my_tokenized_file, my_hashes_file)
+            add_submission_metrics(metrics, args.basepath, seconds, my_tokenized_file,
+                                   my_hashes_file)
 
         users_hashed += 1
         if int((users_hashed / total_users) * 100) > percent_progress:
@@ -120,8 +298,12 @@ def main():
                     continue
 
                 other_tokenized_file = Path(other_version_dir, "tokens.json")
-                other_hashes_file = Path(other_version_dir, "hashes.txt")
-                hasher(lichen_config, lichen_run_config, other_tokenized_file, other_hashes_file)
+                other_hashes_file = Path(other_version_dir, hashes_file_name(lichen_config))
+                seconds, _ = timed(hash_cached, cache, settings_key, lichen_config,
+                                   lichen_run_config, token_value, winnowing_window,
+                                   other_tokenized_file, other_hashes_file)
+                add_submission_metrics(metrics, args.basepath, seconds, other_tokenized_file,
+                                       other_hashes_file)
 
             users_hashed += 1
             if int((users_hashed / total_users) * 100) > percent_progress:
@@ -132,8 +314,24 @@ def main():
     # ==========================================================================
     # hash the provided code
     provided_code_tokenized = Path(args.basepath, "provided_code", "tokens.json")
-    provided_code_hashed = Path(args.basepath, "provided_code", "hashes.txt")
-    hasher(lichen_config, lichen_run_config, provided_code_tokenized, provided_code_hashed)
+    provided_code_hashed = Path(args.basepath, "provided_code", hashes_file_name(lichen_config))
+    seconds, _ = timed(hash_cached, cache, settings_key, lichen_config, lichen_run_config,
+                       token_value, 0, provided_code_tokenized, provided_code_hashed)
+    add_submission_metrics(metrics, args.basepath, seconds, provided_code_tokenized,
+                           provided_code_hashed)
+    metrics.end_phase("hash")
+
+    with metrics.phase("evict cache"):
+        cache.evict()
+
+    # ==========================================================================
+    # index the other gradeables which were hashed, so that later runs can skip them
+    with metrics.phase("index other gradeables"):
+        for other_gradeable, entry in sorted(read_manifest(args.basepath).items()):
+            if not entry["attached"]:
+                index_gradeable(index_dir(args.basepath, lichen_config), entry["key"],
+                                Path(other_gradeables_dir, other_gradeable))
+    metrics.write(args.basepath)
 
     # ==========================================================================
     print("]\nHashing done in", humanize.precisedelta(start_time, format="%1.f"))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Picks the submissions of other gradeables which are likely to hold code copied
+into, or from, one of this gradeable's submissions, using MinHash sketches of
+their fingerprints (see common/minhash.py), so that compare_hashes only loads those.
+The sketches of other gradeables which have a fingerprint index are read from the
+sketches kept with it, rather than from their hashes.
+
+The candidates are written to <basepath>/other_gradeable_candidates.json, which
+maps the name of each other gradeable to a list of the [user, version] of each of
+its candidate submissions.  Nothing is written unless other_gradeables_prefilter is
+set in lichen_config.json, in which case every submission is compared as usual.
+
+Provided code and common code (from the previous run of this gradeable, from
+common_code_paths in config.json, and any hash more than threshold of this gradeable's
+students share) aren't counted as found, so that code which every submission shares
+doesn't make them all candidates.
+
+The recall of the filter is measured by comparing every fingerprint of a sample of the
+candidates and of the other submissions, which estimates how many submissions which reach
+the containment were kept.
+"""
+
+import argparse
+import json
+import os
+import sys
+import humanize
+import datetime
+import numpy as np
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common import minhash  # noqa: E402
+from common.fingerprint_index import find_submissions, index_dir, index_path, read_index_names, read_index_submissions, read_manifest, read_sketches, sketches_path  # noqa: E402,E501
+from common.hash_file import find_hashes_file, read_hashes  # noqa: E402
+from common.metrics import StageMetrics  # noqa: E402
+
+CANDIDATES_FILE_NAME = "other_gradeable_candidates.json"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("basepath")
+    return parser.parse_args()
+
+
+# returns the sketch size, containment and target recall of the filter, and the number of
+# candidates and of other submissions whose recall is measured
+def prefilter_settings(lichen_config):
+    return (lichen_config.get("prefilter_sketch_size", 128),
+            lichen_config.get("prefilter_containment", 0.2),
+            lichen_config.get("prefilter_recall", 0.99),
+            lichen_config.get("prefilter_recall_sample", 100))
+
+
+# returns the hashes of the provided code and of any common code from earlier runs
+def excluded_hashes(basepath, config):
+    directories = [Path(basepath, "provided_code"), Path(basepath, "common_code")]
+    # each of the common_code_paths is a common_code directory, or a gradeable's directory
+    # which holds one, as compare_hashes reads them
+    for path in config.get("common_code_paths", []):
+        if find_hashes_file(path).exists():
+            directories.append(Path(path))
+        else:
+            directories.append(Path(path, "common_code"))
+
+    excluded = [np.empty(0, dtype=np.uint64)]
+    for directory in directories:
+        hashes_file = find_hashes_file(directory)
+        if hashes_file.exists():
+            excluded.append(minhash.fingerprint_set(read_hashes(hashes_file)))
+    return np.unique(np.concatenate(excluded))
+
+
+# returns the hashes which more than threshold students share, as compare_hashes finds them
+def common_hashes(names, sets, threshold):
+    students = {user: i for i, user in enumerate(sorted({user for user, _version in names}))}
+    pairs = np.unique(np.concatenate(
+        [np.empty(0, dtype=np.uint64)] +
+        [(fingerprints << np.uint64(32)) | np.uint64(students[user])
+         for (user, _version), fingerprints in zip(names, sets)]))
+    hashes, counts = np.unique(pairs >> np.uint64(32), return_counts=True)
+    return hashes[counts > max(threshold, 1)]
+
+
+# returns the (user, version) of each submission in gradeable_dir which has been hashed, and
+# the list of its hashes
+def read_gradeable(gradeable_dir):
+    names = []
+    hashes = []
+    for user, version, version_dir in find_submissions(gradeable_dir):
+        hashes_file = find_hashes_file(version_dir)
+        if hashes_file.exists():
+            names.append((user, version))
+            hashes.append(read_hashes(hashes_file))
+    return names, hashes
+
+
+# returns the names and sketches of an other gradeable's submissions, leaving out the
+# fingerprints in excluded, along with the distinct fingerprints of each submission or, for a
+# gradeable read from its fingerprint index in directory, the index and the position of the
+# submission in it so that they can be read only when they are needed
+def read_other_gradeable(basepath, directory, name, entry, excluded, sketch_size):
+    if entry is None:
+        names, hashes = read_gradeable(Path(basepath, "other_gradeables", name))
+        sets = fingerprint_sets(hashes, excluded)
+        return names, [minhash.sketch(s, sketch_size) for s in sets], sets
+
+    path = index_path(directory, entry["key"])
+    names = [tuple(name) for name in read_index_names(path)]
+    sketches = [np.sort(ranked[~np.isin(ranked, excluded)][:sketch_size])
+                for ranked in read_sketches(sketches_path(directory, entry["key"]))]
+    return names, sketches, [(path, position) for position in range(len(names))]
+
+
+# returns the distinct fingerprints of each list of hashes, leaving out those in excluded
+def fingerprint_sets(hashes, excluded):
+    return [np.setdiff1d(minhash.fingerprint_set(h), excluded, assume_unique=True)
+            for h in hashes]
+
+
+# returns the distinct fingerprints of the other submissions at indices, reading those of
+# submissions in fingerprint indexes from the index, leaving out those in excluded
+def read_other_sets(other_sets, indices, excluded):
+    sets = dict()
+    from_index = dict()
+    for i in indices:
+        if isinstance(other_sets[i], tuple):
+            from_index.setdefault(other_sets[i][0], []).append(i)
+        else:
+            sets[i] = other_sets[i]
+    for path, group in from_index.items():
+        _names, hashes = read_index_submissions(path, [other_sets[i][1] for i in group])
+        sets.update(zip(group, fingerprint_sets(hashes, excluded)))
+    return [sets[i] for i in indices]
+
+
+# compares every fingerprint of a sample of the candidates and of the other submissions with
+# these_sets, returning the recall it estimates along with the counts it is estimated from
+def measure_recall(other_sets, sketches, selected, these_sets, excluded, containment,
+                   sample_size):
+    rng = np.random.default_rng(0)
+    counts = dict()
+    estimated = dict()
+    nonempty = np.array([len(s) > 0 for s in sketches], dtype=bool)
+    for kept, label in [(True, "candidates"), (False, "others")]:
+        pool = np.flatnonzero((selected == kept) & nonempty)
+        sample = rng.choice(pool, min(sample_size, len(pool)), replace=False)
+        sets = read_other_sets(other_sets, sample.tolist(), excluded)
+        found = minhash.max_found(sets, these_sets)
+        reached = int(np.sum(found >= containment * np.array([len(s) for s in sets])))
+        counts[label] = {"submissions": len(pool), "sampled": len(sample), "reached": reached}
+        estimated[label] = reached / len(sample) * len(pool) if len(sample) > 0 else 0
+
+    total = estimated["candidates"] + estimated["others"]
+    return (estimated["candidates"] / total if total > 0 else None), counts
+
+
+def main():
+    start_time = datetime.datetime.now()
+    args = parse_args()
+
+    with open(Path(Path(__file__).resolve().parent.parent,
+                   'bin', 'lichen_config.json')) as lichen_config_file:
+        lichen_config = json.load(lichen_config_file)
+    candidates_path = Path(args.basepath, CANDIDATES_FILE_NAME)
+    if candidates_path.exists():
+        os.remove(candidates_path)
+    if not lichen_config.get("other_gradeables_prefilter", False):
+        return
+
+    with open(Path(args.basepath, "config.json")) as config_file:
+        config = json.load(config_file)
+
+    # the other gradeables which were read from their fingerprint indexes weren't concatenated
+    manifest = read_manifest(args.basepath)
+    other_gradeables_dir = Path(args.basepath, "other_gradeables")
+    other_gradeables = sorted({name for name in os.listdir(other_gradeables_dir)
+                               if Path(other_gradeables_dir, name).is_dir()} |
+                              {name for name, entry in manifest.items() if entry["attached"]})
+    if len(other_gradeables) == 0:
+        return
+
+    metrics = StageMetrics("minhash_prefilter")
+    print("MINHASH PREFILTER:", flush=True)
+
+    sketch_size, containment, target_recall, sample_size = prefilter_settings(lichen_config)
+    hits = minhash.min_hits(sketch_size, containment, target_recall)
+    expected_recall = minhash.recall(containment, sketch_size, hits)
+
+    with metrics.phase("load"):
+        names, hashes = read_gradeable(Path(args.basepath, "users"))
+        excluded = excluded_hashes(args.basepath, config)
+        these_sets = fingerprint_sets(hashes, excluded)
+        excluded = np.union1d(excluded, common_hashes(names, these_sets, int(config["threshold"])))
+        these_sets = [np.setdiff1d(s, excluded, assume_unique=True) for s in these_sets]
+
+        directory = index_dir(args.basepath, lichen_config)
+        other_names = []
+        sketches = []
+        other_sets = []
+        for name in other_gradeables:
+            gradeable_names, gradeable_sketches, gradeable_sets = \
+                read_other_gradeable(args.basepath, directory, name, manifest.get(name),
+                                     excluded, sketch_size)
+            other_names.extend((name, user, version) for user, version in gradeable_names)
+            sketches.extend(gradeable_sketches)
+            other_sets.extend(gradeable_sets)
+
+    with metrics.phase("find candidates"):
+        selected = minhash.candidates(sketches, these_sets, containment, target_recall)
+
+    with metrics.phase("measure recall"):
+        measured_recall, recall_counts = measure_recall(other_sets, sketches, selected,
+                                                        these_sets, excluded, containment,
+                                                        sample_size)
+
+    candidates = {name: [] for name in other_gradeables}
+    for (name, user, version), keep in zip(other_names, selected.tolist()):
+        if keep:
+            candidates[name].append([user, version])
+    with open(candidates_path, "w") as candidates_file:
+        json.dump(candidates, candidates_file, indent=4, sort_keys=True)
+
+    kept = int(np.sum(selected))
+    metrics.set("prefilter", {"sketch_size": sketch_size, "containment": containment,
+                              "min_hits": hits, "target_recall": target_recall,
+                              "expected_recall": expected_recall,
+                              "measured_recall": measured_recall, "recall_sample": recall_counts,
+                              "excluded_hashes": len(excluded),
+                              "other_submissions": len(other_sets), "candidates": kept,
+                              "other_gradeables": {name: len(candidates[name])
+                                                   for name in other_gradeables}})
+    metrics.write(args.basepath)
+
+    print(f"Kept {kept} of {len(other_sets)} submissions of other gradeables as candidates")
+    print(f"{hits} of {sketch_size} sampled fingerprints found keep submissions with containment "
+          f"{containment} with probability {expected_recall:.4f} (target {target_recall})")
+    if measured_recall is None:
+        print("Measured recall: no sampled submission reached the containment")
+    else:
+        print(f"Measured recall {measured_recall:.4f}: "
+              f"{recall_counts['candidates']['reached']} of "
+              f"{recall_counts['candidates']['sampled']} sampled candidates and "
+              f"{recall_counts['others']['reached']} of {recall_counts['others']['sampled']} "
+              f"sampled other submissions reach the containment")
+    print("MinHash prefilter done in", humanize.precisedelta(start_time, format="%1.f"))
+
+
+if __name__ == "__main__":
+    main()
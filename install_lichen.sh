@@ -55,7 +55,7 @@ fi
 # compile & install the hash comparison tool
 
 pushd "${lichen_repository_dir}" > /dev/null
-clang++ -I "${lichen_vendor_dir}" -lboost_system -lboost_filesystem -Wall -Wextra -Werror -g -O3 -flto -funroll-loops -std=c++11 compare_hashes/compare_hashes.cpp compare_hashes/submission.cpp -o "${lichen_installation_dir}/compare_hashes/compare_hashes.out"
+clang++ -I "${lichen_vendor_dir}" -lboost_system -lboost_filesystem -Wall -Wextra -Werror -g -O3 -flto -funroll-loops -std=c++11 -pthread compare_hashes/compare_hashes.cpp compare_hashes/submission.cpp compare_hashes/hash_file.cpp compare_hashes/hash_index.cpp compare_hashes/hash_partitions.cpp compare_hashes/stage_metrics.cpp compare_hashes/matches_file.cpp -o "${lichen_installation_dir}/compare_hashes/compare_hashes.out"
 if [ "$?" -ne 0 ]; then
     echo -e "ERROR: FAILED TO BUILD HASH COMPARISON TOOL\n"
     exit 1
@@ -77,4 +77,17 @@ fi
 chown -R root:root ${lichen_installation_dir}
 chmod -R 755 ${lichen_installation_dir}
 
+####################################################################################################
+# create the directory the fingerprint indexes of other gradeables are shared in, if one is set
+# as fingerprint_index_dir in lichen_config.json.  It belongs to the daemon user, which runs
+# Lichen, since every run may add or remove indexes.
+
+fingerprint_index_dir=$(python3 -c 'import json, sys; print(json.load(open(sys.argv[1])).get("fingerprint_index_dir", ""))' "${lichen_installation_dir}/bin/lichen_config.json")
+if [ -n "$fingerprint_index_dir" ]; then
+    daemon_user=$(python3 -c 'import json; print(json.load(open("/usr/local/submitty/config/submitty_users.json"))["daemon_user"])' 2> /dev/null || echo "submitty_daemon")
+    mkdir -p "$fingerprint_index_dir"
+    chown "${daemon_user}:${daemon_user}" "$fingerprint_index_dir"
+    chmod 700 "$fingerprint_index_dir"
+fi
+
 echo "done"
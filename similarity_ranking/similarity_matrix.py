@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Counts the fingerprints every pair of submissions shares and writes them to
+similarity_matrix.bin, along with the scores computed from them (see
+common/similarity_matrix.py)
+"""
+
+import argparse
+import json
+import os
+import sys
+import humanize
+import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.fingerprint_index import find_submissions  # noqa: E402
+from common.hash_file import find_hashes_file, read_hashes  # noqa: E402
+from common.metrics import StageMetrics, file_size  # noqa: E402
+from common.similarity_matrix import FILE_NAME, compute_similarity_matrix  # noqa: E402
+from common.similarity_matrix import write_similarity_matrix  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('basepath')
+    return parser.parse_args()
+
+
+# returns the hashes of the provided code, and of the common code compare_hashes found or was
+# given, which aren't counted as shared by any pair of submissions
+def excluded_hashes(basepath):
+    excluded = []
+    for directory in [Path(basepath, 'provided_code'), Path(basepath, 'common_code')]:
+        hashes_file = find_hashes_file(directory)
+        if hashes_file.exists():
+            excluded.extend(read_hashes(hashes_file))
+    return excluded
+
+
+def main():
+    start_time = datetime.datetime.now()
+    args = parse_args()
+
+    with open(Path(Path(__file__).resolve().parent.parent, 'bin', 'lichen_config.json')) \
+            as lichen_config_file:
+        lichen_config = json.load(lichen_config_file)
+    if not lichen_config.get("similarity_matrix", False):
+        return
+
+    metrics = StageMetrics("similarity_matrix")
+    print("SIMILARITY MATRIX:", flush=True)
+
+    with open(Path(args.basepath, "config.json")) as config_file:
+        config = json.load(config_file)
+
+    users_dir = Path(args.basepath, 'users')
+    if not os.path.isdir(users_dir):
+        raise SystemExit('ERROR! Unable to find users directory')
+
+    with metrics.phase("load"):
+        submissions = []
+        bytes_read = 0
+        for user, version, version_dir in find_submissions(users_dir):
+            hashes_file = find_hashes_file(version_dir)
+            if not hashes_file.exists():
+                continue
+            submissions.append((user, version, read_hashes(hashes_file)))
+            bytes_read += file_size(hashes_file)
+        excluded = excluded_hashes(args.basepath)
+
+    with metrics.phase("count shared fingerprints"):
+        matrix = compute_similarity_matrix(submissions, excluded, int(config["threshold"]))
+
+    with metrics.phase("write"):
+        write_similarity_matrix(Path(args.basepath, FILE_NAME), matrix)
+
+    metrics.set("bytes_read", bytes_read)
+    metrics.set("submissions", len(submissions))
+    metrics.set("pairs", matrix.pair_count())
+    metrics.set("bytes_written", file_size(Path(args.basepath, FILE_NAME)))
+    metrics.write(args.basepath)
+
+    print(f"Found {matrix.pair_count()} similar pairs of submissions")
+    print("Similarity matrix done in", humanize.precisedelta(start_time, format="%1.f"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 """
-Ranks the submissions in order of plagiarism likelihood
+Ranks the submissions in order of plagiarism likelihood, using the summary of
+each submission's matches which compare_hashes writes to match_summary.json
 """
 
 import argparse
 import os
+import sys
 import json
 import humanize
 import datetime
+from functools import partial
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.metrics import StageMetrics, file_size, timed  # noqa: E402
+from common.parallel import run_in_order  # noqa: E402
+
 
 # This is a helper class which is used to store, and ultimately sort, data about submissions
 class Submission:
@@ -45,121 +52,121 @@ class Match:
 def parse_args():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('basepath')
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of ranking.txt files to write at once (0 uses every "
+                             "available core, defaults to ranking_workers in lichen_config.json)")
     return parser.parse_args()
 
 
-# get_submission_stats is passed a user, version, a path to a matches.json, a
-# path to a hashes.txt file, and the hash size and returns a pair of a Submission()
-# object conatining a number of statistics about the specified submission, and a
-# list of Match objects which match this submission
-def get_submission_stats(user_id, version, matches_file, hashes_file, hash_size):
-    submission = Submission(user_id, version)
+# returns the number of threads which should write ranking.txt files at once
+def get_worker_count(args, lichen_config):
+    workers = args.workers
+    if workers is None:
+        workers = lichen_config.get("ranking_workers", 1)
+    if workers <= 0:
+        workers = len(os.sched_getaffinity(0))
+    return workers
+
+
+# get_submission_stats is passed a submission's entry in match_summary.json, which
+# compare_hashes writes, and the hash size and returns a pair of a Submission() object
+# conatining a number of statistics about the specified submission, and a list of Match
+# objects which match this submission, sorted by the number of hashes they match
+def get_submission_stats(summary, hash_size):
+    submission = Submission(summary['username'], str(summary['version']))
 
     # Determine how many hashes there are in this submission
-    with open(hashes_file, 'r') as file:
-        token_count = len([0 for _ in file]) + hash_size
+    token_count = summary['sequences'] + hash_size
 
     # If this is a blank/empty submission, return now
     if token_count <= 1:
         return submission, []
 
-    # It is possible that there are no matches and thus a matches.json file isn't
-    # created. If this is the case, we can simply return now.
-    if not os.path.isfile(matches_file):
-        return submission, []
-
-    with open(matches_file, 'r') as file:
-        matches_json = json.load(file)
-
-    # Calculate the total number of hashes matched, as well as the number of
-    # hashes matched for every other submission with matches
-    matching_submissions = dict()
-    prev_end = 0
-    for match in matches_json:
-        # Common and provided code doesn't have an others list (due to size contraints)
-        if match['type'] != 'match':
-            continue
-
-        for other in match['others']:
-            other_submission = f"{other['username']}_{other['version']}_{other['source_gradeable']}"  # noqa: E501
-            if other_submission not in matching_submissions.keys():
-                matching_submissions[other_submission] = Match(other['username'],
-                                                               other['version'],
-                                                               other['source_gradeable'])
-            matching_submissions[other_submission].matching_hash_count += \
-                match['end'] - max(prev_end, match['start'] - 1)
-        submission.total_hashes_matched += match['end'] - max(prev_end, match['start'] - 1)
-        prev_end = match['end']
+    # compare_hashes has already counted the hashes matched in total and with every other
+    # submission, and sorted the other submissions by them
+    matching_submissions = []
+    for username, version, source_gradeable, matching_hash_count in summary['matches']:
+        match = Match(username, version, source_gradeable)
+        match.matching_hash_count = matching_hash_count
+        matching_submissions.append(match)
+    submission.total_hashes_matched = summary['hashes_matched']
 
     # Actually stored as the fraction of the submission which matches
     submission.percent_match = submission.total_hashes_matched / token_count
 
-    if len(matching_submissions.values()) > 0:
-        matching_submissions = list(matching_submissions.values())
-
-        matching_submissions.sort(key=lambda x: x.matching_hash_count, reverse=True)
+    if len(matching_submissions) > 0:
         submission.highest_match_count = matching_submissions[0].matching_hash_count
-    else:
-        matching_submissions = []
 
     return submission, matching_submissions
 
 
+# writes the ranking.txt for a submission in version_dir
+def write_ranking(version_dir, matching_submissions):
+    with open(Path(version_dir, 'ranking.txt'), 'w') as ranking_file:
+        # matching_submissions is already sorted by the absolute number of hashes matched
+        for match in matching_submissions:
+            ranking_file.write(f"{match.user_id:10} {match.version:3} "
+                               f"{match.source_gradeable} {match.matching_hash_count:>8}\n")
+
+
 def main():
     start_time = datetime.datetime.now()
     args = parse_args()
+    metrics = StageMetrics("similarity_ranking")
 
     print("SIMILARITY RANKING:", flush=True)
     print("[0%                      25%                     50%                     75%                     100%]\n[", end="", flush=True)  # noqa: E501
 
-    with open(Path(args.basepath, "config.json")) as lichen_config_file:
+    with open(Path(Path(__file__).resolve().parent.parent, 'bin', 'lichen_config.json')) \
+            as lichen_config_file:
         lichen_config = json.load(lichen_config_file)
 
     users_dir = Path(args.basepath, 'users')
     if not os.path.isdir(users_dir):
         raise SystemExit('ERROR! Unable to find users directory')
 
+    summary_file = Path(args.basepath, 'match_summary.json')
+    if not os.path.isfile(summary_file):
+        raise SystemExit('ERROR! Unable to find match_summary.json')
+    with open(summary_file) as file:
+        match_summary = json.load(file)
+    metrics.set("bytes_read", file_size(summary_file))
+
+    # the submissions are ranked in the order of their directories, which ties keep
+    summaries = sorted(match_summary['submissions'],
+                       key=lambda summary: (summary['username'], str(summary['version'])))
+
     # We'll make a rough estimate of the percentage of ranking output done by
-    # taking the percentage of users which have been done thus far
-    total_users = len(os.listdir(users_dir))
-    users_ranking_output = 0
+    # taking the percentage of submissions which have been done thus far
+    total_submissions = len(summaries)
+    submissions_ranked = 0
     percent_progress = 0
 
     all_submissions = list()
 
-    for user in sorted(os.listdir(users_dir)):
-        user_dir = Path(users_dir, user)
-        if not os.path.isdir(user_dir):
-            continue
-
-        for version in sorted(os.listdir(user_dir)):
-            version_dir = Path(user_dir, version)
-            if not os.path.isdir(version_dir):
-                continue
-
-            matches_file = Path(version_dir, 'matches.json')
-            hashes_file = Path(version_dir, 'hashes.txt')
-
-            submission, matching_submissions = get_submission_stats(user,
-                                                                    version,
-                                                                    matches_file,
-                                                                    hashes_file,
-                                                                    lichen_config['hash_size'])
-            all_submissions.append(submission)
-
-            # Write the ranking.txt for this submission
-            with open(Path(version_dir, 'ranking.txt'), 'w') as ranking_file:
-                # matching_submissions is already sorted by the absolute number of hashes matched
-                for match in matching_submissions:
-                    ranking_file.write(f"{match.user_id:10} {match.version:3} "
-                                       f"{match.source_gradeable} {match.matching_hash_count:>8}\n")
-
-        users_ranking_output += 1
-        if int((users_ranking_output / total_users) * 100) > percent_progress:
-            new_percent_progress = int((users_ranking_output / total_users) * 100)
+    metrics.start_phase("rank submissions")
+    jobs = []
+    for summary in summaries:
+        version_dir = Path(users_dir, summary['username'], str(summary['version']))
+        submission, matching_submissions = get_submission_stats(summary,
+                                                                match_summary['hash_size'])
+        all_submissions.append(submission)
+        jobs.append((version_dir, matching_submissions))
+
+    for (version_dir, matching_submissions), (seconds, _) in \
+            zip(jobs, run_in_order(partial(timed, write_ranking), jobs,
+                                   get_worker_count(args, lichen_config))):
+        metrics.add_submission(version_dir.relative_to(args.basepath), seconds,
+                               matching_submissions=len(matching_submissions))
+
+        submissions_ranked += 1
+        if int((submissions_ranked / total_submissions) * 100) > percent_progress:
+            new_percent_progress = int((submissions_ranked / total_submissions) * 100)
             print("|" * (new_percent_progress - percent_progress), end="", flush=True)
             percent_progress = new_percent_progress
 
+    metrics.end_phase("rank submissions")
+
     all_submissions.sort(reverse=True)
 
     # A set of all the users we've written lines for thus far (duplicates aren't allowed)
@@ -172,6 +179,8 @@ def main():
                                f"{s.percent_match:4.0%} {s.total_hashes_matched:>8}\n")
             users_written.add(s.user_id)
 
+    metrics.write(args.basepath)
+
     # ==========================================================================
     print("]\nSimilarity ranking done in", humanize.precisedelta(start_time, format="%1.f"))
 
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Benchmarks each stage of Lichen on a synthetic course (see generate_course.py).
+
+Every stage is run on its own, in the order run_lichen.sh and process_all.sh run
+them, and its wall time, CPU time and peak resident set size (including any
+child processes, such as tokenizer workers) are measured.  The phases each stage
+records in logs/metrics are included with the results.  Each repeat starts from
+an empty run directory, which holds the artifact cache and fingerprint indexes, so
+they are never reused between repeats, and the median of each measurement is
+reported.  If fingerprint_index_dir is set in lichen_config.json, it is pointed at
+a directory in the run directory while the stages run, so that the shared indexes
+are neither attached nor written.
+
+The results can be saved as a baseline for the scenario, and later runs are
+compared against it: any stage which takes longer or uses more memory than its
+baseline by more than the tolerance is reported as a regression.  Baselines are
+only comparable when measured on the same machine with the same lichen_config.json.
+
+compare_hashes must be built first (see install_lichen.sh).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from generate_course import LANGUAGES, generate_course
+
+LICHEN_DIR = Path(__file__).resolve().parent.parent.parent
+LICHEN_CONFIG_PATH = Path(LICHEN_DIR, "bin", "lichen_config.json")
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+
+# the parameters of the synthetic course for each scenario, which can each be overridden on
+# the command line
+SCENARIOS = {
+    "small": {"students": 50, "versions": 2, "tokens": 500, "language": "plaintext",
+              "plagiarism_rate": 0.1, "past_terms": 1},
+    "medium": {"students": 300, "versions": 3, "tokens": 2000, "language": "plaintext",
+               "plagiarism_rate": 0.1, "past_terms": 2},
+    "large": {"students": 1000, "versions": 3, "tokens": 5000, "language": "plaintext",
+              "plagiarism_rate": 0.1, "past_terms": 3},
+}
+
+# the measurements of each stage which are compared against the baseline
+COMPARED = ["wall_seconds", "peak_rss_bytes"]
+
+
+# returns the command to run each stage on basepath, in order
+def get_stages(basepath, datapath, compare_hashes, streaming):
+    stages = [("concatenate_all", ["python3", str(Path(LICHEN_DIR, "bin", "concatenate_all.py")),
+                                   str(basepath), str(datapath)])]
+    if streaming:
+        stages.append(("stream_all", ["python3", str(Path(LICHEN_DIR, "bin", "stream_all.py")),
+                                      str(basepath)]))
+    else:
+        stages.append(("tokenize_all", ["python3",
+                                        str(Path(LICHEN_DIR, "tokenizer", "tokenize_all.py")),
+                                        str(basepath)]))
+        stages.append(("hash_all", ["python3", str(Path(LICHEN_DIR, "hasher", "hash_all.py")),
+                                    str(basepath)]))
+    stages.append(("minhash_prefilter",
+                   ["python3", str(Path(LICHEN_DIR, "hasher", "minhash_prefilter.py")),
+                    str(basepath)]))
+    stages.append(("compare_hashes", [str(compare_hashes), str(basepath)]))
+    stages.append(("similarity_ranking",
+                   ["python3", str(Path(LICHEN_DIR, "similarity_ranking",
+                                        "similarity_ranking.py")), str(basepath)]))
+    stages.append(("similarity_matrix",
+                   ["python3", str(Path(LICHEN_DIR, "similarity_ranking",
+                                        "similarity_matrix.py")), str(basepath)]))
+    stages.append(("concatenate_matched",
+                   ["python3", str(Path(LICHEN_DIR, "bin", "concatenate_all.py")),
+                    str(basepath), str(datapath), "--matched"]))
+    return stages
+
+
+# points fingerprint_index_dir in lichen_config.json at a directory in run_dir while the
+# stages run, if it is set, restoring lichen_config.json afterwards
+@contextmanager
+def run_index_dir(run_dir):
+    original = LICHEN_CONFIG_PATH.read_text()
+    lichen_config = json.loads(original)
+    if lichen_config.get("fingerprint_index_dir", "") == "":
+        yield
+        return
+    lichen_config["fingerprint_index_dir"] = str(Path(run_dir, "shared_fingerprint_indexes"))
+    os.makedirs(lichen_config["fingerprint_index_dir"])
+    try:
+        LICHEN_CONFIG_PATH.write_text(json.dumps(lichen_config, indent=2) + "\n")
+        yield
+    finally:
+        LICHEN_CONFIG_PATH.write_text(original)
+
+
+# runs command, writing its output to log_file, and returns its wall time, CPU time and peak
+# resident set size.  The resource usage covers the command and every child process it waited
+# for.
+def run_stage(name, command, log_file):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    _pid, status, usage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise SystemExit(f"ERROR: {name} exited with status {process.returncode}, "
+                         f"see {log_file.name}")
+    return {"wall_seconds": wall_seconds,
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_bytes": usage.ru_maxrss * 1024}
+
+
+# runs every stage on a copy of the generated run directory, returning the measurements of
+# each stage
+def run_once(template, run_dir, datapath, compare_hashes, streaming):
+    shutil.rmtree(run_dir, ignore_errors=True)
+    shutil.copytree(template, run_dir)
+    for directory in ["logs", "other_gradeables", "users"]:
+        os.makedirs(Path(run_dir, directory), exist_ok=True)
+
+    results = dict()
+    with open(Path(run_dir, "logs", "lichen_job_output.txt"), "w") as log_file, \
+            run_index_dir(run_dir):
+        for name, command in get_stages(run_dir, datapath, compare_hashes, streaming):
+            results[name] = run_stage(name, command, log_file)
+            log_file.flush()
+
+            # include the phases of the stage and any values specific to it
+            try:
+                with open(Path(run_dir, "logs", "metrics", f"{name}.json")) as metrics_file:
+                    metrics = json.load(metrics_file)
+            except FileNotFoundError:
+                continue
+            results[name]["phases"] = {phase: times["wall_seconds"]
+                                       for phase, times in metrics["phases"].items()}
+            if "total_bytes" in metrics:
+                results[name]["total_bytes"] = metrics["total_bytes"]
+    return results
+
+
+# combines the results of several runs by taking the median of each measurement
+def median_results(runs):
+    combined = dict()
+    for name in runs[0]:
+        stage = {key: statistics.median(run[name][key] for run in runs)
+                 for key, value in runs[0][name].items() if not isinstance(value, dict)}
+        if "phases" in runs[0][name]:
+            stage["phases"] = {phase: statistics.median(run[name]["phases"][phase]
+                                                        for run in runs)
+                               for phase in runs[0][name]["phases"]}
+        combined[name] = stage
+    return combined
+
+
+# returns a list of (stage, measurement, baseline, result) for every measurement which is more
+# than tolerance worse than its baseline
+def find_regressions(baseline, results, tolerance):
+    regressions = []
+    for name, stage in results.items():
+        if name not in baseline:
+            continue
+        for key in COMPARED:
+            if stage[key] > baseline[name][key] * (1 + tolerance):
+                regressions.append((name, key, baseline[name][key], stage[key]))
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'stage':<20}{'wall (s)':>12}{'cpu (s)':>12}{'peak rss (MB)':>16}{'vs baseline':>14}")
+    for name, stage in results.items():
+        change = ""
+        if baseline is not None and name in baseline:
+            change = f"{stage['wall_seconds'] / baseline[name]['wall_seconds'] - 1:+.1%}"
+        print(f"{name:<20}{stage['wall_seconds']:>12.3f}{stage['cpu_seconds']:>12.3f}"
+              f"{stage['peak_rss_bytes'] / 1e6:>16.1f}{change:>14}")
+        for phase, seconds in stage.get("phases", dict()).items():
+            print(f"    {phase:<28}{seconds:>8.3f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of Lichen on a "
+                                                 "synthetic course")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--students", type=int)
+    parser.add_argument("--versions", type=int)
+    parser.add_argument("--tokens", type=int)
+    parser.add_argument("--language", choices=sorted(LANGUAGES))
+    parser.add_argument("--plagiarism-rate", type=float)
+    parser.add_argument("--past-terms", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of times to run every stage, reporting the median")
+    parser.add_argument("--streaming", action="store_true",
+                        help="run stream_all.py in place of tokenize_all.py and hash_all.py")
+    parser.add_argument("--compare-hashes", type=Path,
+                        default=Path(LICHEN_DIR, "compare_hashes", "compare_hashes.out"),
+                        help="path to the compare_hashes executable")
+    parser.add_argument("--baseline", type=Path,
+                        help="baseline to compare against (defaults to baselines/<scenario>.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as the baseline instead of comparing them")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="how much worse than its baseline a measurement can be, as a share")
+    parser.add_argument("--output", type=Path, help="also write the results as JSON to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.compare_hashes.is_file():
+        raise SystemExit(f"ERROR: Unable to find {args.compare_hashes}, build it with "
+                         "install_lichen.sh or pass --compare-hashes")
+
+    parameters = dict(SCENARIOS[args.scenario])
+    for key in parameters:
+        if getattr(args, key) is not None:
+            parameters[key] = getattr(args, key)
+    parameters["seed"] = args.seed
+    parameters["streaming"] = args.streaming
+
+    with TemporaryDirectory() as temp_dir:
+        datapath = Path(temp_dir, "data")
+        template = Path(temp_dir, "template")
+        print("Generating course:", json.dumps(parameters, sort_keys=True), flush=True)
+        generate_course(datapath, template, parameters["students"], parameters["versions"],
+                        parameters["tokens"], parameters["language"],
+                        parameters["plagiarism_rate"], parameters["past_terms"], args.seed)
+
+        runs = []
+        for repeat in range(args.repeat):
+            print(f"Running every stage ({repeat + 1} of {args.repeat})", flush=True)
+            runs.append(run_once(template, Path(temp_dir, "run"), datapath, args.compare_hashes,
+                                 args.streaming))
+    results = median_results(runs)
+
+    baseline_path = args.baseline or Path(BASELINE_DIR, f"{args.scenario}.json")
+    baseline = None
+    if not args.save_baseline and baseline_path.is_file():
+        with open(baseline_path) as baseline_file:
+            saved = json.load(baseline_file)
+        if saved["parameters"] == parameters:
+            baseline = saved["stages"]
+        else:
+            print(f"Not comparing against {baseline_path}, which was measured with "
+                  f"different parameters: {json.dumps(saved['parameters'], sort_keys=True)}")
+
+    print()
+    print_results(results, baseline)
+
+    output = {"parameters": parameters, "stages": results}
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=4)
+    if args.save_baseline:
+        os.makedirs(baseline_path.parent, exist_ok=True)
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(output, baseline_file, indent=4)
+        print(f"\nSaved baseline to {baseline_path}")
+    elif baseline is not None:
+        regressions = find_regressions(baseline, results, args.tolerance)
+        for name, key, before, after in regressions:
+            print(f"REGRESSION: {name} {key} went from {before:.4g} to {after:.4g}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
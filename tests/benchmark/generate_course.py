@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Generates a synthetic course for benchmarking Lichen.
+
+The course is laid out the way Submitty stores it under a data path:
+    <datapath>/<term>/<course>/submissions/<gradeable>/<user>/<version>/...
+for the current term and for each past term, along with the config.json and
+provided code for a Lichen run on the current term's gradeable.
+
+Each submission is a program made up of randomly generated statements in the
+chosen language, starting with the provided code.  A share of the students, set
+by the plagiarism rate, copy a long run of statements from a student in the same
+term or a past term.  Every version after a student's first changes a few of the
+statements of the version before it.  The same seed always generates the same
+course.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+from pathlib import Path
+
+COURSE = "bench"
+GRADEABLE = "hw1"
+CURRENT_TERM = "current"
+
+# how many statements of each submission are copied from the provided code
+PROVIDED_STATEMENTS = 8
+
+# the share of a source submission's statements which a plagiarized submission copies
+COPIED_SHARE = (0.3, 0.8)
+
+WORDS = ["the", "of", "and", "a", "to", "in", "is", "was", "that", "for", "it", "with", "as",
+         "on", "be", "by", "this", "are", "from", "or", "which", "an", "not", "but", "have",
+         "result", "value", "loop", "array", "function", "pointer", "memory", "string",
+         "compile", "error", "output", "input", "student", "program", "test", "case"]
+NAMES = ["i", "j", "k", "n", "x", "y", "total", "count", "index", "value", "result", "left",
+         "right", "mid", "temp", "sum", "size", "data", "key", "node"]
+OPERATORS = ["+", "-", "*", "/", "%"]
+COMPARISONS = ["<", ">", "<=", ">=", "==", "!="]
+REGISTERS = ["$t0", "$t1", "$t2", "$t3", "$s0", "$s1", "$a0", "$a1", "$v0"]
+
+
+def plaintext_statement(rng):
+    words = rng.choices(WORDS, k=rng.randint(6, 16))
+    return " ".join(words).capitalize() + rng.choice([".", ".", ",", "?", "!"])
+
+
+def python_statement(rng):
+    a, b, c = rng.sample(NAMES, 3)
+    n = rng.randint(0, 99)
+    return rng.choice([
+        f"{a} = {b} {rng.choice(OPERATORS)} {n}",
+        f"if {a} {rng.choice(COMPARISONS)} {b}:\n    {c} += {n}",
+        f"for {a} in range({n}):\n    {b} = {b} {rng.choice(OPERATORS)} {a}",
+        f"print({a}, {b})",
+        f"def {a}_{n}({b}, {c}):\n    return {b} {rng.choice(OPERATORS)} {c}",
+        f"while {a} {rng.choice(COMPARISONS)} {n}:\n    {a} = {a} + 1",
+    ])
+
+
+def c_like_statement(rng, print_call):
+    a, b, c = rng.sample(NAMES, 3)
+    n = rng.randint(0, 99)
+    return rng.choice([
+        f"int {a} = {b} {rng.choice(OPERATORS)} {n};",
+        f"if ({a} {rng.choice(COMPARISONS)} {b}) {{\n    {c} += {n};\n}}",
+        f"for (int {a} = 0; {a} < {n}; {a}++) {{\n    {b} = {b} {rng.choice(OPERATORS)} {a};\n}}",
+        f"{print_call}({a});",
+        f"while ({a} {rng.choice(COMPARISONS)} {n}) {{\n    {a} = {a} + 1;\n}}",
+    ])
+
+
+def mips_statement(rng):
+    a, b, c = rng.sample(REGISTERS, 3)
+    n = rng.randint(0, 99)
+    return rng.choice([
+        f"addi {a}, {b}, {n}",
+        f"add {a}, {b}, {c}",
+        f"lw {a}, {4 * (n % 16)}($sp)",
+        f"sw {a}, {4 * (n % 16)}($sp)",
+        f"beq {a}, {b}, label{n}\nlabel{n}:",
+        f"li $v0, {n % 12}\nsyscall",
+    ])
+
+
+# the statement generator, file extension, and text which each file starts and ends with,
+# for each language in tokenizer_config.json
+LANGUAGES = {
+    "plaintext": (plaintext_statement, "txt", "", ""),
+    "python": (python_statement, "py", "", ""),
+    "cpp": (lambda rng: c_like_statement(rng, "printf"), "cpp",
+            "#include <stdio.h>\n\nint main() {\n", "return 0;\n}\n"),
+    "java": (lambda rng: c_like_statement(rng, "System.out.println"), "java",
+             "public class Main {\npublic static void main(String[] args) {\n", "}\n}\n"),
+    "mips": (mips_statement, "s", ".text\nmain:\n", "li $v0, 10\nsyscall\n"),
+}
+
+
+# returns roughly how many tokens a tokenizer would find in text
+def count_tokens(text):
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+class CourseGenerator:
+    def __init__(self, language, tokens, versions, plagiarism_rate, seed):
+        if language not in LANGUAGES:
+            raise ValueError(f"no statement generator for language {language}")
+        self.statement, self.extension, self.header, self.footer = LANGUAGES[language]
+        self.tokens = tokens
+        self.versions = versions
+        self.plagiarism_rate = plagiarism_rate
+        self.rng = random.Random(seed)
+        self.provided = [self.statement(self.rng) for _ in range(PROVIDED_STATEMENTS)]
+        # the first version of every program generated so far, which plagiarists copy from
+        self.programs = []
+
+    # returns a list of new statements with about the given number of tokens
+    def statements(self, tokens):
+        result = []
+        while tokens > 0:
+            result.append(self.statement(self.rng))
+            tokens -= count_tokens(result[-1])
+        return result
+
+    # returns the statements of each version of a new student's submission
+    def student(self):
+        program = self.provided + self.statements(self.tokens)
+        if len(self.programs) > 0 and self.rng.random() < self.plagiarism_rate:
+            source = self.rng.choice(self.programs)
+            length = min(int(len(source) * self.rng.uniform(*COPIED_SHARE)), len(program))
+            start = self.rng.randint(0, len(source) - length)
+            at = self.rng.randint(0, len(program) - length)
+            program[at:at + length] = source[start:start + length]
+        self.programs.append(program)
+
+        versions = [program]
+        for _ in range(1, self.rng.randint(1, self.versions)):
+            program = list(program)
+            for _ in range(self.rng.randint(1, 3)):
+                program[self.rng.randrange(len(program))] = self.statement(self.rng)
+            versions.append(program)
+        return versions
+
+    # writes a program to dir, split between two files
+    def write_program(self, program, dir):
+        os.makedirs(dir, exist_ok=True)
+        half = len(program) // 2
+        for name, statements in [("main", program[:half]), ("helpers", program[half:])]:
+            with open(Path(dir, f"{name}.{self.extension}"), "w") as file:
+                file.write(self.header + "\n".join(statements) + "\n" + self.footer)
+
+    # writes every submission of a gradeable for the given number of students
+    def write_gradeable(self, gradeable_dir, students):
+        for student in range(students):
+            user_dir = Path(gradeable_dir, f"student{student:05d}")
+            versions = self.student()
+            for version, program in enumerate(versions, start=1):
+                self.write_program(program, Path(user_dir, str(version)))
+            with open(Path(user_dir, "user_assignment_settings.json"), "w") as file:
+                json.dump({"active_version": len(versions)}, file)
+
+
+# generates a course under datapath, with past terms generated before the current term so
+# that plagiarists in the current term can copy from them.  Writes config.json and the provided
+# code for the current term's gradeable to basepath, laid out as run_lichen.sh expects.
+def generate_course(datapath, basepath, students, versions, tokens, language, plagiarism_rate,
+                    past_terms, seed=0):
+    generator = CourseGenerator(language, tokens, versions, plagiarism_rate, seed)
+    terms = [f"past{term}" for term in range(1, past_terms + 1)] + [CURRENT_TERM]
+    for term in terms:
+        generator.write_gradeable(Path(datapath, term, COURSE, "submissions", GRADEABLE),
+                                  students)
+
+    with open(Path(Path(__file__).resolve().parent.parent.parent, "tokenizer",
+                   "tokenizer_config.json")) as token_data_file:
+        hash_size = json.load(token_data_file)[language]["default_hash_size"]
+
+    config = {
+        "term": CURRENT_TERM,
+        "course": COURSE,
+        "gradeable": GRADEABLE,
+        "config_id": 1,
+        "version": "all_versions",
+        "regex": [""],
+        "regex_dirs": ["submissions"],
+        "language": language,
+        "threshold": 10,
+        "hash_size": hash_size,
+        "other_gradeables": [{"other_term": term, "other_course": COURSE,
+                              "other_gradeable": GRADEABLE} for term in terms[:-1]],
+        "ignore_submissions": []
+    }
+    os.makedirs(basepath, exist_ok=True)
+    with open(Path(basepath, "config.json"), "w") as config_file:
+        json.dump(config, config_file, indent=4)
+    generator.write_program(generator.provided, Path(basepath, "provided_code", "files"))
+    return config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic course for Lichen")
+    parser.add_argument("datapath")
+    parser.add_argument("basepath")
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--versions", type=int, default=2,
+                        help="most versions submitted by each student")
+    parser.add_argument("--tokens", type=int, default=1000,
+                        help="about how many tokens are in each submission")
+    parser.add_argument("--language", default="plaintext", choices=sorted(LANGUAGES))
+    parser.add_argument("--plagiarism-rate", type=float, default=0.1,
+                        help="share of students who copy from another submission")
+    parser.add_argument("--past-terms", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    generate_course(args.datapath, args.basepath, args.students, args.versions, args.tokens,
+                    args.language, args.plagiarism_rate, args.past_terms, args.seed)
+
+
+if __name__ == "__main__":
+    main()
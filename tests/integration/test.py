@@ -1,14 +1,48 @@
 #!/usr/bin/env python3
 
 import unittest
+import json
 import os
 import shutil
 import subprocess
+from contextlib import contextmanager
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 
 test_data_dir = Path(__file__).resolve().parent.parent / 'data'
+repository_dir = Path(__file__).resolve().parent.parent.parent
+
+# run_lichen.sh reads lichen_config.json from this repository on the host, and from the
+# installation in docker
+lichen_config_paths = [Path(repository_dir, 'bin', 'lichen_config.json'),
+                       Path('/usr/local/submitty/Lichen/bin/lichen_config.json')]
+
+
+# sets the settings in a test case's lichen_config.json, if it has one, in every
+# lichen_config.json for the duration of its run
+@contextmanager
+def lichen_config_overrides(data_path):
+    overrides_path = Path(data_path, 'lichen_config.json')
+    if not overrides_path.exists():
+        yield
+        return
+    with open(overrides_path) as file:
+        overrides = json.load(file)
+
+    originals = dict()
+    for path in lichen_config_paths:
+        if path.exists():
+            originals[path] = path.read_text()
+    try:
+        for path, original in originals.items():
+            lichen_config = json.loads(original)
+            lichen_config.update(overrides)
+            path.write_text(json.dumps(lichen_config, indent=2) + '\n')
+        yield
+    finally:
+        for path, original in originals.items():
+            path.write_text(original)
 
 
 class TestLichen(unittest.TestCase):
@@ -26,7 +60,8 @@ class TestLichen(unittest.TestCase):
                 subprocess.check_call(f"chgrp -R {data_path.group()} {temp_dir}", shell=True)
 
                 # run Lichen
-                print(subprocess.run(['bash', f'{str(Path(__file__).resolve().parent.parent.parent)}/bin/run_lichen.sh', str(temp_dir), str(data_path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+                with lichen_config_overrides(data_path):
+                    print(subprocess.run(['bash', f'{str(repository_dir)}/bin/run_lichen.sh', str(temp_dir), str(data_path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE))
 
                 # print the output for debugging purposes if necessary
                 with open(Path(temp_dir, 'logs', 'lichen_job_output.txt'), 'r') as file:
@@ -52,8 +87,9 @@ class TestLichen(unittest.TestCase):
                         else:
                             act_path = Path(temp_dir, root.replace(str(ex_output_path), "").strip("/"), file)
 
-                        with open(ex_path) as ex_file:
-                            with open(act_path) as act_file:
+                        # files are compared as bytes, as some of them are binary
+                        with open(ex_path, 'rb') as ex_file:
+                            with open(act_path, 'rb') as act_file:
                                 self.assertEqual(ex_file.read().strip(), act_file.read().strip())
 
                     for dir in dirs:
@@ -66,7 +102,13 @@ class TestLichen(unittest.TestCase):
                         self.assertTrue(os.path.isdir(act_path))
 
                 act_files_count = 0
-                for _, dirs, files in os.walk(Path(temp_dir)):
+                for root, dirs, files in os.walk(Path(temp_dir)):
+                    # the artifact cache's contents depend on previous runs
+                    if root == str(temp_dir) and "cache" in dirs:
+                        dirs.remove("cache")
+                    # as do the timings in the metrics of each stage
+                    if root == str(Path(temp_dir, "logs")) and "metrics" in dirs:
+                        dirs.remove("metrics")
                     act_files_count += len(dirs) + len(files)
 
                 # ensure that we didn't miss any files by checking that there are the same number of files in each directory
@@ -2,12 +2,30 @@
 
 import unittest
 import os
+import sys
 import shutil
 import json
+import hashlib
 import subprocess
+import numpy as np
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
+sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
+sys.path.append(str(Path(__file__).resolve().parent.parent.parent / 'hasher'))
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'benchmark'))
+from common.artifact_cache import ArtifactCache  # noqa: E402
+from common import minhash  # noqa: E402
+from common.fingerprint_index import extract_tokens, index_gradeable, index_path, read_index, read_index_names, read_index_submissions, read_sketches, sketches_path, tokens_path, update_manifest, write_index  # noqa: E402,E501
+from common.hash_file import count_hashes, count_sequences, find_hashes_file, read_fingerprints, read_hashes, write_hashes  # noqa: E402
+from common.matches_file import find_matches_file, matches_file_name, read_matches  # noqa: E402
+from common.metrics import StageMetrics  # noqa: E402
+from common.similarity_matrix import compute_similarity_matrix, read_similarity_matrix, write_similarity_matrix  # noqa: E402
+from common.token_stream import read_tokens, write_tokens  # noqa: E402
+import hash_all  # noqa: E402
+import minhash_prefilter  # noqa: E402
+from generate_course import generate_course  # noqa: E402
+
 
 test_data_dir = Path(__file__).resolve().parent / '..' / 'data'
 
@@ -192,6 +210,25 @@ class TestCTokenizer(unittest.TestCase):
             self.assertEqual(actual_output_with_comments, expected_output_with_comments)
             self.assertEqual(actual_output_ignore_comments, expected_output_ignore_comments)
 
+    def testCTokenizerFullParse(self):
+        self.maxDiff = None
+
+        with TemporaryDirectory() as temp_dir:
+            input_file = Path(test_data_dir, "tokenizer", "c", "input.cpp")
+            output_file = Path(temp_dir, "output.json")
+            expected_output_file = Path(test_data_dir, "tokenizer", "c", "expected_output", "output.json")
+
+            # fully parsing the file gives the same tokens as only lexing it
+            subprocess.check_call(f"python3 {str(Path(Path(__file__).resolve().parent.parent.parent, 'tokenizer', 'c', 'c_tokenizer.py'))} {str(input_file)} --full_parse > {str(output_file)}", shell=True)
+
+            with open(output_file) as file:
+                actual_output = json.load(file)
+
+            with open(expected_output_file) as file:
+                expected_output = json.load(file)
+
+            self.assertEqual(actual_output, expected_output)
+
 
 class TestPythonTokenizer(unittest.TestCase):
     def testPythonTokenizer(self):
@@ -213,6 +250,76 @@ class TestPythonTokenizer(unittest.TestCase):
             self.assertEqual(actual_output, expected_output)
 
 
+class TestTokenizerWorker(unittest.TestCase):
+    def testTokenizerWorker(self):
+        self.maxDiff = None
+
+        test_cases = [
+            ("plaintext", "plaintext_tokenizer.py", [], "input.txt", "output.json"),
+            ("plaintext", "plaintext_tokenizer.py", ["--ignore_punctuation", "--to_lower", "--ignore_numbers", "--ignore_newlines"], "input.txt", "output_ignore_everything.json"),
+            ("mips", "mips_tokenizer.py", [], "input.s", "output.json"),
+            ("python", "python_tokenizer.py", [], "input.py", "output.json"),
+        ]
+
+        with TemporaryDirectory() as temp_dir:
+            for language, tokenizer, cli_args, input_name, expected_name in test_cases:
+                tokenizer_path = Path(Path(__file__).resolve().parent.parent.parent, 'tokenizer', language, tokenizer)
+                worker_path = Path(Path(__file__).resolve().parent.parent.parent, 'tokenizer', 'tokenizer_worker.py')
+                input_file = Path(test_data_dir, "tokenizer", language, input_name)
+                expected_output_file = Path(test_data_dir, "tokenizer", language, "expected_output", expected_name)
+
+                # tokenize the same file twice with a single worker process
+                requests = ""
+                for i in range(2):
+                    requests += json.dumps({"input": str(input_file), "output": str(Path(temp_dir, f"output_{i}.json"))}) + "\n"
+                result = subprocess.run(["python3", str(worker_path), str(tokenizer_path)] + cli_args,
+                                        input=requests, stdout=subprocess.PIPE, text=True, check=True)
+                self.assertEqual(result.stdout.splitlines(), ['{"error": null}'] * 2)
+
+                with open(expected_output_file) as file:
+                    expected_output = json.load(file)
+
+                for i in range(2):
+                    with open(Path(temp_dir, f"output_{i}.json")) as file:
+                        actual_output = json.load(file)
+                    self.assertEqual(actual_output, expected_output)
+
+
+class TestTokenizeAll(unittest.TestCase):
+    def testTokenizeAllParallel(self):
+        self.maxDiff = None
+
+        outputs = []
+        for workers in [1, 4]:
+            with TemporaryDirectory() as temp_dir:
+                # make the fake directory structure tokenize_all.py expects
+                for user in ["aphacker", "bitdiddle", "lreasoner"]:
+                    os.makedirs(Path(temp_dir, "users", user, "1"))
+                    shutil.copyfile(Path(test_data_dir, "tokenizer", "plaintext", "input.txt"),
+                                    Path(temp_dir, "users", user, "1", "submission.concatenated"))
+                os.makedirs(Path(temp_dir, "other_gradeables", "f20__csci1200__hw01", "aphacker", "2"))
+                shutil.copyfile(Path(test_data_dir, "tokenizer", "plaintext", "input.txt"),
+                                Path(temp_dir, "other_gradeables", "f20__csci1200__hw01", "aphacker", "2", "submission.concatenated"))
+                os.makedirs(Path(temp_dir, "provided_code"))
+                open(Path(temp_dir, "provided_code", "submission.concatenated"), 'a').close()
+                with open(Path(temp_dir, "config.json"), 'w') as file:
+                    json.dump({"language": "plaintext"}, file)
+
+                subprocess.check_call(f"python3 {str(Path(Path(__file__).resolve().parent.parent.parent, 'tokenizer', 'tokenize_all.py'))} {temp_dir} --workers {workers} > /dev/null", shell=True)
+
+                output = {}
+                for root, _dirs, files in os.walk(temp_dir):
+                    for file in files:
+                        if file == "tokens.json":
+                            with open(Path(root, file)) as tokens_file:
+                                output[str(Path(root, file).relative_to(temp_dir))] = tokens_file.read()
+                outputs.append(output)
+
+        # every submission should be tokenized, identically to the serial run
+        self.assertEqual(len(outputs[0]), 5)
+        self.assertEqual(outputs[0], outputs[1])
+
+
 ################################################################################
 # Hasher tests
 
@@ -267,5 +374,473 @@ class TestHashAll(unittest.TestCase):
                         self.assertNotEqual(lines[i], lines[j])
 
 
+################################################################################
+# Streaming pipeline tests
+
+class TestStreamAll(unittest.TestCase):
+    def testStreamAllMatchesStages(self):
+        self.maxDiff = None
+        lichen_dir = Path(__file__).resolve().parent.parent.parent
+
+        outputs = []
+        for commands in [["tokenizer/tokenize_all.py", "hasher/hash_all.py"], ["bin/stream_all.py"]]:
+            with TemporaryDirectory() as temp_dir:
+                # make the fake directory structure both of them expect
+                for submission in [Path("users", "aphacker", "1"), Path("users", "bitdiddle", "2"),
+                                   Path("other_gradeables", "f20__csci1200__hw01", "aphacker", "1"),
+                                   Path("provided_code")]:
+                    os.makedirs(Path(temp_dir, submission))
+                    shutil.copyfile(Path(test_data_dir, "tokenizer", "plaintext", "input.txt"),
+                                    Path(temp_dir, submission, "submission.concatenated"))
+                with open(Path(temp_dir, "config.json"), 'w') as file:
+                    json.dump({"language": "plaintext", "hash_size": 3}, file)
+
+                for command in commands:
+                    subprocess.check_call(f"python3 {str(Path(lichen_dir, command))} {temp_dir} > /dev/null", shell=True)
+
+                output = {}
+                for root, _dirs, files in os.walk(temp_dir):
+                    for file in files:
+                        if file in ["tokens.json", "hashes.txt"]:
+                            with open(Path(root, file)) as output_file:
+                                output[str(Path(root, file).relative_to(temp_dir))] = output_file.read()
+                outputs.append(output)
+
+        # every submission should be tokenized and hashed, identically to running each stage
+        self.assertEqual(len(outputs[0]), 8)
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestHashAlgorithms(unittest.TestCase):
+    # returns lists of token values to hash, taken from the test data for each tokenizer
+    def getTokenValues(self):
+        token_values = []
+        for tokens_file in [Path(test_data_dir, "hash_all", "tokens.json"),
+                            Path(test_data_dir, "tokenizer", "plaintext", "expected_output", "output.json"),
+                            Path(test_data_dir, "tokenizer", "python", "expected_output", "output.json"),
+                            Path(test_data_dir, "tokenizer", "mips", "expected_output", "output.json")]:
+            with open(tokens_file) as file:
+                tokens = json.load(file)
+            token_values.append([str(x["value"]) for x in tokens])
+            token_values.append([str(x["type"]) for x in tokens])
+        return token_values
+
+    def testMD5Hashes(self):
+        for token_values in self.getTokenValues():
+            for hash_size in [1, 2, 5, 14]:
+                expected = [hashlib.md5(''.join(token_values[x:x+hash_size]).encode()).hexdigest()[0:8]
+                            for x in range(0, len(token_values)-hash_size+1)]
+                self.assertEqual([f"{h:08x}" for h in hash_all.md5_hashes(token_values, hash_size)], expected)
+
+    def testRollingHashesEquivalentToMD5(self):
+        for token_values in self.getTokenValues():
+            for hash_size in [1, 2, 5, 14]:
+                md5_hashes = hash_all.md5_hashes(token_values, hash_size)
+                rolling_hashes = hash_all.rolling_hashes(token_values, hash_size)
+                self.assertEqual(len(rolling_hashes), len(md5_hashes))
+                self.assertTrue(all(0 <= h < 2**32 for h in rolling_hashes))
+
+                # two sequences must share a rolling hash exactly when they share an md5 hash
+                md5_groups = dict()
+                rolling_groups = dict()
+                for i in range(len(md5_hashes)):
+                    md5_groups.setdefault(md5_hashes[i], []).append(i)
+                    rolling_groups.setdefault(rolling_hashes[i], []).append(i)
+                self.assertEqual(sorted(md5_groups.values()), sorted(rolling_groups.values()))
+
+    def testRollingHashesShortInput(self):
+        self.assertEqual(hash_all.rolling_hashes([], 3), [])
+        self.assertEqual(hash_all.rolling_hashes(["a", "b"], 3), [])
+        self.assertEqual(len(hash_all.rolling_hashes(["a", "b", "c"], 3)), 1)
+        self.assertEqual(hash_all.rolling_hashes(["a", "b", "a", "b"], 2)[0],
+                         hash_all.rolling_hashes(["a", "b", "a", "b"], 2)[2])
+
+    def testWinnowing(self):
+        # the example from the winnowing paper
+        hashes = [77, 74, 42, 17, 98, 50, 17, 98, 8, 88, 67, 39, 77, 74, 42, 17, 98]
+        self.assertEqual(hash_all.winnow(hashes, 4), ([17, 17, 8, 39, 17], [4, 7, 9, 12, 16]))
+        self.assertEqual(hash_all.winnow(hashes, 1), (hashes, list(range(1, len(hashes) + 1))))
+        self.assertEqual(hash_all.winnow([5, 3, 4], 4), ([3], [2]))
+        self.assertEqual(hash_all.winnow([], 4), ([], []))
+
+        for token_values in self.getTokenValues():
+            hashes = hash_all.md5_hashes(token_values, 3)
+            for window in [2, 5, 8]:
+                fingerprints, locations = hash_all.winnow(hashes, window)
+                self.assertEqual(fingerprints, [hashes[i - 1] for i in locations])
+                # every window must contain a selected fingerprint
+                for start in range(1, len(hashes) - window + 2):
+                    self.assertTrue(any(start <= i < start + window for i in locations))
+
+
+class TestHashFile(unittest.TestCase):
+    def testHashFileFormats(self):
+        hashes = [0, 1, 0xdeadbeef, 0xffffffff, 42]
+
+        with TemporaryDirectory() as temp_dir:
+            hex_file = Path(temp_dir, "hashes.txt")
+            write_hashes(hex_file, hashes, 4)
+            with open(hex_file) as file:
+                self.assertEqual(file.read(), "00000000\n00000001\ndeadbeef\nffffffff\n0000002a")
+            self.assertEqual(find_hashes_file(temp_dir), hex_file)
+
+            binary_file = Path(temp_dir, "hashes.bin")
+            write_hashes(binary_file, hashes, 4)
+            self.assertEqual(os.path.getsize(binary_file), 16 + 4 * len(hashes))
+            self.assertEqual(find_hashes_file(temp_dir), binary_file)
+
+            for hashes_file in [hex_file, binary_file]:
+                self.assertEqual(read_hashes(hashes_file), hashes)
+                self.assertEqual(count_hashes(hashes_file), len(hashes))
+
+            # empty submissions have no hashes in either format
+            write_hashes(hex_file, [], 4)
+            write_hashes(binary_file, [], 4)
+            for hashes_file in [hex_file, binary_file]:
+                self.assertEqual(read_hashes(hashes_file), [])
+                self.assertEqual(count_hashes(hashes_file), 0)
+
+    def testHashFileLocations(self):
+        hashes = [0xdeadbeef, 7, 42]
+        locations = [3, 4, 9]
+
+        with TemporaryDirectory() as temp_dir:
+            hex_file = Path(temp_dir, "hashes.txt")
+            write_hashes(hex_file, hashes, 4, locations=locations, sequences=10)
+            with open(hex_file) as file:
+                self.assertEqual(file.read(), "# sequences 10\ndeadbeef 3\n00000007 4\n0000002a 9")
+
+            binary_file = Path(temp_dir, "hashes.bin")
+            write_hashes(binary_file, hashes, 4, locations=locations, sequences=10)
+            self.assertEqual(os.path.getsize(binary_file), 16 + 8 * len(hashes))
+
+            for hashes_file in [hex_file, binary_file]:
+                self.assertEqual(read_fingerprints(hashes_file), (hashes, locations, 10))
+                self.assertEqual(read_hashes(hashes_file), hashes)
+                self.assertEqual(count_hashes(hashes_file), len(hashes))
+                self.assertEqual(count_sequences(hashes_file), 10)
+
+            # without locations every sequence was kept
+            write_hashes(hex_file, hashes, 4)
+            self.assertEqual(read_fingerprints(hex_file), (hashes, [1, 2, 3], 3))
+            self.assertEqual(count_sequences(hex_file), 3)
+
+
+################################################################################
+# Matches file tests
+
+class TestMatchesFile(unittest.TestCase):
+    def testMatchesFileFormats(self):
+        # the same matches, as compare_hashes writes them in each format
+        matches_dir = Path(test_data_dir, "matches_file")
+        with open(Path(matches_dir, "matches.json")) as file:
+            expected = json.load(file)
+        self.assertEqual(expected[0]["others"][0]["matchingpositions"],
+                         [{"end": 4, "start": 1}, {"end": 13, "start": 10}])
+
+        for file_format in ["json", "ndjson", "binary"]:
+            name = matches_file_name({"matches_file_format": file_format})
+            self.assertEqual(read_matches(Path(matches_dir, name)), expected)
+
+        self.assertEqual(matches_file_name({}), "matches.json")
+
+        with TemporaryDirectory() as temp_dir:
+            self.assertIsNone(find_matches_file(temp_dir))
+            shutil.copyfile(Path(matches_dir, "matches.bin"), Path(temp_dir, "matches.bin"))
+            self.assertEqual(find_matches_file(temp_dir), Path(temp_dir, "matches.bin"))
+
+            # a truncated binary file is an error, not a shorter list of regions
+            with open(Path(temp_dir, "matches.bin"), "r+b") as file:
+                file.truncate(os.path.getsize(Path(matches_dir, "matches.bin")) - 1)
+            with self.assertRaises(ValueError):
+                read_matches(Path(temp_dir, "matches.bin"))
+
+
+################################################################################
+# Similarity matrix tests
+
+class TestSimilarityMatrix(unittest.TestCase):
+    def testSimilarityMatrix(self):
+        submissions = [("alice", 1, [1, 2, 3, 4, 8, 9]),
+                       ("alice", 2, [1, 2, 3]),
+                       ("bob", 1, [1, 2, 5, 8, 9, 0x100000001]),
+                       ("carol", 1, [2, 3, 5, 6, 9]),
+                       ("dave", 1, [7])]
+        # 9 is provided code and 2 is shared by more than 2 students, so neither is counted.
+        # Hashes are truncated to 32 bits, so bob's last hash is the same as his first.
+        matrix = compute_similarity_matrix(submissions, [9], 2)
+        self.assertEqual(matrix.fingerprints.tolist(), [4, 2, 3, 3, 1])
+
+        # alice's versions aren't compared with each other
+        self.assertEqual(matrix.pair_count(), 5)
+        self.assertEqual(matrix.top_k("alice", 1, 10),
+                         [("bob", 1, 2, 2 / 4, 2 / 5), ("carol", 1, 1, 1 / 4, 1 / 6)])
+        self.assertEqual(matrix.top_k("alice", 1, 1), [("bob", 1, 2, 2 / 4, 2 / 5)])
+        self.assertEqual(matrix.top_k("bob", 1, 10),
+                         [("alice", 1, 2, 2 / 3, 2 / 5), ("alice", 2, 1, 1 / 3, 1 / 4),
+                          ("carol", 1, 1, 1 / 3, 1 / 5)])
+        self.assertEqual([(user, version) for user, version, *_ in matrix.top_k("carol", 1, 10)],
+                         [("alice", 1), ("alice", 2), ("bob", 1)])
+        self.assertEqual([(user, version) for user, version, *_ in matrix.top_k("carol", 1, 10, "jaccard")],
+                         [("alice", 2), ("bob", 1), ("alice", 1)])
+        self.assertEqual(matrix.top_k("dave", 1, 10), [])
+
+        with TemporaryDirectory() as temp_dir:
+            write_similarity_matrix(Path(temp_dir, "similarity_matrix.bin"), matrix)
+            read_matrix = read_similarity_matrix(Path(temp_dir, "similarity_matrix.bin"))
+        self.assertEqual(read_matrix.names, matrix.names)
+        for name in matrix.names:
+            self.assertEqual(read_matrix.top_k(*name, 10), matrix.top_k(*name, 10))
+
+
+################################################################################
+# Fingerprint index tests
+
+class TestMinHash(unittest.TestCase):
+    def testMinHits(self):
+        hits = minhash.min_hits(128, 0.2, 0.99)
+        self.assertGreaterEqual(minhash.recall(0.2, 128, hits), 0.99)
+        self.assertLess(minhash.recall(0.2, 128, hits + 1), 0.99)
+        # too few samples to reach the target, so one found is enough
+        self.assertEqual(minhash.min_hits(5, 0.2, 0.99), 1)
+
+    def testSketch(self):
+        # hashes are truncated to 32 bits, and the order of a submission's hashes doesn't matter
+        self.assertEqual(minhash.sketch(list(range(1000))[::-1] + [0x100000000], 64).tolist(),
+                         minhash.sketch(range(1000), 64).tolist())
+        self.assertEqual(len(minhash.sketch(range(1000), 64)), 64)
+        self.assertEqual(minhash.sketch([3, 1, 3], 64).tolist(), [1, 3])
+
+    def testRankedSketch(self):
+        ranked = minhash.ranked_sketch(range(1000), 256)
+        self.assertEqual(np.sort(ranked).tolist(), minhash.sketch(range(1000), 256).tolist())
+        # leaving fingerprints out of a ranked sketch leaves the sketch of the rest
+        left = ranked[ranked % 3 != 0]
+        self.assertEqual(np.sort(left[:64]).tolist(),
+                         minhash.sketch([h for h in range(1000) if h % 3 != 0], 64).tolist())
+
+    def testMaxFound(self):
+        these_sets = [np.array([1, 2, 3], dtype=np.uint64), np.array([3, 4], dtype=np.uint64)]
+        queries = [np.array([1, 2, 4], dtype=np.uint64), np.array([3, 4], dtype=np.uint64),
+                   np.array([5], dtype=np.uint64), np.array([], dtype=np.uint64)]
+        self.assertEqual(minhash.max_found(queries, these_sets).tolist(), [2, 2, 0, 0])
+
+    def testCandidatesAtDefaults(self):
+        sketch_size, containment, target_recall, _sample = minhash_prefilter.prefilter_settings({})
+        these_sets = [np.arange(0, 2000, dtype=np.uint64), np.arange(10000, 11000, dtype=np.uint64)]
+        others = [
+            # a quarter of it is copied from the first submission
+            np.concatenate([np.arange(0, 500), np.arange(50000, 51500)]),
+            # a few of its fingerprints are in each submission by chance
+            np.concatenate([np.arange(1900, 1920), np.arange(10900, 10920), np.arange(60000, 62000)]),
+            # as much is copied as from the first, but from both submissions
+            np.concatenate([np.arange(0, 250), np.arange(10000, 10250), np.arange(70000, 71500)]),
+            [],
+        ]
+        sketches = [minhash.sketch(hashes, sketch_size) for hashes in others]
+        self.assertEqual(minhash.candidates(sketches, these_sets, containment, target_recall).tolist(),
+                         [True, False, False, False])
+
+
+class TestFingerprintIndex(unittest.TestCase):
+    def testFingerprintIndex(self):
+        submissions = {("alice", 1): ([5, 3, 5], [1, 2, 4]),
+                       ("alice", 10): ([3], [1]),
+                       ("bob", 2): ([], [])}
+
+        with TemporaryDirectory() as temp_dir:
+            for (user, version), (hashes, locations) in submissions.items():
+                os.makedirs(Path(temp_dir, "gradeable", user, str(version)))
+                write_hashes(Path(temp_dir, "gradeable", user, str(version), "hashes.txt"),
+                             hashes, 4, locations=locations, sequences=5)
+
+            with open(Path(temp_dir, "gradeable", "alice", "10", "tokens.json"), "w") as file:
+                file.write("[]")
+
+            index_gradeable(Path(temp_dir, "indexes"), "key", Path(temp_dir, "gradeable"))
+            index_file = index_path(Path(temp_dir, "indexes"), "key")
+            names, index = read_index(index_file)
+            submission_names, submission_hashes = read_index_submissions(index_file)
+            _names, selected_hashes = read_index_submissions(index_file, [2, 0])
+            sketches = read_sketches(sketches_path(Path(temp_dir, "indexes"), "key"))
+            self.assertEqual(read_index_names(index_file), names)
+
+            # only the submissions which were tokenized have tokens to write
+            extracted = extract_tokens(tokens_path(Path(temp_dir, "indexes"), "key"),
+                                       [("alice", 1, Path(temp_dir, "out", "1")),
+                                        ("alice", 10, Path(temp_dir, "out", "10"))])
+            self.assertEqual(extracted, 1)
+            with open(Path(temp_dir, "out", "10", "tokens.json")) as file:
+                self.assertEqual(file.read(), "[]")
+
+        # versions are sorted numerically, and each hash's postings by submission and location
+        self.assertEqual(names, [["alice", 1], ["alice", 10], ["bob", 2]])
+        self.assertEqual(index, {3: [(0, 2), (1, 1)], 5: [(0, 1), (0, 4)]})
+        self.assertEqual(submission_names, names)
+        # each submission's hashes are read in the order of their locations
+        self.assertEqual([hashes.tolist() for hashes in submission_hashes], [[5, 3, 5], [3], []])
+        self.assertEqual([hashes.tolist() for hashes in selected_hashes], [[], [5, 3, 5]])
+        self.assertEqual([sketch.tolist() for sketch in sketches],
+                         [minhash.ranked_sketch([5, 3], 512).tolist(), [3], []])
+
+    def testSharedIndexManifest(self):
+        config = {"language": "plaintext", "hash_size": 3, "regex": [""], "regex_dirs": ["submissions"],
+                  "version": "active_version", "ignore_submissions": []}
+        with TemporaryDirectory() as temp_dir:
+            store = Path(temp_dir, "store")
+            lichen_config = {"max_sequences_per_file": 10000, "index_other_gradeables": True,
+                             "fingerprint_index_dir": str(store)}
+            os.makedirs(Path(temp_dir, "data", "aphacker", "1"))
+            with open(Path(temp_dir, "data", "aphacker", "1", "main.txt"), "w") as file:
+                file.write("hello")
+            other_gradeables = {"f20__csci1200__hw01": (["f20", "csci1200", "hw01"], [Path(temp_dir, "data")])}
+
+            # runs of different gradeables share the index once it is written
+            manifest = update_manifest(Path(temp_dir, "first"), config, lichen_config, other_gradeables)
+            self.assertFalse(manifest["f20__csci1200__hw01"]["attached"])
+            key = manifest["f20__csci1200__hw01"]["key"]
+            write_index(index_path(store, key), [("aphacker", 1, [1, 2], [0, 1])])
+            manifest = update_manifest(Path(temp_dir, "second"), config, lichen_config, other_gradeables)
+            self.assertEqual(manifest["f20__csci1200__hw01"], {"key": key, "attached": True})
+
+            # changing a submission changes the key.  The out of date index is kept while other
+            # runs may still be reading it, and removed once it hasn't been used for a day.
+            with open(Path(temp_dir, "data", "aphacker", "1", "main.txt"), "a") as file:
+                file.write(" world")
+            manifest = update_manifest(Path(temp_dir, "second"), config, lichen_config, other_gradeables)
+            self.assertFalse(manifest["f20__csci1200__hw01"]["attached"])
+            self.assertEqual(manifest["f20__csci1200__hw01"]["key"].split("-")[0], key.split("-")[0])
+            self.assertTrue(index_path(store, key).exists())
+
+            for file in os.listdir(store):
+                os.utime(Path(store, file), (0, 0))
+            update_manifest(Path(temp_dir, "second"), config, lichen_config, other_gradeables)
+            self.assertEqual(sorted(os.listdir(store)), [".lock"])
+
+
+################################################################################
+# Token stream tests
+
+class TestTokenStream(unittest.TestCase):
+    def testTokenStreamRoundTrip(self):
+        tokens = [{"char": 1, "line": 1, "type": "string", "value": "hello"},
+                  {"char": 7, "line": 1, "type": "string", "value": "[\n]"}]
+
+        with TemporaryDirectory() as temp_dir:
+            tokens_file = Path(temp_dir, "tokens.json")
+            with open(tokens_file, "w") as file:
+                write_tokens(tokens, file)
+            with open(tokens_file) as file:
+                self.assertEqual(json.load(file), tokens)
+            self.assertEqual(list(read_tokens(tokens_file)), tokens)
+
+            with open(tokens_file, "w") as file:
+                write_tokens([], file)
+            self.assertEqual(list(read_tokens(tokens_file)), [])
+
+            # files written by running a tokenizer directly are still readable
+            with open(tokens_file, "w") as file:
+                json.dump(tokens, file, indent=4, sort_keys=True)
+            self.assertEqual(list(read_tokens(tokens_file)), tokens)
+
+            with open(tokens_file, "w") as file:
+                file.write("null")
+            self.assertEqual(list(read_tokens(tokens_file)), [])
+
+
+################################################################################
+# Artifact cache tests
+
+class TestArtifactCache(unittest.TestCase):
+    def testArtifactCache(self):
+        with TemporaryDirectory() as temp_dir:
+            cache = ArtifactCache(Path(temp_dir, "cache"), 10)
+            source = Path(temp_dir, "tokens.json")
+            destination = Path(temp_dir, "fetched.json")
+
+            first_key = cache.key("plaintext", ["--to_lower"], "abc")
+            second_key = cache.key("plaintext", [], "abc")
+            self.assertNotEqual(first_key, second_key)
+
+            # nothing can be fetched before it is stored
+            self.assertFalse(cache.fetch(first_key, "tokens.json", destination))
+
+            with open(source, "w") as file:
+                file.write("123456")
+            cache.store(first_key, "tokens.json", source)
+            self.assertTrue(cache.fetch(first_key, "tokens.json", destination))
+            with open(destination) as file:
+                self.assertEqual(file.read(), "123456")
+
+            # storing past the size limit evicts the least recently used artifact
+            os.utime(cache.path(first_key, "tokens.json"), (0, 0))
+            cache.store(second_key, "tokens.json", source)
+            cache.evict()
+            self.assertFalse(cache.fetch(first_key, "tokens.json", destination))
+            self.assertTrue(cache.fetch(second_key, "tokens.json", destination))
+
+            # a cache without any space is disabled
+            cache = ArtifactCache(Path(temp_dir, "cache"), 0)
+            self.assertFalse(cache.fetch(second_key, "tokens.json", destination))
+
+
+################################################################################
+# Stage metrics tests
+
+class TestStageMetrics(unittest.TestCase):
+    def testStageMetrics(self):
+        metrics = StageMetrics("test_stage")
+        with metrics.phase("first"):
+            pass
+        metrics.start_phase("second")
+        metrics.end_phase("second")
+        metrics.add_submission(Path("users", "alice", "1"), 0.5, hashes=3)
+        metrics.add_submission(Path("users", "bob", "1"), 2.0, hashes=7)
+        metrics.set("submissions_cached", 1)
+
+        with TemporaryDirectory() as temp_dir:
+            metrics.write(temp_dir)
+            with open(Path(temp_dir, "logs", "metrics", "test_stage.json")) as file:
+                written = json.load(file)
+
+        self.assertEqual(written["stage"], "test_stage")
+        self.assertEqual(written["submissions_cached"], 1)
+        self.assertEqual(sorted(written["phases"]), ["first", "second"])
+        self.assertGreaterEqual(written["phases"]["first"]["wall_seconds"], 0)
+        self.assertEqual(written["submissions"]["users/bob/1"], {"hashes": 7, "seconds": 2.0})
+        self.assertEqual(written["slowest_submissions"],
+                         [["users/bob/1", 2.0], ["users/alice/1", 0.5]])
+        self.assertGreater(written["peak_rss_bytes"], 0)
+
+
+################################################################################
+# Benchmark tests
+
+class TestGenerateCourse(unittest.TestCase):
+    def testGenerateCourse(self):
+        outputs = []
+        for _ in range(2):
+            with TemporaryDirectory() as temp_dir:
+                config = generate_course(Path(temp_dir, "data"), Path(temp_dir, "run"), 5, 3,
+                                         200, "python", 0.5, 2, seed=4)
+                output = {}
+                for root, _dirs, files in os.walk(temp_dir):
+                    for file in files:
+                        with open(Path(root, file)) as f:
+                            output[str(Path(root, file).relative_to(temp_dir))] = f.read()
+                outputs.append(output)
+
+        # the same seed always generates the same course
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual([gradeable["other_term"] for gradeable in config["other_gradeables"]],
+                         ["past1", "past2"])
+        self.assertIn("run/config.json", outputs[0])
+        self.assertIn("run/provided_code/files/main.py", outputs[0])
+        for term in ["past1", "past2", "current"]:
+            for student in range(5):
+                self.assertIn(f"data/{term}/bench/submissions/hw1/student{student:05d}/1/main.py",
+                              outputs[0])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,33 +6,58 @@ import os
 import argparse
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='C Tokenizer')
     parser.add_argument('input_file')
     parser.add_argument('--ignore_comments', action='store_true')
-    return parser.parse_args()
+    parser.add_argument('--full_parse', action='store_true')
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+# the clang index is created once and reused for every file tokenized by this process
+index = None
+
+# the tokens are lexed from the file itself, so by default it is parsed as little as possible:
+# as C++ whatever its name, without looking for headers or parsing function bodies
+LEXING_ARGS = ['-x', 'c++', '-nostdinc', '-nostdinc++']
+LEXING_OPTIONS = clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | \
+    clang.cindex.TranslationUnit.PARSE_INCOMPLETE
+
 
+def get_index():
+    global index
+    if index is None:
+        if (os.path.isfile('/usr/lib/llvm-14/lib/libclang.so.1')):
+            clang.cindex.Config.set_library_file('/usr/lib/llvm-14/lib/libclang.so.1')
+        index = clang.cindex.Index.create()
+    return index
+
+
+# fully parses the input file, as the tokenizer used to, which gives the same tokens but takes
+# far longer, especially for code which doesn't compile
+def full_parse(input_file):
     # apparently, the file name must end in .cpp (or some standard
     # c/c++ suffix to be successfully tokenized)
 
     # make a temprary filename
     tmp_cpp_file_handle, tmp_cpp_file_name = tempfile.mkstemp(suffix='.cpp')
+    os.close(tmp_cpp_file_handle)
     # copy the concatenated file to the temporary file location
-    shutil.copy(args.input_file, tmp_cpp_file_name)
-
-    if (os.path.isfile('/usr/lib/llvm-14/lib/libclang.so.1')):
-        clang.cindex.Config.set_library_file('/usr/lib/llvm-14/lib/libclang.so.1')
-    idx = clang.cindex.Index.create()
+    shutil.copy(input_file, tmp_cpp_file_name)
 
     # parse the input file
-    parsed_data = idx.parse(tmp_cpp_file_name)
+    parsed_data = get_index().parse(tmp_cpp_file_name)
 
     # remove the temporary file
     os.remove(tmp_cpp_file_name)
+    return parsed_data
+
+
+def tokenize(args):
+    if args.full_parse:
+        parsed_data = full_parse(args.input_file)
+    else:
+        parsed_data = get_index().parse(args.input_file, args=LEXING_ARGS, options=LEXING_OPTIONS)
 
     tokens = []
 
@@ -50,7 +75,11 @@ def main():
 
         tokens.append(tmp)
 
-    print(json.dumps(tokens, indent=4, sort_keys=True))
+    return tokens
+
+
+def main():
+    print(json.dumps(tokenize(parse_args()), indent=4, sort_keys=True))
 
 
 if __name__ == '__main__':
@@ -1,21 +1,38 @@
 import javac_parser
+import argparse
 import json
-import sys
 
+# starting the JVM is expensive, so a single instance is shared by every file tokenized
 java = javac_parser.Java()
 
-file = open(sys.argv[1], 'r')
-file_content = file.read()
 
-tokens = []
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Java Tokenizer')
+    parser.add_argument('input_file')
+    return parser.parse_args(argv)
 
-for token in java.lex(file_content):
-    tmp = dict()
-    tmp["line"] = token[2][0]
-    tmp["char"] = token[2][1]+1
-    tmp["type"] = str(token[0])
-    tmp["value"] = str(token[1])
-    tokens.append(tmp)
 
-tokens.pop()
-print(json.dumps(tokens, indent=4, sort_keys=True))
+def tokenize(args):
+    with open(args.input_file, 'r') as file:
+        file_content = file.read()
+
+    tokens = []
+
+    for token in java.lex(file_content):
+        tmp = dict()
+        tmp["line"] = token[2][0]
+        tmp["char"] = token[2][1]+1
+        tmp["type"] = str(token[0])
+        tmp["value"] = str(token[1])
+        tokens.append(tmp)
+
+    tokens.pop()
+    return tokens
+
+
+def main():
+    print(json.dumps(tokenize(parse_args()), indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,17 @@ import argparse
 import string
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Plaintext Tokenizer")
     parser.add_argument("input_file")
     parser.add_argument("--ignore_punctuation", action='store_true')
     parser.add_argument("--to_lower", action='store_true')
     parser.add_argument("--ignore_numbers", action='store_true')
     parser.add_argument("--ignore_newlines", action='store_true')
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
-
+def tokenize(args):
     with open(args.input_file, "r", encoding="ISO-8859-1") as input_file:
         file_data = input_file.read()
 
@@ -124,10 +122,14 @@ def main():
             col = 1
         else:
             col += 1
-    # --------------------------------------------------------------------------
+    return tokens
+
+
+def main():
     # print the json file
-    print(json.dumps(tokens, indent=4, sort_keys=True))
+    print(json.dumps(tokenize(parse_args()), indent=4, sort_keys=True))
 
 
 # Run tokenizer
-main()
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,37 @@
-from parso.python.tokenize import tokenize
+from parso.python.tokenize import tokenize as parso_tokenize
+import argparse
 import json
-import sys
 
-file = open(sys.argv[1], 'r')
-file_content = file.read()
 
-tokens = []
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Python Tokenizer')
+    parser.add_argument('input_file')
+    return parser.parse_args(argv)
 
-for token in tokenize(file_content, version_info=(3, 6)):
-    if (str(token.string) != ""):
-        tmp = dict()
-        tmp["line"] = (token.start_pos)[0]
-        tmp["char"] = ((token.start_pos)[1]) + 1
-        tmp["type"] = ((str(token.type))[17:]).strip(")")
-        if tmp["type"] == "OP":
-            tmp["type"] += "-" + str(token.string)
-        tmp["value"] = str(token.string)
-        tokens.append(tmp)
 
-print(json.dumps(tokens, indent=4, sort_keys=True))
+def tokenize(args):
+    with open(args.input_file, 'r') as file:
+        file_content = file.read()
+
+    tokens = []
+
+    for token in parso_tokenize(file_content, version_info=(3, 6)):
+        if (str(token.string) != ""):
+            tmp = dict()
+            tmp["line"] = (token.start_pos)[0]
+            tmp["char"] = ((token.start_pos)[1]) + 1
+            tmp["type"] = ((str(token.type))[17:]).strip(")")
+            if tmp["type"] == "OP":
+                tmp["type"] += "-" + str(token.string)
+            tmp["value"] = str(token.string)
+            tokens.append(tmp)
+
+    return tokens
+
+
+def main():
+    print(json.dumps(tokenize(parse_args()), indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
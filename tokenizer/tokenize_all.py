@@ -5,20 +5,43 @@ Tokenizes the concatenated files.
 
 import argparse
 import os
+import sys
 import json
 import subprocess
+import threading
 import humanize
 import datetime
+from functools import partial
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.artifact_cache import ArtifactCache, file_digest  # noqa: E402
+from common.metrics import StageMetrics, file_size, timed  # noqa: E402
+from common.parallel import run_in_order  # noqa: E402
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("basepath")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of submissions to tokenize at once (0 uses every available "
+                             "core, defaults to tokenizer_workers in lichen_config.json)")
     return parser.parse_args()
 
 
-def tokenize(lichen_config_data, my_concatenated_file, my_tokenized_file):
+# returns the number of tokenizers which should run at once
+def get_worker_count(args, lichen_config):
+    workers = args.workers
+    if workers is None:
+        workers = lichen_config.get("tokenizer_workers", 1)
+    if workers <= 0:
+        workers = len(os.sched_getaffinity(0))
+    return workers
+
+
+# returns the tokenizer_config.json entry for the configured language along with the
+# command line arguments which should be passed to its tokenizer
+def get_tokenizer_config(lichen_config_data):
     language = lichen_config_data["language"]
 
     cli_args = list()
@@ -40,50 +63,130 @@ def tokenize(lichen_config_data, my_concatenated_file, my_tokenized_file):
                         language_token_data["command_args"][argument]["default"]:
                     cli_args.append(language_token_data["command_args"][argument]["argument"])
 
-    tokenizer = Path(Path(__file__).resolve().parent, language_token_data['tokenizer'])
-
-    result = subprocess.run([language_token_data['command_executable'],
-                             tokenizer, my_concatenated_file] + cli_args,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-
-    stderr = result.stderr.decode('utf-8')
-    if not stderr.isspace() and stderr is not None and stderr != '':
-        print(result.stderr.decode("utf-8"))
-
-    with open(my_tokenized_file, 'w') as file:
-        file.write(result.stdout.decode('utf-8'))
+    return language_token_data, cli_args
 
 
-def main():
-    start_time = datetime.datetime.now()
-    args = parse_args()
-
-    print("TOKENIZE ALL:", flush=True)
-    print("[0%                      25%                     50%                     75%                     100%]\n[", end="", flush=True)  # noqa: E501
-
-    with open(os.path.join(args.basepath, "config.json")) as lichen_config:
-        lichen_config_data = json.load(lichen_config)
-
-    users_dir = os.path.join(args.basepath, "users")
-    if not os.path.isdir(users_dir):
-        raise SystemExit("ERROR: Unable to find users directory")
+# tokenizes a single file by starting a new tokenizer process, writing the tokenizer's
+# output straight to my_tokenized_file.  Returns anything the tokenizer printed to stderr
+def tokenize(language_token_data, cli_args, my_concatenated_file, my_tokenized_file):
+    tokenizer = Path(Path(__file__).resolve().parent, language_token_data['tokenizer'])
 
-    other_gradeables_dir = os.path.join(args.basepath, "other_gradeables")
-    if not os.path.isdir(other_gradeables_dir):
-        raise SystemExit("ERROR: Unable to find other gradeables directory")
+    with open(my_tokenized_file, 'wb') as file:
+        result = subprocess.run([language_token_data['command_executable'],
+                                 tokenizer, my_concatenated_file] + cli_args,
+                                stdout=file,
+                                stderr=subprocess.PIPE)
+
+    return result.stderr.decode('utf-8')
+
+
+# tokenizes a single file with tokenize_func unless an identical submission was already
+# tokenized with the same settings, in which case the cached tokens are copied instead.
+# Returns whatever tokenize_func returned, along with whether the cache was used.
+def tokenize_cached(cache, settings_key, tokenize_func, my_concatenated_file, my_tokenized_file):
+    if not cache.enabled():
+        return tokenize_func(my_concatenated_file, my_tokenized_file), False
+
+    key = cache.key(settings_key, file_digest(my_concatenated_file))
+    if cache.fetch(key, "tokens.json", my_tokenized_file):
+        return "", True
+
+    stderr = tokenize_func(my_concatenated_file, my_tokenized_file)
+    # only clean runs are cached so that any problems are reported again on the next run
+    if stderr.strip() == "":
+        cache.store(key, "tokens.json", my_tokenized_file)
+    return stderr, False
+
+
+# A set of long-lived tokenizer processes (see tokenizer_worker.py), one for each thread
+# which tokenizes files.  Starting a tokenizer is often more expensive than tokenizing a
+# submission, so each worker loads its tokenizer once and is reused for every file.
+class TokenizerPool:
+    def __init__(self, language_token_data, cli_args):
+        self.command = [language_token_data['command_executable'],
+                        Path(Path(__file__).resolve().parent, 'tokenizer_worker.py'),
+                        Path(Path(__file__).resolve().parent, language_token_data['tokenizer'])]\
+            + cli_args
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def get_worker(self):
+        worker = getattr(self.local, "worker", None)
+        if worker is None:
+            worker = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, text=True)
+            self.local.worker = worker
+            with self.lock:
+                self.workers.append(worker)
+        return worker
+
+    # sends a request to this thread's worker (see tokenizer_worker.py), returning its response
+    def request(self, request):
+        worker = self.get_worker()
+        try:
+            worker.stdin.write(json.dumps(request) + "\n")
+            worker.stdin.flush()
+            response = worker.stdout.readline()
+        except BrokenPipeError:
+            response = ""
+
+        if response == "":
+            # the worker died partway through, a new one is started for the next file
+            worker.kill()
+            worker.wait()
+            self.local.worker = None
+            return {"error": "Error: tokenizer exited unexpectedly while tokenizing "
+                             f"{request['input']}"}
+        response = json.loads(response)
+        if response["error"] is None:
+            response["error"] = ""
+        return response
+
+    # tokenizes a single file using this thread's worker, returning any error which occurred
+    def tokenize(self, my_concatenated_file, my_tokenized_file):
+        return self.request({"input": str(my_concatenated_file),
+                             "output": str(my_tokenized_file)})["error"]
+
+    # tokenizes a single file using this thread's worker, also writing the tokens to
+    # my_tokenized_file unless it is None.  Returns any error which occurred along with the
+    # token_value field of every token.
+    def tokenize_values(self, my_concatenated_file, my_tokenized_file, token_value):
+        response = self.request({"input": str(my_concatenated_file),
+                                 "output": None if my_tokenized_file is None
+                                 else str(my_tokenized_file),
+                                 "value": token_value})
+        return response["error"], response.get("values", [])
+
+    def close(self):
+        for worker in self.workers:
+            if worker.poll() is None:
+                worker.stdin.close()
+            worker.wait()
+
+
+# returns the part of the cache key for a submission's tokens which depends on the settings.
+# The tokens only depend on its contents, the tokenizer and its arguments (and on how they
+# are written, for tokenizers run as workers).
+def get_settings_key(cache, lichen_config_data, language_token_data, cli_args, persistent):
+    tokenizer = Path(Path(__file__).resolve().parent, language_token_data['tokenizer'])
+    tokenizer_sources = [tokenizer]
+    if persistent:
+        tokenizer_sources += [Path(Path(__file__).resolve().parent, 'tokenizer_worker.py'),
+                              Path(Path(__file__).resolve().parent.parent,
+                                   'common', 'token_stream.py')]
+    return cache.key(lichen_config_data["language"], cli_args,
+                     [file_digest(source) for source in tokenizer_sources])
 
-    # We'll make a rough estimate of the percentage of tokenization done by
-    # taking the percentage of users which have been tokenized thus far
-    total_users = len(os.listdir(users_dir))
-    for dir in os.listdir(other_gradeables_dir):
-        total_users += len(os.listdir(os.path.join(other_gradeables_dir, dir)))
 
-    users_tokenized = 0
-    percent_progress = 0
+# returns a list of (concatenated file, tokenized file) pairs for every submission in
+# this gradeable and the other gradeables, in the order they should be tokenized.  Other
+# gradeables which already have a fingerprint index weren't concatenated, so aren't found.
+def get_submissions(users_dir, other_gradeables_dir):
+    submissions = []
 
     # ===========================================================================
-    # walk the subdirectories to tokenize this gradeable's submissions
+    # walk the subdirectories to find this gradeable's submissions
 
     for user in sorted(os.listdir(users_dir)):
         user_dir = os.path.join(users_dir, user)
@@ -95,18 +198,11 @@ def main():
             if not os.path.isdir(my_dir):
                 continue
 
-            my_concatenated_file = os.path.join(my_dir, "submission.concatenated")
-            my_tokenized_file = os.path.join(my_dir, "tokens.json")
-            tokenize(lichen_config_data, my_concatenated_file, my_tokenized_file)
-
-        users_tokenized += 1
-        if int((users_tokenized / total_users) * 100) > percent_progress:
-            new_percent_progress = int((users_tokenized / total_users) * 100)
-            print("|" * (new_percent_progress - percent_progress), end="", flush=True)
-            percent_progress = new_percent_progress
+            submissions.append((os.path.join(my_dir, "submission.concatenated"),
+                                os.path.join(my_dir, "tokens.json")))
 
     # ===========================================================================
-    # tokenize the other other gradeables' submissions
+    # find the other other gradeables' submissions
 
     for other_gradeable in sorted(os.listdir(other_gradeables_dir)):
         other_gradeable_dir = os.path.join(other_gradeables_dir, other_gradeable)
@@ -123,24 +219,97 @@ def main():
                 if not os.path.isdir(other_version_dir):
                     continue
 
-                other_concatenated_file = os.path.join(other_version_dir, "submission.concatenated")
-                other_tokenized_file = os.path.join(other_version_dir, "tokens.json")
-                tokenize(lichen_config_data, other_concatenated_file, other_tokenized_file)
+                submissions.append((os.path.join(other_version_dir, "submission.concatenated"),
+                                    os.path.join(other_version_dir, "tokens.json")))
 
-            users_tokenized += 1
-            if int((users_tokenized / total_users) * 100) > percent_progress:
-                new_percent_progress = int((users_tokenized / total_users) * 100)
-                print("|" * (new_percent_progress - percent_progress), end="", flush=True)
-                percent_progress = new_percent_progress
+    return submissions
 
-    # ===========================================================================
-    # tokenize the provided code
+
+def main():
+    start_time = datetime.datetime.now()
+    args = parse_args()
+    metrics = StageMetrics("tokenize_all")
+
+    print("TOKENIZE ALL:", flush=True)
+    print("[0%                      25%                     50%                     75%                     100%]\n[", end="", flush=True)  # noqa: E501
+
+    with open(os.path.join(args.basepath, "config.json")) as lichen_config:
+        lichen_config_data = json.load(lichen_config)
+
+    with open(Path(Path(__file__).resolve().parent.parent,
+                   'bin', 'lichen_config.json')) as lichen_config_file:
+        lichen_config = json.load(lichen_config_file)
+
+    users_dir = os.path.join(args.basepath, "users")
+    if not os.path.isdir(users_dir):
+        raise SystemExit("ERROR: Unable to find users directory")
+
+    other_gradeables_dir = os.path.join(args.basepath, "other_gradeables")
+    if not os.path.isdir(other_gradeables_dir):
+        raise SystemExit("ERROR: Unable to find other gradeables directory")
+
+    language_token_data, cli_args = get_tokenizer_config(lichen_config_data)
+
+    with metrics.phase("find submissions"):
+        submissions = get_submissions(users_dir, other_gradeables_dir)
+
+    # the provided code is tokenized last, along with everything else
     provided_code_concat = os.path.join(args.basepath, "provided_code", "submission.concatenated")
     provided_code_tokenized = os.path.join(args.basepath, "provided_code", "tokens.json")
-    tokenize(lichen_config_data, provided_code_concat, provided_code_tokenized)
+    submissions.append((provided_code_concat, provided_code_tokenized))
+
+    submissions_tokenized = 0
+    submissions_cached = 0
+    percent_progress = 0
+
+    # tokenizers which support it are run as persistent workers, others are started once per file
+    if language_token_data.get("persistent_worker", False):
+        pool = TokenizerPool(language_token_data, cli_args)
+        tokenize_func = pool.tokenize
+    else:
+        pool = None
+        tokenize_func = partial(tokenize, language_token_data, cli_args)
+
+    cache = ArtifactCache(Path(args.basepath, "cache"),
+                          lichen_config.get("cache_max_total_bytes", 0))
+    settings_key = get_settings_key(cache, lichen_config_data, language_token_data, cli_args,
+                                    pool is not None)
+
+    # each job only hands a file to a tokenizer process and waits on it, so threads are enough
+    # to keep one tokenizer per worker busy
+    jobs = [(cache, settings_key, tokenize_func, concatenated, tokenized)
+            for concatenated, tokenized in submissions]
+    try:
+        with metrics.phase("tokenize"):
+            for (concatenated, tokenized), (seconds, (stderr, cached)) in \
+                    zip(submissions, run_in_order(partial(timed, tokenize_cached), jobs,
+                                                  get_worker_count(args, lichen_config))):
+                if not stderr.isspace() and stderr is not None and stderr != '':
+                    print(stderr)
+
+                metrics.add_submission(Path(concatenated).parent.relative_to(args.basepath),
+                                       seconds, cached=cached,
+                                       bytes_read=file_size(concatenated),
+                                       bytes_written=file_size(tokenized))
+                submissions_tokenized += 1
+                submissions_cached += cached
+                if int((submissions_tokenized / len(jobs)) * 100) > percent_progress:
+                    new_percent_progress = int((submissions_tokenized / len(jobs)) * 100)
+                    print("|" * (new_percent_progress - percent_progress), end="", flush=True)
+                    percent_progress = new_percent_progress
+    finally:
+        if pool is not None:
+            pool.close()
+
+    with metrics.phase("evict cache"):
+        cache.evict()
+    metrics.set("submissions_cached", submissions_cached)
+    metrics.write(args.basepath)
 
     # ==========================================================================
     print("]\nTokenization done in", humanize.precisedelta(start_time, format="%1.f"))
+    if cache.enabled():
+        print(f"Reused cached tokens for {submissions_cached} of {len(jobs)} submissions")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Runs a tokenizer as a long-lived worker process.  The tokenizer (and anything
+it needs, such as libclang or a JVM) is loaded once, after which the worker
+tokenizes one file per request until its stdin is closed.
+
+Each request is a single line of JSON on stdin:
+    {"input": "path/to/submission.concatenated", "output": "path/to/tokens.json"}
+and each response is a single line of JSON on stdout:
+    {"error": null}  or  {"error": "description of what went wrong"}
+
+A request may also name a token field as "value", in which case the response
+includes that field of every token as a string, so that the tokens can be hashed
+without reading them back from disk (see bin/stream_all.py):
+    {"input": "...", "output": null, "value": "type"}
+    {"error": null, "values": ["NAME", "OP", ...]}
+"output" may be null if the tokens don't need to be written at all.
+
+The tokens written to the output file are the same tokens the tokenizer prints
+when it is run directly from the command line, written one per line as they are
+serialized (see common/token_stream.py) instead of as one pretty-printed document.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import traceback
+from contextlib import nullcontext
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.token_stream import write_tokens  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tokenizer Worker")
+    parser.add_argument("tokenizer")
+    # any remaining arguments are passed along to the tokenizer for every file
+    return parser.parse_known_args()
+
+
+def load_tokenizer(tokenizer_path):
+    spec = importlib.util.spec_from_file_location(Path(tokenizer_path).stem, tokenizer_path)
+    tokenizer = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tokenizer)
+    return tokenizer
+
+
+def main():
+    args, cli_args = parse_args()
+
+    # keep stdout for responses only: anything the tokenizer (or a library it loads,
+    # such as the JVM) prints is sent to stderr instead
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    tokenizer = load_tokenizer(args.tokenizer)
+
+    for request in sys.stdin:
+        request = json.loads(request)
+        response = {"error": None}
+        output = request.get("output")
+        with open(output, "w") if output is not None else nullcontext() as output_file:
+            try:
+                tokens = tokenizer.tokenize(tokenizer.parse_args([request["input"]] + cli_args))
+                if request.get("value") is not None:
+                    # the tokens are used twice, so they can't be streamed
+                    tokens = list(tokens)
+                    response["values"] = [str(token[request["value"]]) for token in tokens]
+                if output_file is not None:
+                    write_tokens(tokens, output_file)
+            except Exception:
+                response["error"] = traceback.format_exc()
+        print(json.dumps(response), file=responses, flush=True)
+
+
+if __name__ == "__main__":
+    main()